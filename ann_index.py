@@ -0,0 +1,210 @@
+import os
+import numpy as np
+
+DEFAULT_NPROBE = int(os.environ.get('ANN_NPROBE', 16))
+
+KMEANS_ITERATIONS = 10
+
+# k-means is trained on a sample of this many rows per list
+TRAINING_ROWS_PER_LIST = 32
+
+# Rows added after the inverted lists were built are scanned by every query until
+# they make up this share of the index, then the lists are rebuilt
+MAX_TAIL_FRACTION = 0.1
+
+# Bounds the (rows x nlist) score block when assigning rows to lists
+ASSIGN_BLOCK_ELEMENTS = 1 << 24
+
+class IVFIndex:
+    """Inverted-file (IVF-flat) partition of the rows of a VectorIndex
+
+    Rows are assigned to the nearest of nlist spherical k-means centroids, and a
+    query only scores the rows of its nprobe closest lists: raising nprobe
+    trades speed for recall. The vectors themselves stay in the owning
+    VectorIndex; this only keeps the centroids and one list id per row, so
+    rows are added incrementally by assigning them to a list. Deleted rows are
+    filtered out by the owner and dropped from the lists on compaction.
+
+    Centroids and assignments are saved to an .npz file next to the database
+    so a restart doesn't need to run k-means again.
+    """
+
+    def __init__(self, path=None, nprobe=DEFAULT_NPROBE):
+        self.path = path
+        self.nprobe = nprobe
+        self.reset()
+
+    def reset(self):
+        self.centroids = None
+        self.trained_rows = 0
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._size = 0
+        self._list_offsets = np.zeros(1, dtype=np.int64)
+        self._list_rows = np.empty(0, dtype=np.int64)
+        self._listed = 0  # rows covered by the inverted lists; the rest are the tail
+        self.dirty = False
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    @property
+    def nlist(self):
+        return 0 if self.centroids is None else len(self.centroids)
+
+    @staticmethod
+    def default_nlist(num_rows):
+        return int(max(1, min(num_rows, 4 * np.sqrt(num_rows))))
+
+    def _nearest(self, vectors, centroids=None):
+        """Index of the closest centroid of every row, computed in bounded blocks"""
+        centroids = self.centroids if centroids is None else centroids
+        labels = np.empty(len(vectors), dtype=np.int32)
+        block = max(1, ASSIGN_BLOCK_ELEMENTS // len(centroids))
+        for start in range(0, len(vectors), block):
+            labels[start:start + block] = np.argmax(vectors[start:start + block] @ centroids.T, axis=1)
+        return labels
+
+    def train(self, vectors, nlist=None, seed=0):
+        """Fit the centroids with spherical k-means over a sample of unit-length rows"""
+        num_rows = len(vectors)
+        nlist = min(nlist or self.default_nlist(num_rows), num_rows)
+        rng = np.random.default_rng(seed)
+
+        sample_size = min(num_rows, nlist * TRAINING_ROWS_PER_LIST)
+        sample = vectors[np.sort(rng.choice(num_rows, sample_size, replace=False))]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(KMEANS_ITERATIONS):
+            labels = self._nearest(sample, centroids)
+            order = np.argsort(labels, kind='stable')
+            counts = np.bincount(labels, minlength=nlist)
+            filled = np.flatnonzero(counts)
+            sums = np.add.reduceat(sample[order], (np.cumsum(counts) - counts)[filled])
+            centroids[filled] = sums
+            # Re-seed empty lists with random sample rows
+            empty = np.flatnonzero(counts == 0)
+            if empty.size:
+                centroids[empty] = sample[rng.choice(sample_size, empty.size, replace=False)]
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids /= norms
+
+        self.centroids = centroids.astype(np.float32, copy=False)
+        self.trained_rows = num_rows
+        self._size = 0
+        self._listed = 0
+        self._assignments = np.empty(0, dtype=np.int32)
+
+    def assign_all(self, vectors):
+        """(Re)assign every row and rebuild the inverted lists"""
+        self._assignments = self._nearest(vectors)
+        self._size = len(vectors)
+        self._build_lists()
+        self.dirty = True
+
+    def append(self, start, vectors):
+        """Assign rows [start, start + len(vectors)) appended by the owner"""
+        if start != self._size:
+            raise ValueError(f"Rows must be appended in order: expected row {self._size}, got {start}")
+        needed = self._size + len(vectors)
+        if needed > len(self._assignments):
+            resized = np.empty(max(needed, 2 * len(self._assignments)), dtype=np.int32)
+            resized[:self._size] = self._assignments[:self._size]
+            self._assignments = resized
+        self._assignments[self._size:needed] = self._nearest(vectors)
+        self._size = needed
+        self.dirty = True
+        if self._size - self._listed > MAX_TAIL_FRACTION * self._size:
+            self._build_lists()
+
+    def compact(self, row_mask):
+        """Drop the rows the owner compacted away (row_mask marks the survivors)"""
+        self._assignments = self._assignments[:self._size][row_mask]
+        self._size = len(self._assignments)
+        self._build_lists()
+        self.dirty = True
+
+    def _build_lists(self):
+        assignments = self._assignments[:self._size]
+        self._list_rows = np.argsort(assignments, kind='stable')
+        self._list_offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=self.nlist), out=self._list_offsets[1:])
+        self._listed = self._size
+
+    def probe(self, query, nprobe=None):
+        """Rows of the nprobe lists closest to a unit-length query, plus the unlisted tail, ascending"""
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        closeness = self.centroids @ query
+        lists = np.argpartition(-closeness, nprobe - 1)[:nprobe]
+        parts = [self._list_rows[self._list_offsets[i]:self._list_offsets[i + 1]] for i in lists]
+        parts.append(np.arange(self._listed, self._size))
+        rows = np.concatenate(parts)
+        rows.sort()
+        return rows
+
+    @staticmethod
+    def fingerprint(vectors):
+        """Cheap per-row checksum used to tell whether a persisted row is still the same vector"""
+        probe = np.random.default_rng(0).standard_normal(vectors.shape[1]).astype(np.float32)
+        fingerprints = np.empty(len(vectors), dtype=np.float32)
+        block = max(1, ASSIGN_BLOCK_ELEMENTS // vectors.shape[1])
+        for start in range(0, len(vectors), block):
+            fingerprints[start:start + block] = vectors[start:start + block] @ probe
+        return fingerprints
+
+    def save(self, document_ids, ordinals, vectors):
+        """Persist the centroids and assignments, keyed by (document_id, ordinal) of every row"""
+        if self.path is None or not self.trained:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, trained_rows=self.trained_rows,
+                     assignments=self._assignments[:self._size], document_ids=document_ids,
+                     ordinals=ordinals, fingerprints=self.fingerprint(vectors))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def load(self, document_ids, ordinals, vectors):
+        """Restore persisted centroids, reusing the saved assignment of every unchanged row
+
+        Returns:
+            bool: False if there is no usable saved index
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path) as saved:
+                centroids = saved['centroids']
+                if centroids.shape[1] != vectors.shape[1]:
+                    return False
+                self.reset()
+                self.centroids = centroids
+                self.trained_rows = int(saved['trained_rows'])
+                if (len(saved['assignments']) == len(vectors)
+                        and np.array_equal(saved['document_ids'], document_ids)
+                        and np.array_equal(saved['ordinals'], ordinals)):
+                    self._assignments = saved['assignments'].astype(np.int32)
+                    self._size = len(vectors)
+                    # Rows whose vector changed in place are assigned again
+                    changed = np.flatnonzero(~np.isclose(saved['fingerprints'], self.fingerprint(vectors),
+                                                         rtol=1e-4, atol=1e-5))
+                    if changed.size * 2 > len(vectors):
+                        # Most vectors were replaced (a rebuild was swapped in): the centroids no longer fit
+                        self.reset()
+                        return False
+                    if changed.size:
+                        self._assignments[changed] = self._nearest(vectors[changed])
+                    self._build_lists()
+                    self.dirty = bool(changed.size)
+                else:
+                    self.assign_all(vectors)
+            return True
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Ignoring unreadable ANN index {self.path}: {str(e)}")
+            self.reset()
+            return False
+
+    def remove_file(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,11 +1,15 @@
-from embeder import DocumentEmbedder
+from embeder import get_embedder
 from retreiver import DocumentRetriever
-from database import db  # Import the database instance
-from flask import Flask, request, jsonify
+from database import db, normalize_date  # Import the database instance
+from jobs import JobQueue
+import metrics
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 import os
 import json
+import math
+import time
 import logging
-import sqlite3  # Added SQLite import
+import threading
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
@@ -25,9 +29,64 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB limit
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize DocumentEmbedder and DocumentRetriever
-embeder = DocumentEmbedder()
-retriever = DocumentRetriever(query=None)  # No longer need to pass db_path
+# Documents per page of /documents, by default and at most
+DOCUMENTS_PAGE_SIZE = int(os.environ.get('DOCUMENTS_PAGE_SIZE', 100))
+MAX_DOCUMENTS_PAGE_SIZE = 1000
+
+# Document metadata filters accepted by /search, pushed down to the database
+SEARCH_FILTERS = ('path_prefix', 'created_after', 'created_before', 'min_size', 'max_size')
+
+# Share a single DocumentEmbedder between ingestion and search
+embeder = get_embedder()
+retriever = DocumentRetriever(embeder, db)
+
+# Background ingestion workers, fed through the persistent jobs table
+job_queue = JobQueue(db, embeder)
+
+# Load the model and the search index in the background once the server starts handling
+# requests (WARMUP=0 leaves that to the first search, or to the first /ready check)
+WARMUP = os.environ.get('WARMUP', '1') != '0'
+warmup_state = {'started': False, 'index_loaded': False, 'seconds': None, 'error': None}
+_warmup_lock = threading.Lock()
+
+def warmup():
+    """Load the model and the index, and run one forward pass"""
+    start = time.perf_counter()
+    try:
+        embeder.warmup()
+        retriever.index.load()
+        warmup_state['index_loaded'] = True
+        warmup_state['seconds'] = time.perf_counter() - start
+        logger.info(f"Warmup complete in {warmup_state['seconds']:.1f} s")
+    except Exception as e:
+        warmup_state['error'] = str(e)
+        logger.error(f"Warmup failed: {str(e)}")
+
+def start_warmup():
+    """Run warmup() on a background thread (safe to call more than once)"""
+    with _warmup_lock:
+        if warmup_state['started']:
+            return
+        warmup_state['started'] = True
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+@app.before_request
+def start_request_timer():
+    # Label by route pattern, not path, so document IDs don't create a series each
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.timer = metrics.RequestTimer(endpoint)
+    g.timer.start()
+
+@app.after_request
+def stop_request_timer(response):
+    """Record the request, and add the X-Timing stage breakdown if the client asked for it"""
+    timer = g.pop('timer', None)
+    if timer is not None:
+        timer.stop(response.status_code)
+        # A streamed body is produced after this runs, so its breakdown would be empty
+        if (request.headers.get('X-Timing') or request.args.get('timing')) and not response.is_streamed:
+            response.headers['X-Timing'] = timer.header()
+    return response
 
 # Function to check if the file is allowed
 def allowed_file(filename):
@@ -42,15 +101,13 @@ def save_file(file):
         return file_path
     return None
 
-# Function to process the uploaded file and generate embeddings
-def process_file(file_path):
-    # We can now use the embeder's process_document method directly
-    success = embeder.process_document(file_path)
-    
-    if success:
-        return {"status": "success", "file_path": file_path}
-    else:
-        return {"status": "error", "file_path": file_path}
+# Start the ingestion workers with the first request rather than at import,
+# so the reloader's parent process never runs jobs of its own
+@app.before_request
+def start_job_queue():
+    job_queue.start()
+    if WARMUP:
+        start_warmup()
 
 # Routes
 @app.route('/', methods=['GET'])
@@ -60,25 +117,67 @@ def index():
 
 @app.route('/documents', methods=['GET'])
 def list_documents():
-    """Get a list of all documents in the database"""
+    """List documents, newest first, one keyset page at a time
+    
+    Query parameters: limit (page size), after_id (the next_after_id of the
+    previous page), extension (repeatable), path_prefix, created_after,
+    created_before, min_size and max_size. With format=ndjson every matching document is streamed
+    instead, one JSON line each.
+    """
     try:
-        conn = db.db_path
-        # Using SQLite connection to get all documents
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, file_path, created_at FROM documents ORDER BY id DESC")
-        rows = cursor.fetchall()
-        conn.close()
+        try:
+            after_id = request.args.get('after_id', None, type=int)
+            limit = request.args.get('limit', None, type=int)
+            if 'after_id' in request.args and after_id is None:
+                raise ValueError("after_id must be an integer")
+            for name in ('min_size', 'max_size'):
+                if name in request.args and request.args.get(name, type=int) is None:
+                    raise ValueError(f"{name} must be an integer")
+            if 'limit' in request.args and (limit is None or limit < 1):
+                raise ValueError("limit must be a positive integer")
+            dates = {name: date_bound(name, request.args[name])
+                     for name in ('created_after', 'created_before') if request.args.get(name)}
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        documents = []
-        for row in rows:
-            documents.append({
+        filters = {
+            'extensions': request.args.getlist('extension') or None,
+            'path_prefix': request.args.get('path_prefix'),
+            'created_after': dates.get('created_after'),
+            'created_before': dates.get('created_before'),
+            'min_size': request.args.get('min_size', None, type=int),
+            'max_size': request.args.get('max_size', None, type=int)
+        }
+        
+        def document_json(row):
+            return {
                 'id': row[0],
                 'file_path': row[1],
-                'created_at': row[2]
-            })
+                'created_at': row[2],
+                'extension': row[3],
+                'text_length': row[4]
+            }
+        
+        if request.args.get('format') == 'ndjson':
+            def generate():
+                try:
+                    for row in db.iter_documents(after_id=after_id, limit=limit, **filters):
+                        yield json.dumps(document_json(row)) + '\n'
+                except Exception as e:
+                    # Headers are already sent; report the failure as the last line
+                    logger.error(f"Error listing documents: {str(e)}")
+                    yield json.dumps({"error": str(e)}) + '\n'
+            
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
         
-        return jsonify(documents)
+        limit = min(limit or DOCUMENTS_PAGE_SIZE, MAX_DOCUMENTS_PAGE_SIZE)
+        rows = db.list_documents(after_id, limit, **filters)
+        
+        return jsonify({
+            'documents': [document_json(row) for row in rows],
+            # Pass back as after_id for the next page; null on the last page
+            'next_after_id': rows[-1][0] if len(rows) == limit else None
+        })
     
     except Exception as e:
         logger.error(f"Error listing documents: {str(e)}")
@@ -104,9 +203,9 @@ def upload_file():
         if not file_path:
             return jsonify({"error": "File type not allowed"}), 400
         
-        # Process the file and save to database
-        result = process_file(file_path)
-        return jsonify(result), 201
+        # Queue the file for background processing
+        job_id = job_queue.enqueue_upload(file_path)
+        return jsonify({"status": "queued", "job_id": job_id, "file_path": file_path}), 202
     
     except Exception as e:
         logger.error(f"Error uploading file: {str(e)}")
@@ -125,19 +224,108 @@ def process_dir():
         
         if not os.path.isdir(directory_path):
             return jsonify({"error": "Invalid directory path"}), 400
+        try:
+            file_extensions = extension_list('file_extensions', file_extensions)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Use the embeder's process_directory method
-        embeder.process_directory(directory_path, file_extensions)
+        # Queue the directory for background processing; unchanged files are skipped unless incremental is false
+        job_id = job_queue.enqueue_directory(
+            directory_path,
+            file_extensions,
+            incremental=data.get('incremental', True),
+            purge_missing=data.get('purge_missing', False)
+        )
         
         return jsonify({
-            "status": "success", 
-            "message": "Directory processing initiated"
-        }), 200
+            "status": "queued", 
+            "message": "Directory processing initiated",
+            "job_id": job_id
+        }), 202
     
     except Exception as e:
         logger.error(f"Error processing directory: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def extension_list(name, value):
+    """File extensions of a request as a list; a single extension may be sent as a string
+
+    Raises:
+        ValueError: If value is neither a string nor a list of strings
+    """
+    if isinstance(value, str):
+        return [value]
+    if value is not None and not (isinstance(value, list) and all(isinstance(ext, str) for ext in value)):
+        raise ValueError(f"{name} must be a list of file extensions")
+    return value
+
+def date_bound(name, value):
+    """A created_after/created_before value in the form stored in created_at
+
+    Raises:
+        ValueError: If value isn't an ISO 8601 date or date and time
+    """
+    try:
+        return normalize_date(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an ISO 8601 date or date and time, e.g. 2024-05-01 or 2024-05-01T10:00:00")
+
+def search_options(data):
+    """Validate the search options of a request body
+
+    Returns:
+        dict: Keyword arguments of DocumentRetriever.search_similar_documents
+
+    Raises:
+        ValueError: With a message for the client if an option is invalid
+    """
+    options = {
+        'top_k': data.get('top_k', 5),
+        'file_extensions': extension_list('file_extensions', data.get('file_extensions', None)),
+        'min_similarity': data.get('min_similarity', 0.0),
+        'aggregation': data.get('aggregation', 'max'),
+        'top_n': data.get('top_n', 3),
+        'nprobe': data.get('nprobe', None),
+        'exact': data.get('exact', False),
+        'mode': data.get('mode', 'vector'),
+        'prefilter': data.get('prefilter', False),
+        'filters': {name: data[name] for name in SEARCH_FILTERS if data.get(name) is not None} or None
+    }
+    for name in ('top_k', 'top_n', 'nprobe'):
+        value = options[name]
+        if (value is not None or name != 'nprobe') and (
+                not isinstance(value, int) or isinstance(value, bool) or value < 1):
+            raise ValueError(f"{name} must be a positive integer")
+    min_similarity = options['min_similarity']
+    if (not isinstance(min_similarity, (int, float)) or isinstance(min_similarity, bool)
+            or not math.isfinite(min_similarity)):
+        raise ValueError("min_similarity must be a number")
+    for name in ('exact', 'prefilter'):
+        if not isinstance(options[name], bool):
+            raise ValueError(f"{name} must be true or false")
+    if options['aggregation'] not in ('max', 'top_n_mean'):
+        raise ValueError("aggregation must be 'max' or 'top_n_mean'")
+    if options['mode'] not in ('vector', 'lexical', 'hybrid'):
+        raise ValueError("mode must be 'vector', 'lexical' or 'hybrid'")
+    if (options['mode'] != 'vector' or options['prefilter']) and not db.full_text_search:
+        raise ValueError("Lexical search needs an SQLite build with FTS5")
+    for name, value in (options['filters'] or {}).items():
+        if name in ('min_size', 'max_size'):
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise ValueError(f"{name} must be a non-negative integer")
+        elif not isinstance(value, str):
+            raise ValueError(f"{name} must be a string")
+        elif name in ('created_after', 'created_before'):
+            options['filters'][name] = date_bound(name, value)
+    return options
+
+def json_results(results):
+    """Convert NumPy float32 similarities to native Python floats to make them JSON serializable"""
+    for result in results:
+        if 'similarity' in result and isinstance(result['similarity'], np.float32):
+            result['similarity'] = float(result['similarity'])
+    return results
+
 @app.route('/search', methods=['POST'])
 def search():
     """Find documents similar to a query"""
@@ -146,38 +334,112 @@ def search():
         if not data or 'query' not in data:
             return jsonify({"error": "Query is required"}), 400
         
-        query_text = data['query']
-        top_k = data.get('top_k', 5)
-        file_extensions = data.get('file_extensions', None)
-        min_similarity = data.get('min_similarity', 0.0)
-        
-        # Create a retriever with the query
-        retriever_instance = DocumentRetriever(query=query_text)
+        try:
+            options = search_options(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         # Find similar documents with the new filter parameters
-        results = retriever_instance.search_similar_documents(
-            query_text, 
-            top_k=top_k,
-            file_extensions=file_extensions,
-            min_similarity=min_similarity
-        )
+        results = retriever.search_similar_documents(data['query'], **options)
+        with metrics.timed('serialize'):
+            response = jsonify({"results": json_results(results)})
+        return response, 200
+    
+    except Exception as e:
+        logger.error(f"Error searching similar documents: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    """Search many queries at once, streaming one NDJSON line of results per query
+
+    The body holds "queries" (strings, or objects with a "query" and their own
+    search options) and default search options for all of them. With X-Timing,
+    a last {"timing": ...} line holds the stage breakdown.
+    """
+    try:
+        data = request.json
+        if not data or not isinstance(data.get('queries'), list):
+            return jsonify({"error": "queries must be a list"}), 400
+        
+        try:
+            defaults = search_options(data)
+            queries = []
+            for query in data['queries']:
+                if isinstance(query, str):
+                    queries.append(query)
+                elif isinstance(query, dict) and isinstance(query.get('query'), str):
+                    queries.append(dict(search_options({**data, **query}), query=query['query']))
+                else:
+                    raise ValueError("Each query must be a string or an object with a 'query' string")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # The X-Timing header is sent before the results are computed, so the breakdown is the last line instead
+        timing = bool(request.headers.get('X-Timing') or request.args.get('timing'))
         
-        # Convert NumPy float32 to native Python float to make it JSON serializable
-        for result in results:
-            if 'similarity' in result and isinstance(result['similarity'], np.float32):
-                result['similarity'] = float(result['similarity'])
+        def generate():
+            start = time.perf_counter()
+            with metrics.collect_stages({}) as stages:
+                try:
+                    for position, results in enumerate(retriever.search_many(queries, **defaults)):
+                        yield json.dumps({"index": position, "results": json_results(results)}) + '\n'
+                except Exception as e:
+                    # Headers are already sent; report the failure as the last line
+                    logger.error(f"Error in batch search: {str(e)}")
+                    yield json.dumps({"error": str(e)}) + '\n'
+            if timing:
+                yield json.dumps({"timing": metrics.format_timing(stages, time.perf_counter() - start)}) + '\n'
         
-        return jsonify({"results": results}), 200
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
     
     except Exception as e:
-        logger.error(f"Error searching similar documents: {str(e)}")
+        logger.error(f"Error in batch search: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the progress of a background ingestion job"""
+    try:
+        job = job_queue.get_status(job_id)
+        if job is None:
+            return jsonify({"error": f"Job {job_id} not found"}), 404
+        return jsonify(job), 200
+    
+    except Exception as e:
+        logger.error(f"Error getting job status: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    """Hit, miss and eviction counters of the query-embedding and search-result caches"""
+    return jsonify(retriever.cache_stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Stage timing histograms and request counters in the Prometheus text format"""
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for the API"""
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness endpoint: 200 once the model and the search index are loaded, 503 until then"""
+    start_warmup()
+    ready = embeder.loaded and warmup_state['index_loaded']
+    body = {
+        "ready": ready,
+        "model_loaded": embeder.loaded,
+        "index_loaded": warmup_state['index_loaded'],
+        "warmup_seconds": warmup_state['seconds']
+    }
+    if warmup_state['error']:
+        body['error'] = warmup_state['error']
+    return jsonify(body), 200 if ready else 503
+
 @app.route('/api', methods=['GET'])
 def api_info():
     """Show API information (renamed from previous index route)"""
@@ -188,8 +450,13 @@ def api_info():
             {"path": "/upload", "method": "POST", "description": "Upload and process a document"},
             {"path": "/process_directory", "method": "POST", "description": "Process all documents in a directory"},
             {"path": "/search", "method": "POST", "description": "Find documents similar to a query"},
-            {"path": "/documents", "method": "GET", "description": "List all documents in the database"},
-            {"path": "/health", "method": "GET", "description": "Health check endpoint"}
+            {"path": "/search/batch", "method": "POST", "description": "Search many queries, streaming NDJSON results"},
+            {"path": "/jobs/<id>", "method": "GET", "description": "Progress of an upload or directory job"},
+            {"path": "/documents", "method": "GET", "description": "List documents a page at a time (limit, after_id, extension, path_prefix, created_after, created_before, min_size, max_size; format=ndjson streams them all)"},
+            {"path": "/cache", "method": "GET", "description": "Query and result cache counters"},
+            {"path": "/metrics", "method": "GET", "description": "Stage timings and request counters (Prometheus)"},
+            {"path": "/health", "method": "GET", "description": "Health check endpoint"},
+            {"path": "/ready", "method": "GET", "description": "Readiness check: 200 once the model and search index are loaded"}
         ]
     }), 200
 
@@ -213,30 +480,23 @@ def delete_document(document_id):
 def preview_document(document_id):
     """Get the preview of a document content"""
     try:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
-        # Get document content
-        cursor.execute("SELECT file_path, document_text FROM documents WHERE id = ?", (document_id,))
-        result = cursor.fetchone()
-        conn.close()
+        # Only the preview is read from the database, along with the total length
+        max_preview_length = 5000
+        result = db.get_document_preview(document_id, max_preview_length)
         
         if not result:
             return jsonify({"error": f"Document {document_id} not found"}), 404
             
-        file_path, document_text = result
-        
-        # For very large documents, limit preview size
-        max_preview_length = 5000
-        preview = document_text[:max_preview_length]
-        truncated = len(document_text) > max_preview_length
+        file_path, preview, total_length = result
+        preview, total_length = preview or '', total_length or 0
+        truncated = total_length > max_preview_length
         
         return jsonify({
             "id": document_id,
             "file_path": file_path,
             "preview": preview,
             "truncated": truncated,
-            "total_length": len(document_text)
+            "total_length": total_length
         }), 200
     
     except Exception as e:
@@ -247,18 +507,11 @@ def preview_document(document_id):
 def download_document(document_id):
     """Download the original document file"""
     try:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
         # Get document file path
-        cursor.execute("SELECT file_path FROM documents WHERE id = ?", (document_id,))
-        result = cursor.fetchone()
-        conn.close()
+        file_path = db.get_document_path(document_id)
         
-        if not result:
+        if file_path is None:
             return jsonify({"error": f"Document {document_id} not found"}), 404
-            
-        file_path = result[0]
         
         # Check if the file exists
         if not os.path.exists(file_path):
@@ -279,5 +532,9 @@ if __name__ == '__main__':
     # Make sure the uploads directory exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
+    # Load the model while the server starts, in the reloader's child process only
+    if WARMUP and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_warmup()
+    
     # Run the Flask app
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
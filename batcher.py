@@ -0,0 +1,104 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from metrics import record, current_stages, collect_stages, QUERY_BATCHES
+
+# Most queries embedded by one coalesced forward pass; 0 disables coalescing
+QUERY_BATCH_MAX_SIZE = int(os.environ.get('QUERY_BATCH_MAX_SIZE', 32))
+
+# How long the first query of a batch waits for others to join it, in milliseconds
+QUERY_BATCH_WAIT_MS = float(os.environ.get('QUERY_BATCH_WAIT_MS', 1))
+
+class QueryBatcher:
+    """Coalesces concurrent query embeddings into shared forward passes
+
+    Callers enqueue their texts and block on futures. A background thread
+    takes the first waiting text, collects more until max_batch_size texts
+    or max_wait seconds, embeds them with one padded forward pass and
+    resolves each caller's future with its vector. While a pass runs, new
+    queries queue up and go into the next one, so the batches grow with
+    the load. The stages timed during a pass (tokenize, forward) are added
+    to the X-Timing breakdown of every request waiting on it.
+    """
+
+    def __init__(self, embeder, max_batch_size=QUERY_BATCH_MAX_SIZE, max_wait=QUERY_BATCH_WAIT_MS / 1000):
+        self.embeder = embeder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_batch_size > 0
+
+    def _ensure_started(self):
+        # Threads don't survive fork, so a forked server process starts its own
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._worker, name="query-batcher", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def submit(self, text):
+        """Future resolved with the embedding of text"""
+        future = Future()
+        if not self.enabled:
+            try:
+                future.set_result(self.embeder.generate_embeddings([text])[0])
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._ensure_started()
+        self._queue.put((text, future, current_stages()))
+        return future
+
+    def embed_many(self, texts):
+        """Embeddings of texts, computed together with those of any concurrent callers"""
+        if not texts:
+            return []
+        start = time.perf_counter()
+        futures = [self.submit(text) for text in texts]
+        embeddings = [future.result() for future in futures]
+        record('query_embedding', time.perf_counter() - start)
+        return embeddings
+
+    def _collect(self):
+        """Block for the next query, then gather more until the batch is full or the wait is over"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            # Identical concurrent queries share one row of the batch
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            QUERY_BATCHES.observe(len(texts))
+            stages = {}
+            try:
+                with collect_stages(stages):
+                    embeddings = dict(zip(texts, self.embeder.generate_embeddings(texts)))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for text, future, caller_stages in batch:
+                # Written before the future resolves, while the caller is still waiting on it
+                if caller_stages is not None:
+                    for stage, seconds in stages.items():
+                        caller_stages[stage] = caller_stages.get(stage, 0.0) + seconds
+                future.set_result(embeddings[text])
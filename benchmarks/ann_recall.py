@@ -0,0 +1,79 @@
+"""Compare IVF approximate search against exact search: recall@k versus queries per second.
+
+Uses a synthetic clustered corpus, so no database or model is needed:
+
+    python -m benchmarks.ann_recall --vectors 200000 --dimension 768
+"""
+import argparse
+import time
+
+import numpy as np
+
+from vector_index import VectorIndex
+
+class SyntheticStore:
+    """Just enough of the Database interface for VectorIndex"""
+
+    def __init__(self, num_vectors, dimension, chunks_per_document, seed=0):
+        rng = np.random.default_rng(seed)
+        centers = rng.standard_normal((max(1, num_vectors // 200), dimension)).astype(np.float32)
+        labels = rng.integers(len(centers), size=num_vectors)
+        self.vectors = centers[labels] + 0.6 * rng.standard_normal((num_vectors, dimension)).astype(np.float32)
+        self.chunks_per_document = chunks_per_document
+        self.db_path = None
+
+    def add_listener(self, listener):
+        pass
+
+    def get_vector_version(self):
+        return 0
+
+    def get_all_chunk_vectors(self, document_ids=None):
+        if document_ids is None:
+            rows = range(len(self.vectors))
+        else:
+            rows = [(document_id - 1) * self.chunks_per_document + ordinal
+                    for document_id in sorted(document_ids) for ordinal in range(self.chunks_per_document)]
+        return [(row // self.chunks_per_document + 1, f"/synthetic/{row // self.chunks_per_document}.txt",
+                 row % self.chunks_per_document, 0, 150, self.vectors[row].tobytes(), 'float32')
+                for row in rows if row < len(self.vectors)]
+
+def timed_search(index, queries, top_k, **kwargs):
+    """Run every query; return the result document IDs and the queries per second"""
+    start = time.perf_counter()
+    results = [[hit[0] for hit in index.search(query, top_k=top_k, min_similarity=-1, **kwargs)]
+               for query in queries]
+    return results, len(queries) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=200000, help='Chunk vectors in the corpus')
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--chunks-per-document', type=int, default=4)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    store = SyntheticStore(args.vectors, args.dimension, args.chunks_per_document)
+    rng = np.random.default_rng(1)
+    picks = rng.integers(args.vectors, size=args.queries)
+    queries = store.vectors[picks] + 0.3 * rng.standard_normal((args.queries, args.dimension)).astype(np.float32)
+
+    start = time.perf_counter()
+    index = VectorIndex(store, ann='ivf', ann_min_vectors=0)
+    index.reload()
+    print(f"Loaded {index.num_vectors} vectors and trained {index._ivf.nlist} IVF lists "
+          f"in {time.perf_counter() - start:.1f} s")
+
+    exact, exact_qps = timed_search(index, queries, args.top_k, exact=True)
+    print(f"{'exact':>12}: recall@{args.top_k}=1.000  {exact_qps:9.1f} QPS")
+
+    for nprobe in args.nprobe:
+        approximate, qps = timed_search(index, queries, args.top_k, nprobe=nprobe)
+        recall = np.mean([len(set(a) & set(e)) / max(len(e), 1) for a, e in zip(approximate, exact)])
+        print(f"{'nprobe=' + str(nprobe):>12}: recall@{args.top_k}={recall:.3f}  {qps:9.1f} QPS  "
+              f"({qps / exact_qps:.1f}x)")
+
+if __name__ == '__main__':
+    main()
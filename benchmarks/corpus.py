@@ -0,0 +1,181 @@
+"""Generate a deterministic synthetic corpus of txt, md, docx and pdf files.
+
+The same seed and index always give the same text, so runs at a scale are
+comparable and an interrupted or smaller corpus can be extended in place:
+
+    python -m benchmarks.corpus /tmp/corpus-1k --scale 1k --formats txt md docx pdf
+
+Words are drawn from a synthetic vocabulary with a Zipf distribution, so
+lexical search sees realistic term frequencies. Files are spread over
+subdirectories of FILES_PER_DIRECTORY files each.
+"""
+import argparse
+import datetime
+import math
+import os
+import random
+import time
+
+SCALES = {'1k': 1000, '100k': 100000, '1M': 1000000}
+FORMATS = ('txt', 'md', 'docx', 'pdf')
+
+VOCABULARY_SIZE = 20000
+FILES_PER_DIRECTORY = 1000
+
+# Document lengths in words: log-normal around MEDIAN_WORDS, capped at MAX_WORDS
+MEDIAN_WORDS = 300
+MAX_WORDS = 5000
+
+SYLLABLES = ("ka lo mi ne ru sa te vo pi da el on ar is um ex ta ro ni be "
+             "qu zo fa ly ge ho ju ce wi xa").split()
+
+_vocabularies = {}
+
+def vocabulary(seed=0):
+    """VOCABULARY_SIZE distinct pseudo-words and their cumulative Zipf weights"""
+    if seed not in _vocabularies:
+        rng = random.Random(f"vocabulary-{seed}")
+        words = []
+        seen = set()
+        while len(words) < VOCABULARY_SIZE:
+            word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        cumulative, total = [], 0.0
+        for rank in range(1, VOCABULARY_SIZE + 1):
+            total += 1.0 / rank
+            cumulative.append(total)
+        _vocabularies[seed] = (words, cumulative)
+    return _vocabularies[seed]
+
+def document_text(index, seed=0):
+    """(title, paragraphs) of document number index"""
+    words, cumulative = vocabulary(seed)
+    rng = random.Random(f"document-{seed}-{index}")
+    num_words = min(MAX_WORDS, max(20, int(rng.lognormvariate(math.log(MEDIAN_WORDS), 0.8))))
+    body = rng.choices(words, cum_weights=cumulative, k=num_words)
+    title = ' '.join(rng.choices(words[100:2000], k=4)).capitalize()
+
+    paragraphs, start = [], 0
+    while start < num_words:
+        length = rng.randint(40, 120)
+        sentence = ' '.join(body[start:start + length])
+        paragraphs.append(sentence[:1].upper() + sentence[1:] + '.')
+        start += length
+    return title, paragraphs
+
+def sample_queries(count, seed=0):
+    """Distinct queries of 2-4 mid-frequency words"""
+    words, _ = vocabulary(seed)
+    rng = random.Random(f"queries-{seed}")
+    queries = []
+    seen = set()
+    while len(queries) < count:
+        query = ' '.join(rng.choices(words[50:5000], k=rng.randint(2, 4)))
+        if query not in seen:
+            seen.add(query)
+            queries.append(query)
+    return queries
+
+def corpus_path(directory, index, file_format):
+    return os.path.join(directory, f"{index // FILES_PER_DIRECTORY:04d}", f"doc-{index:07d}.{file_format}")
+
+def _write_txt(path, title, paragraphs):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(title + '\n\n' + '\n\n'.join(paragraphs) + '\n')
+
+def _write_md(path, title, paragraphs):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"# {title}\n\n" + '\n\n'.join(paragraphs) + '\n')
+
+def _write_docx(path, title, paragraphs):
+    import docx
+
+    document = docx.Document()
+    document.add_heading(title, level=1)
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    # Fixed metadata, so the extracted properties don't depend on the run
+    document.core_properties.created = document.core_properties.modified = datetime.datetime(2000, 1, 1)
+    document.save(path)
+
+def _pdf_escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def _write_pdf(path, title, paragraphs, line_width=90, lines_per_page=60):
+    """Minimal PDF 1.4 with the text in Helvetica, one content stream per page"""
+    lines = [title, '']
+    for paragraph in paragraphs:
+        words, line = paragraph.split(), ''
+        for word in words:
+            if line and len(line) + 1 + len(word) > line_width:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.extend([line, ''])
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)]
+
+    # Objects: 1 catalog, 2 page tree, 3 font, then a page and its content stream per page
+    objects = {1: "<< /Type /Catalog /Pages 2 0 R >>", 3: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"}
+    kids = []
+    for number, page_lines in enumerate(pages):
+        page_id, content_id = 4 + 2 * number, 5 + 2 * number
+        kids.append(f"{page_id} 0 R")
+        stream = "BT /F1 10 Tf 12 TL 50 800 Td\n" + '\n'.join(
+            f"({_pdf_escape(line)}) Tj T*" for line in page_lines) + "\nET"
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>")
+        objects[content_id] = f"<< /Length {len(stream.encode('latin-1'))} >>\nstream\n{stream}\nendstream"
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(output)
+        output += f"{object_id} 0 obj\n{objects[object_id]}\nendobj\n".encode('latin-1')
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('latin-1')
+    for object_id in sorted(objects):
+        output += f"{offsets[object_id]:010d} 00000 n \n".encode('latin-1')
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode('latin-1')
+    with open(path, 'wb') as f:
+        f.write(output)
+
+WRITERS = {'txt': _write_txt, 'md': _write_md, 'docx': _write_docx, 'pdf': _write_pdf}
+
+def write_corpus(directory, num_documents, formats=FORMATS, seed=0, overwrite=False):
+    """Write documents 0..num_documents-1, cycling through formats; existing files are kept
+
+    Returns:
+        list: The paths of all num_documents files
+    """
+    paths = []
+    for index in range(num_documents):
+        file_format = formats[index % len(formats)]
+        path = corpus_path(directory, index, file_format)
+        paths.append(path)
+        if not overwrite and os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        WRITERS[file_format](path, *document_text(index, seed))
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--scale', choices=SCALES, default='1k')
+    parser.add_argument('--documents', type=int, help='Number of documents (overrides --scale)')
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--overwrite', action='store_true', help='Rewrite files that already exist')
+    args = parser.parse_args()
+
+    num_documents = args.documents or SCALES[args.scale]
+    start = time.perf_counter()
+    write_corpus(args.directory, num_documents, args.formats, args.seed, args.overwrite)
+    print(f"{num_documents} documents in {args.directory} ({time.perf_counter() - start:.1f} s)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Measure embedding throughput (docs/sec) for different batch sizes.
+
+Uses deterministic synthetic texts of mixed lengths so runs are comparable:
+
+    python -m benchmarks.embedding_throughput --docs 256 --batch-sizes 1 8 16 32 64
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from embeder import get_embedder
+
+WORDS = ("retrieval embedding document search vector index query passage model "
+         "token batch latency throughput database chunk similarity cosine").split()
+
+def synthetic_texts(count, seed=0):
+    """Texts between 20 and 400 words, shuffled so lengths are interleaved"""
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 400))) for _ in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--docs', type=int, default=256, help='Number of synthetic documents')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    embeder = get_embedder()
+    texts = synthetic_texts(args.docs)
+    embeder.generate_embeddings(texts[:8], batch_size=8)  # warm up
+
+    print(f"{args.docs} documents, torch threads={torch.get_num_threads()}")
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        embeder.generate_embeddings(texts, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"batch_size={batch_size:>4}: {args.docs / elapsed:8.1f} docs/sec ({elapsed:.2f} s)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Compare inference backends: query latency, batch throughput and embedding drift against eager float32.
+
+Loads the configured model once per backend and embeds the same synthetic texts:
+
+    python -m benchmarks.inference_backends --docs 256 --queries 50 --threads 4
+
+Drift is the cosine distance between each text's embedding and its eager
+float32 embedding (0 means identical). Backends whose runtime is not
+installed are reported as unavailable.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.embedding_throughput import synthetic_texts
+from embeder import DocumentEmbedder, DEFAULT_MODEL_NAME, INFERENCE_BACKENDS, configure_threads
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default=DEFAULT_MODEL_NAME)
+    parser.add_argument('--backends', nargs='+', default=list(INFERENCE_BACKENDS), choices=INFERENCE_BACKENDS)
+    parser.add_argument('--docs', type=int, default=256, help='Synthetic documents embedded for throughput')
+    parser.add_argument('--queries', type=int, default=50, help='Single-text embeddings timed for latency')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=0, help='Torch intra-op threads (0 keeps the default)')
+    args = parser.parse_args()
+
+    configure_threads(args.threads)
+    texts = synthetic_texts(args.docs)
+    queries = [' '.join(text.split()[:12]) for text in synthetic_texts(args.queries, seed=1)]
+
+    reference = None
+    print(f"{'backend':>12} {'p50 ms':>8} {'p95 ms':>8} {'docs/sec':>9} {'mean drift':>11} {'max drift':>10}")
+    for name in ['eager'] + [name for name in args.backends if name != 'eager']:
+        embedder = DocumentEmbedder(args.model, backend=name)
+        if embedder.backend.name != name:
+            print(f"{name:>12} unavailable")
+            continue
+        embedder.generate_embeddings(texts[:8], batch_size=8)  # warm up
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            embedder.generate_embedding(query)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        embeddings = embedder.generate_embeddings(texts, batch_size=args.batch_size)
+        throughput = len(texts) / (time.perf_counter() - start)
+
+        if reference is None:
+            reference = embeddings
+        drift = 1 - np.sum(embeddings * reference, axis=1)
+        if name in args.backends:
+            print(f"{name:>12} {np.percentile(latencies, 50) * 1000:8.2f} {np.percentile(latencies, 95) * 1000:8.2f} "
+                  f"{throughput:9.1f} {drift.mean():11.2e} {drift.max():10.2e}")
+
+if __name__ == '__main__':
+    main()
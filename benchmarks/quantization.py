@@ -0,0 +1,51 @@
+"""Compare resident index codecs: memory saved and recall@k lost against float32.
+
+Uses the synthetic clustered corpus of benchmarks.ann_recall:
+
+    python -m benchmarks.quantization --vectors 100000 --dimension 768
+
+"approximate" ranks documents by their compressed codes alone; "rescored"
+re-ranks the best candidates with their stored float32 vectors, as /search does.
+"""
+import argparse
+
+import numpy as np
+
+from benchmarks.ann_recall import SyntheticStore, timed_search
+from quantization import INDEX_CODECS
+from vector_index import VectorIndex, RESCORE_FACTOR
+
+def recall(results, expected):
+    return np.mean([len(set(r) & set(e)) / max(len(e), 1) for r, e in zip(results, expected)])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=100000, help='Chunk vectors in the corpus')
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--chunks-per-document', type=int, default=4)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    store = SyntheticStore(args.vectors, args.dimension, args.chunks_per_document)
+    rng = np.random.default_rng(1)
+    picks = rng.integers(args.vectors, size=args.queries)
+    queries = store.vectors[picks] + 0.3 * rng.standard_normal((args.queries, args.dimension)).astype(np.float32)
+
+    reference = VectorIndex(store, ann='off', codec='float32')
+    expected, _ = timed_search(reference, queries, args.top_k)
+
+    print(f"{'codec':>8} {'MB':>9} {'saved':>7} {'approx recall':>14} {'rescored recall':>16} {'QPS':>9}")
+    for codec in INDEX_CODECS:
+        index = VectorIndex(store, ann='off', codec=codec, rescore_factor=1)
+        index.reload()
+        usage = index.memory_usage()
+        # With one candidate per result, rescoring can only reorder the approximate top-k
+        approximate, _ = timed_search(index, queries, args.top_k)
+        index.rescore_factor = RESCORE_FACTOR
+        rescored, qps = timed_search(index, queries, args.top_k)
+        print(f"{codec:>8} {usage['bytes'] / 2**20:9.1f} {usage['saved_bytes'] / max(usage['float32_bytes'], 1):7.1%} "
+              f"{recall(approximate, expected):14.3f} {recall(rescored, expected):16.3f} {qps:9.1f}")
+
+if __name__ == '__main__':
+    main()
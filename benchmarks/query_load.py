@@ -0,0 +1,99 @@
+"""Load-test query embedding: throughput and tail latency at increasing client concurrency.
+
+By default, compares one forward pass per query ("direct") with the query
+coalescer ("coalesced") in this process, using the configured model:
+
+    python -m benchmarks.query_load --clients 1 8 64 --queries-per-client 20
+
+With --url, the clients send searches to a running server instead:
+
+    python -m benchmarks.query_load --url http://localhost:5000
+
+Every query text is distinct, so the query and result caches never answer.
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+from benchmarks.embedding_throughput import WORDS
+
+def query_texts(client, count):
+    """Short queries unique to one client and run"""
+    rng = np.random.default_rng(client)
+    return [' '.join(rng.choice(WORDS, size=6)) + f" {client}-{i}-{time.time_ns()}" for i in range(count)]
+
+def run_clients(call, clients, queries_per_client):
+    """Run clients threads that each call() their queries back to back
+
+    Returns:
+        tuple: (queries per second, per-query latencies in seconds)
+    """
+    latencies = [[] for _ in range(clients)]
+    texts = [query_texts(client, queries_per_client) for client in range(clients)]
+    barrier = threading.Barrier(clients + 1)
+
+    def client_loop(client):
+        barrier.wait()
+        for text in texts[client]:
+            start = time.perf_counter()
+            call(text)
+            latencies[client].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client_loop, args=(client,)) for client in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return clients * queries_per_client / elapsed, np.concatenate(latencies)
+
+def http_search(url):
+    def call(text):
+        request = urllib.request.Request(f"{url.rstrip('/')}/search", data=json.dumps({'query': text}).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            response.read()
+    return call
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--queries-per-client', type=int, default=20)
+    parser.add_argument('--url', help='Search a running server instead of embedding in this process')
+    parser.add_argument('--max-batch-size', type=int, default=None, help='Coalescer batch limit (default: env)')
+    parser.add_argument('--max-wait-ms', type=float, default=None, help='Coalescer wait window (default: env)')
+    args = parser.parse_args()
+
+    if args.url:
+        modes = {'server': http_search(args.url)}
+    else:
+        from batcher import QueryBatcher
+        from embeder import get_embedder
+
+        embeder = get_embedder()
+        batcher = QueryBatcher(embeder)
+        if args.max_batch_size is not None:
+            batcher.max_batch_size = args.max_batch_size
+        if args.max_wait_ms is not None:
+            batcher.max_wait = args.max_wait_ms / 1000
+        embeder.generate_embeddings(query_texts(0, 8))  # warm up
+        modes = {
+            'direct': embeder.generate_embedding,
+            'coalesced': lambda text: batcher.embed_many([text])[0]
+        }
+
+    print(f"{'mode':>10} {'clients':>8} {'QPS':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for clients in args.clients:
+        for mode, call in modes.items():
+            qps, latencies = run_clients(call, clients, args.queries_per_client)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+            print(f"{mode:>10} {clients:>8} {qps:9.1f} {p50:9.2f} {p95:9.2f} {p99:9.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Measure /search latency with a per-request embedder versus the shared one.
+
+Run from the repository root against the current document_embeddings.db:
+
+    python -m benchmarks.search_latency --requests 50
+"""
+import argparse
+import time
+
+import numpy as np
+
+import app as app_module
+from cache import LRUCache
+from embeder import DocumentEmbedder, set_embedder
+from retreiver import QUERY_CACHE_SIZE, QUERY_CACHE_TTL, RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+
+QUERIES = [
+    "how to configure the database",
+    "error handling in the upload route",
+    "semantic search over pdf documents",
+    "python function that reads a file",
+    "project license and contributors",
+]
+
+def percentile_report(label, timings):
+    """Print p50/p99/mean latency in milliseconds"""
+    timings_ms = np.array(timings) * 1000
+    print(f"{label:>8}: p50={np.percentile(timings_ms, 50):9.1f} ms  "
+          f"p99={np.percentile(timings_ms, 99):9.1f} ms  "
+          f"mean={timings_ms.mean():9.1f} ms  (n={len(timings_ms)})")
+
+def reload_embedder(retriever):
+    """Load a fresh model into retriever, as if it had never served a query
+
+    Only the embedder (and the caches it filled) is replaced; building a new
+    DocumentRetriever per request would also reload the vector index and leave
+    a listener, a save hook and a batcher thread behind for each one.
+    """
+    embedder = DocumentEmbedder()
+    set_embedder(embedder)
+    retriever.embeder = embedder
+    retriever.batcher.embeder = embedder
+    retriever.query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+    retriever.result_cache = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+def wait_until_ready(client, timeout=600):
+    """Let the app's warmup finish so no mode pays for (or races) the first model and index load"""
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get('/ready')
+        body = response.get_json()
+        if response.status_code == 200:
+            return
+        if body.get('error') or time.monotonic() > deadline:
+            raise RuntimeError(f"Warmup failed: {body}")
+        time.sleep(0.2)
+
+def run(client, num_requests, reload_model):
+    """Send num_requests searches and return the wall time of each"""
+    timings = []
+    for i in range(num_requests):
+        query = QUERIES[i % len(QUERIES)]
+        start = time.perf_counter()
+        if reload_model:
+            # Previous behaviour: every request loaded its own BERT model
+            reload_embedder(app_module.retriever)
+        response = client.post('/search', json={'query': query, 'top_k': 5})
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"/search failed: {response.get_json()}")
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50, help='Searches per mode')
+    parser.add_argument('--before-requests', type=int, default=10,
+                        help='Searches for the per-request model mode (slow)')
+    args = parser.parse_args()
+
+    retriever = app_module.retriever
+    shared_embedder = retriever.embeder
+    client = app_module.app.test_client()
+    wait_until_ready(client)
+
+    before = run(client, args.before_requests, reload_model=True)
+
+    set_embedder(shared_embedder)
+    retriever.embeder = shared_embedder
+    retriever.batcher.embeder = shared_embedder
+    run(client, 3, reload_model=False)  # warm up
+    after = run(client, args.requests, reload_model=False)
+
+    percentile_report('before', before)
+    percentile_report('after', after)
+
+if __name__ == '__main__':
+    main()
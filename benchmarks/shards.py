@@ -0,0 +1,108 @@
+"""Measure exact-search QPS and latency with the index split over 1 to N shard processes.
+
+Uses a synthetic memory-mapped store in a temporary directory, so no database
+or model is needed:
+
+    python -m benchmarks.shards --vectors 1000000 --dimension 384 --shards 1 2 4 8
+
+One shard scores in process as without SEARCH_SHARDS. Latency is measured
+with sequential searches and throughput with --clients threads searching
+at once; every sharded run is checked against the single-process results.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from vector_index import VectorIndex
+
+class SyntheticStore:
+    """Just enough of the Database interface for a VectorIndex with vector_store='mmap'"""
+
+    def __init__(self, directory, num_vectors, dimension, chunks_per_document, seed=0):
+        rng = np.random.default_rng(seed)
+        self.vectors = rng.standard_normal((num_vectors, dimension)).astype(np.float32)
+        self.chunks_per_document = chunks_per_document
+        self.db_path = os.path.join(directory, 'synthetic.db')
+
+    def add_listener(self, listener):
+        pass
+
+    def get_vector_version(self):
+        return 0
+
+    def get_all_chunk_vectors(self, document_ids=None):
+        rows = range(len(self.vectors)) if document_ids is None else [
+            (document_id - 1) * self.chunks_per_document + ordinal
+            for document_id in sorted(document_ids) for ordinal in range(self.chunks_per_document)]
+        return [(row // self.chunks_per_document + 1, f"/synthetic/{row // self.chunks_per_document}.txt",
+                 row % self.chunks_per_document, 0, 150, self.vectors[row].tobytes(), 'float32')
+                for row in rows if row < len(self.vectors)]
+
+def run_queries(index, queries, top_k):
+    """Search every query in turn; return the results and the latency of each"""
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.search(query, top_k=top_k, min_similarity=-1))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+def concurrent_qps(index, queries, top_k, clients):
+    """Queries per second with clients threads splitting the queries"""
+    threads = [threading.Thread(target=run_queries, args=(index, queries[number::clients], top_k))
+               for number in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(queries) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=200000, help='Chunk vectors in the corpus')
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--chunks-per-document', type=int, default=4)
+    parser.add_argument('--codec', default='float32', choices=['float32', 'float16', 'int8'])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=4, help='Threads searching at once for the QPS run')
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='ragfus-shards-') as directory:
+        store = SyntheticStore(directory, args.vectors, args.dimension, args.chunks_per_document)
+        queries = np.random.default_rng(1).standard_normal((args.queries, args.dimension)).astype(np.float32)
+
+        start = time.perf_counter()
+        VectorIndex(store, ann='off', codec=args.codec, vector_store='mmap').reload()
+        print(f"Wrote {args.vectors} vectors in {time.perf_counter() - start:.1f} s")
+
+        expected = None
+        print(f"{'shards':>6} {'p50 ms':>9} {'p95 ms':>9} {'QPS':>9} {'QPS x' + str(args.clients):>9} {'speedup':>8}")
+        for num_shards in sorted(set(args.shards)):
+            index = VectorIndex(store, ann='off', codec=args.codec, vector_store='mmap',
+                                shards=num_shards, shard_min_vectors=0)
+            run_queries(index, queries[:5], args.top_k)  # warm up: map the store, start the shard processes
+
+            start = time.perf_counter()
+            results, latencies = run_queries(index, queries, args.top_k)
+            qps = len(queries) / (time.perf_counter() - start)
+            parallel_qps = concurrent_qps(index, queries, args.top_k, args.clients)
+            if expected is None:
+                expected, baseline_qps = results, qps
+            elif [[hit[0] for hit in hits] for hits in results] != [[hit[0] for hit in hits] for hits in expected]:
+                print(f"Warning: the results with {num_shards} shards differ from a single process")
+
+            latencies_ms = np.array(latencies) * 1000
+            print(f"{num_shards:>6} {np.percentile(latencies_ms, 50):9.2f} {np.percentile(latencies_ms, 95):9.2f} "
+                  f"{qps:9.1f} {parallel_qps:9.1f} {qps / baseline_qps:7.2f}x")
+            if index._shards is not None:
+                index._shards.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Measure startup cost: module import times and the time to the first search.
+
+Every measurement runs in a fresh interpreter in an empty working directory
+(so a new, empty database), with the configured model:
+
+    python -m benchmarks.startup --runs 5
+
+"first search" imports app and sends one /search through the test client,
+which loads the model and the index on the spot; "ready" instead polls
+/ready until the background warmup has loaded both.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['database', 'clear_db', 'rebuild_embeddings', 'embeder', 'retreiver', 'app']
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'import': time.perf_counter() - start,
+                  'torch': 'torch' in sys.modules, 'transformers': 'transformers' in sys.modules}}))
+"""
+
+FIRST_SEARCH_SCRIPT = """
+import time, json
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+client.post('/search', json={'query': 'startup benchmark'})
+first = time.perf_counter()
+client.post('/search', json={'query': 'another startup benchmark'})
+print(json.dumps({'import': imported - start, 'first': first - imported, 'second': time.perf_counter() - first}))
+"""
+
+READY_SCRIPT = """
+import time, json
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+while client.get('/ready').status_code != 200:
+    time.sleep(0.01)
+ready = time.perf_counter()
+client.post('/search', json={'query': 'startup benchmark'})
+print(json.dumps({'import': imported - start, 'ready': ready - imported, 'first': time.perf_counter() - ready}))
+"""
+
+def run(script):
+    """Run script in a fresh interpreter and working directory; return the JSON it prints last"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    with tempfile.TemporaryDirectory() as directory:
+        output = subprocess.run([sys.executable, '-c', script], cwd=directory, env=env,
+                                capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def median(runs, key):
+    return np.median([run[key] for run in runs]) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per measurement')
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    args = parser.parse_args()
+
+    print(f"{'import':>20} {'median ms':>10}  heavy modules loaded")
+    for module in args.modules:
+        runs = [run(IMPORT_SCRIPT.format(module=module)) for _ in range(args.runs)]
+        heavy = [name for name in ('torch', 'transformers') if runs[-1][name]]
+        print(f"{module:>20} {median(runs, 'import'):10.1f}  {', '.join(heavy) or '-'}")
+
+    runs = [run(FIRST_SEARCH_SCRIPT) for _ in range(args.runs)]
+    print(f"\nLazy start: import app {median(runs, 'import'):.0f} ms, first search {median(runs, 'first'):.0f} ms, "
+          f"second search {median(runs, 'second'):.0f} ms")
+    runs = [run(READY_SCRIPT) for _ in range(args.runs)]
+    print(f"Warmup: import app {median(runs, 'import'):.0f} ms, ready after {median(runs, 'ready'):.0f} ms, "
+          f"first search {median(runs, 'first'):.0f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Deterministic stand-in for DocumentEmbedder that needs no model weights.
+
+Chunks are windows of regex word tokens and embeddings are feature-hashed
+bags of words, so texts sharing words get similar vectors and search
+results stay meaningful. Everything downstream of the model (chunk spans,
+storage, indexing, search) runs the real code:
+
+    from benchmarks.stub_embedder import install_stub_embedder
+    install_stub_embedder()  # before importing app or jobs
+"""
+import re
+import zlib
+
+import numpy as np
+
+from embeder import DocumentEmbedder, set_embedder
+
+WORD_PATTERN = re.compile(r'\w+')
+
+class _StubBackend:
+    name = 'stub'
+    model = None
+    device = 'cpu'
+
+class StubEmbedder(DocumentEmbedder):
+    """DocumentEmbedder with the tokenizer and model replaced by word hashing"""
+
+    def __init__(self, dimension=768, model_name='stub', **kwargs):
+        super().__init__(model_name=model_name, **kwargs)
+        self.dimension = dimension
+        self._buckets = {}  # word -> (dimension index, sign)
+
+    def _load(self):
+        self._tokenizer = None
+        self._hidden_size = self.dimension
+        self._backend = _StubBackend()
+
+    def _bucket(self, word):
+        bucket = self._buckets.get(word)
+        if bucket is None:
+            digest = zlib.crc32(word.encode('utf-8'))
+            bucket = self._buckets[word] = (digest % self.dimension, 1.0 if digest & (1 << 31) else -1.0)
+        return bucket
+
+    def generate_embeddings(self, texts, batch_size=None):
+        """Unit-length feature-hashed bags of lowercased words, (len(texts), dimension) float32"""
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = WORD_PATTERN.findall(text.lower())
+            if not words:
+                # Still a valid direction, so empty texts normalize cleanly
+                words = [text]
+            indices, signs = zip(*(self._bucket(word) for word in words))
+            np.add.at(embeddings[row], list(indices), signs)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+
+    def chunk_texts(self, texts):
+        """Windows of chunk_size word tokens, overlapping by chunk_overlap"""
+        return [self._chunk_spans([match.span() for match in WORD_PATTERN.finditer(text)], len(text))
+                for text in texts]
+
+def install_stub_embedder(dimension=768):
+    """Make get_embedder() return a StubEmbedder; call before importing app or jobs"""
+    embedder = StubEmbedder(dimension)
+    set_embedder(embedder)
+    return embedder
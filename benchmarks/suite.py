@@ -0,0 +1,271 @@
+"""Run the ingestion and search benchmark scenarios on a synthetic corpus with the stub embedder.
+
+Each run uses a fresh working directory (database, uploads) and a corpus from
+benchmarks.corpus, which is generated once and reused if --corpus-dir exists:
+
+    python -m benchmarks.suite --scale 1k --output results.json
+    python -m benchmarks.suite --scale 1k --baseline results.json --tolerance 0.15
+
+Scenarios: ingest (process_directory), reingest (the same, unchanged tree),
+rebuild (rebuild_all_embeddings, bypassing the embedding cache), search and
+concurrent_search (/search through Flask's test client) and delete_churn
+(deleting and re-ingesting documents between searches). With --baseline, every timing metric is
+compared against the saved run and the exit status is 1 if any got worse
+by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.corpus import SCALES, FORMATS, write_corpus, sample_queries
+from benchmarks.stub_embedder import install_stub_embedder
+
+SCENARIOS = ('ingest', 'reingest', 'rebuild', 'search', 'concurrent_search', 'delete_churn')
+
+def metric_direction(name):
+    """1 if higher is better, -1 if lower is better, None for counts that aren't compared"""
+    if name.endswith('_per_sec') or name == 'qps':
+        return 1
+    if name.endswith('_ms') or name == 'seconds':
+        return -1
+    return None
+
+def latency_metrics(latencies, elapsed):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'qps': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99))
+    }
+
+def search(client, query, top_k=10):
+    response = client.post('/search', json={'query': query, 'top_k': top_k})
+    if response.status_code != 200:
+        raise RuntimeError(f"/search failed: {response.get_json()}")
+
+class Suite:
+    """The scenarios, sharing one app, database and corpus"""
+
+    def __init__(self, app_module, corpus_dir, num_files, queries, clients, churn):
+        self.app = app_module.app
+        self.db = app_module.db
+        self.embedder = app_module.embeder
+        self.corpus_dir = corpus_dir
+        self.num_files = num_files
+        self.queries = queries
+        self.clients = clients
+        self.churn = churn
+        self._next_query = 0
+
+    def _take_queries(self, count):
+        """Queries not searched before, so the caches never answer"""
+        queries = self.queries[self._next_query:self._next_query + count]
+        self._next_query += count
+        return queries
+
+    def ingest(self):
+        start = time.perf_counter()
+        processed, failed = self.embedder.process_directory(self.corpus_dir, incremental=False)
+        seconds = time.perf_counter() - start
+        return {'documents': processed, 'failed': failed, 'seconds': seconds, 'docs_per_sec': processed / seconds}
+
+    def reingest(self):
+        start = time.perf_counter()
+        self.embedder.process_directory(self.corpus_dir, incremental=True)
+        seconds = time.perf_counter() - start
+        return {'files': self.num_files, 'seconds': seconds, 'files_per_sec': self.num_files / seconds}
+
+    def rebuild(self):
+        from rebuild_embeddings import rebuild_all_embeddings
+
+        documents = len(self.db.list_documents())
+        # Re-embed for real, as rebuild_embeddings.py --no-cache does: the corpus was just embedded into the cache
+        cache, self.embedder.cache = self.embedder.cache, None
+        try:
+            start = time.perf_counter()
+            rebuild_all_embeddings()
+            seconds = time.perf_counter() - start
+        finally:
+            self.embedder.cache = cache
+        return {'documents': documents, 'seconds': seconds, 'docs_per_sec': documents / seconds}
+
+    def search(self, count=200):
+        client = self.app.test_client()
+        for query in self._take_queries(5):
+            search(client, query)  # warm up: index load, first requests
+
+        latencies = []
+        start = time.perf_counter()
+        for query in self._take_queries(count):
+            query_start = time.perf_counter()
+            search(client, query)
+            latencies.append(time.perf_counter() - query_start)
+        return latency_metrics(latencies, time.perf_counter() - start)
+
+    def concurrent_search(self, per_client=50):
+        queries = [self._take_queries(per_client) for _ in range(self.clients)]
+        latencies = [[] for _ in range(self.clients)]
+        barrier = threading.Barrier(self.clients + 1)
+
+        def client_loop(number):
+            client = self.app.test_client()
+            barrier.wait()
+            for query in queries[number]:
+                query_start = time.perf_counter()
+                search(client, query)
+                latencies[number].append(time.perf_counter() - query_start)
+
+        threads = [threading.Thread(target=client_loop, args=(number,)) for number in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        metrics = latency_metrics(np.concatenate(latencies), time.perf_counter() - start)
+        metrics['clients'] = self.clients
+        return metrics
+
+    def delete_churn(self):
+        """Delete a document, search, re-ingest its file, search again"""
+        client = self.app.test_client()
+        documents = self.db.list_documents(limit=self.churn)
+        queries = iter(self._take_queries(2 * len(documents)))
+        latencies = []
+
+        def timed_search():
+            query_start = time.perf_counter()
+            search(client, next(queries))
+            latencies.append(time.perf_counter() - query_start)
+
+        start = time.perf_counter()
+        for document_id, file_path, *_ in documents:
+            response = client.delete(f'/documents/{document_id}')
+            if response.status_code != 200:
+                raise RuntimeError(f"Deleting document {document_id} failed: {response.get_json()}")
+            timed_search()
+            self.embedder.process_documents([file_path])
+            timed_search()
+        seconds = time.perf_counter() - start
+        metrics = latency_metrics(latencies, seconds)
+        metrics.update(documents=len(documents), seconds=seconds, churn_per_sec=len(documents) / seconds)
+        return metrics
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(baseline, current, tolerance):
+    """Print every compared metric; return the (scenario, metric) pairs that regressed"""
+    if baseline.get('meta', {}).get('documents') != current['meta']['documents']:
+        print("Warning: the baseline was run on a different corpus size")
+
+    regressions = []
+    print(f"\n{'scenario':>18} {'metric':>14} {'baseline':>11} {'current':>11} {'change':>8}")
+    for scenario, metrics in current['results'].items():
+        for name, value in metrics.items():
+            direction = metric_direction(name)
+            old = baseline.get('results', {}).get(scenario, {}).get(name)
+            if direction is None or not old:
+                continue
+            change = (value - old) / abs(old)
+            worse = -change * direction
+            status = 'REGRESSION' if worse > tolerance else ('improved' if worse < -tolerance else '')
+            if status == 'REGRESSION':
+                regressions.append((scenario, name))
+            print(f"{scenario:>18} {name:>14} {old:11.2f} {value:11.2f} {change:+8.1%} {status}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=SCALES, default='1k')
+    parser.add_argument('--documents', type=int, help='Number of documents (overrides --scale)')
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--dimension', type=int, default=768, help='Stub embedding dimension')
+    parser.add_argument('--queries', type=int, default=200, help='Sequential searches')
+    parser.add_argument('--clients', type=int, default=8, help='Threads of concurrent_search')
+    parser.add_argument('--churn', type=int, default=50, help='Documents deleted and re-ingested')
+    parser.add_argument('--corpus-dir', help='Corpus location, reused across runs (default: in the workdir)')
+    parser.add_argument('--workdir', help='Directory for the database (default: a temporary one, removed after)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative slowdown per metric')
+    args = parser.parse_args()
+
+    num_documents = args.documents or SCALES[args.scale]
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='ragfus-bench-')
+    corpus_dir = os.path.abspath(args.corpus_dir) if args.corpus_dir else os.path.join(workdir, 'corpus')
+
+    start = time.perf_counter()
+    write_corpus(corpus_dir, num_documents, args.formats, args.seed)
+    print(f"Corpus of {num_documents} documents ready in {time.perf_counter() - start:.1f} s")
+
+    # The app keeps its database in the working directory and shares whatever get_embedder() returns
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    install_stub_embedder(args.dimension)
+    import app as app_module
+
+    queries = sample_queries(args.queries + args.clients * 50 + 2 * args.churn + 10, args.seed)
+    suite = Suite(app_module, corpus_dir, num_documents, queries, args.clients, args.churn)
+    if 'ingest' not in args.scenarios and not app_module.db.list_documents(limit=1):
+        suite.ingest()
+
+    results = {}
+    try:
+        for scenario in SCENARIOS:
+            if scenario not in args.scenarios:
+                continue
+            print(f"Running {scenario}...")
+            results[scenario] = suite.search(args.queries) if scenario == 'search' else getattr(suite, scenario)()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'documents': num_documents,
+            'formats': args.formats,
+            'seed': args.seed,
+            'dimension': args.dimension,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'results': results
+    }
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
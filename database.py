@@ -1,122 +1,1260 @@
 import sqlite3
 import os
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+from quantization import STORAGE_CODECS, encode_vector, decode_vector
+from metrics import timed
+
+# Columns of the jobs table returned by get_job
+JOB_COLUMNS = ('id', 'kind', 'payload', 'status', 'files_seen', 'files_done', 'files_failed',
+               'files_skipped', 'checkpoint', 'error', 'created_at', 'started_at', 'updated_at', 'finished_at')
+
+# Columns of the rebuilds table returned by get_rebuild
+REBUILD_COLUMNS = ('id', 'model_name', 'dtype', 'status', 'checkpoint', 'documents_done', 'documents_failed',
+                   'started_at', 'updated_at', 'finished_at')
+
+# Live vector table -> shadow table an embedding rebuild writes to until it is swapped in
+REBUILD_TABLES = {'chunks': 'chunks_rebuild', 'embeddings': 'embeddings_rebuild'}
+
+# Seconds a connection waits on a locked database before giving up
+BUSY_TIMEOUT = 30
+
+# Pragmas applied to every pooled connection (journal_mode=WAL is persistent and set once)
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+)
+
+# file_size, file_mtime and content_hash of documents d, NULL for documents without vectors (so they're re-embedded)
+_HAS_VECTORS = ("(EXISTS (SELECT 1 FROM chunks c WHERE c.document_id = d.id) "
+                "OR EXISTS (SELECT 1 FROM embeddings e WHERE e.document_id = d.id))")
+FILE_STATE_COLUMNS = ', '.join(f"CASE WHEN {_HAS_VECTORS} THEN {column} END"
+                               for column in ('file_size', 'file_mtime', 'content_hash'))
+
+# Keep IN (...) lists under SQLite's bound-parameter limit
+MAX_PARAMETERS = 500
+
+# Lexical search: full-text index of document bodies (external content, so bodies aren't stored twice)
+FTS_TABLE = 'document_fts'
+
+# Encoding of newly stored embeddings: 'float32', 'float16' or 'int8' (see quantization.py)
+EMBEDDING_DTYPE = os.environ.get('EMBEDDING_DTYPE', 'float32')
+
+def _add_missing_columns(cursor, table, columns):
+    """Add (name, type) columns that an older database doesn't have yet"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, column_type in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+def _extension(file_path):
+    return os.path.splitext(file_path)[1].lower()
+
+def _migrate_base_schema(cursor):
+    """Version 1: the tables as they existed before schema versioning"""
+    # Create documents table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY,
+        file_path TEXT UNIQUE,
+        document_text TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # File state used to skip unchanged files on re-ingestion
+    _add_missing_columns(cursor, 'documents', [
+        ('file_size', 'INTEGER'),
+        ('file_mtime', 'INTEGER'),
+        ('content_hash', 'TEXT')
+    ])
+    
+    # Create embeddings table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS embeddings (
+        id INTEGER PRIMARY KEY,
+        document_id INTEGER,
+        embedding BLOB,
+        FOREIGN KEY (document_id) REFERENCES documents (id)
+    )
+    ''')
+    
+    # Create chunks table (one embedding per token window of a document)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS chunks (
+        id INTEGER PRIMARY KEY,
+        document_id INTEGER,
+        ordinal INTEGER,
+        start_char INTEGER,
+        end_char INTEGER,
+        embedding BLOB,
+        FOREIGN KEY (document_id) REFERENCES documents (id)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunks_document_id ON chunks (document_id)")
+    
+    # Create jobs table (persistent background ingestion queue)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        kind TEXT,
+        payload TEXT,
+        status TEXT DEFAULT 'queued',
+        files_seen INTEGER DEFAULT 0,
+        files_done INTEGER DEFAULT 0,
+        files_failed INTEGER DEFAULT 0,
+        checkpoint INTEGER DEFAULT 0,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at REAL,
+        updated_at REAL,
+        finished_at REAL
+    )
+    ''')
+    _add_missing_columns(cursor, 'jobs', [('files_skipped', 'INTEGER DEFAULT 0')])
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+
+def _migrate_unique_embeddings(cursor):
+    """Version 2: one embedding per document and one row per chunk ordinal
+
+    Re-processing a file used to append another embedding, which showed up as
+    duplicate search hits; the newest row of each duplicate set is kept.
+    """
+    cursor.execute("DELETE FROM embeddings WHERE id NOT IN (SELECT MAX(id) FROM embeddings GROUP BY document_id)")
+    cursor.execute(
+        "DELETE FROM chunks WHERE id NOT IN (SELECT MAX(id) FROM chunks GROUP BY document_id, ordinal)"
+    )
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_embeddings_document_id ON embeddings (document_id)")
+    cursor.execute("DROP INDEX IF EXISTS idx_chunks_document_id")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chunks_document_ordinal ON chunks (document_id, ordinal)")
+
+def _migrate_document_extension(cursor):
+    """Version 3: indexed file extension column (file_path is already indexed by its UNIQUE constraint)"""
+    _add_missing_columns(cursor, 'documents', [('extension', 'TEXT')])
+    cursor.execute("SELECT id, file_path FROM documents")
+    cursor.executemany("UPDATE documents SET extension = ? WHERE id = ?",
+                       [(_extension(file_path or ''), doc_id) for doc_id, file_path in cursor.fetchall()])
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_extension ON documents (extension)")
+
+def _migrate_embedding_metadata(cursor):
+    """Version 4: record the dimension, dtype and model of every stored vector
+
+    Rows written before this version are float32; their model is unknown.
+    """
+    for table in ('embeddings', 'chunks'):
+        _add_missing_columns(cursor, table, [
+            ('dimension', 'INTEGER'),
+            ('dtype', "TEXT DEFAULT 'float32'"),
+            ('model_name', 'TEXT')
+        ])
+        cursor.execute(f"UPDATE {table} SET dimension = length(embedding) / 4, dtype = 'float32'")
+
+def _migrate_separate_text(cursor):
+    """Version 5: move document bodies out of the documents table
+
+    Listing, change detection and search joins no longer page through
+    megabytes of text; bodies are read from document_texts only on demand.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS document_texts (
+        document_id INTEGER PRIMARY KEY,
+        document_text TEXT,
+        FOREIGN KEY (document_id) REFERENCES documents (id)
+    )
+    ''')
+    cursor.execute(
+        "INSERT OR REPLACE INTO document_texts (document_id, document_text) SELECT id, document_text FROM documents"
+    )
+    
+    # SQLite can't drop the column in place on older versions, so rebuild the table without it
+    cursor.execute('''
+    CREATE TABLE documents_new (
+        id INTEGER PRIMARY KEY,
+        file_path TEXT UNIQUE,
+        extension TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        file_size INTEGER,
+        file_mtime INTEGER,
+        content_hash TEXT
+    )
+    ''')
+    cursor.execute('''
+    INSERT INTO documents_new (id, file_path, extension, created_at, file_size, file_mtime, content_hash)
+    SELECT id, file_path, extension, created_at, file_size, file_mtime, content_hash FROM documents
+    ''')
+    cursor.execute("DROP TABLE documents")
+    cursor.execute("ALTER TABLE documents_new RENAME TO documents")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_extension ON documents (extension)")
+
+def _migrate_vector_version(cursor):
+    """Version 6: persistent counter bumped by every transaction that changes stored vectors
+
+    Lets the memory-mapped vector store tell whether it still matches the database.
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+    cursor.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('vectors', 0)")
+
+def _migrate_full_text_search(cursor):
+    """Version 7: FTS5 index of document bodies, used by lexical and hybrid search
+
+    The table reads its content from document_texts and is kept in sync by
+    the methods that write bodies. SQLite builds without FTS5 skip it and
+    only support vector search.
+    """
+    try:
+        cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+            document_text, content='document_texts', content_rowid='document_id'
+        )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"Full-text search unavailable: {str(e)}")
+        return
+    cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+
+def _migrate_text_length(cursor):
+    """Version 8: character length of each body, stored when it is written
+
+    Listings and previews report a document's length without reading its body.
+    """
+    _add_missing_columns(cursor, 'documents', [('text_length', 'INTEGER')])
+    cursor.execute(
+        "UPDATE documents SET text_length = "
+        "(SELECT length(document_text) FROM document_texts WHERE document_id = documents.id)"
+    )
+
+def _migrate_rebuilds(cursor):
+    """Version 9: progress of embedding rebuilds, so an interrupted rebuild resumes from its checkpoint"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rebuilds (
+        id INTEGER PRIMARY KEY,
+        model_name TEXT,
+        dtype TEXT,
+        status TEXT DEFAULT 'running',
+        checkpoint INTEGER DEFAULT 0,
+        documents_done INTEGER DEFAULT 0,
+        documents_failed INTEGER DEFAULT 0,
+        started_at REAL,
+        updated_at REAL,
+        finished_at REAL
+    )
+    ''')
+
+def _migrate_filter_indexes(cursor):
+    """Version 10: index the document columns that search filters are pushed down to
+
+    extension is indexed since version 3 and file_path by its UNIQUE constraint.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_created_at ON documents (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_file_size ON documents (file_size)")
+
+def _create_rebuild_tables(cursor, rebuild_id):
+    """Empty shadow copies of the chunks and embeddings tables
+
+    The indexes are named after the rebuild, so they keep their names once
+    the tables are renamed into place and the next rebuild can't collide.
+    """
+    cursor.execute(f'''
+    CREATE TABLE {REBUILD_TABLES['embeddings']} (
+        id INTEGER PRIMARY KEY,
+        document_id INTEGER,
+        embedding BLOB,
+        dimension INTEGER,
+        dtype TEXT DEFAULT 'float32',
+        model_name TEXT,
+        FOREIGN KEY (document_id) REFERENCES documents (id)
+    )
+    ''')
+    cursor.execute(f'''
+    CREATE TABLE {REBUILD_TABLES['chunks']} (
+        id INTEGER PRIMARY KEY,
+        document_id INTEGER,
+        ordinal INTEGER,
+        start_char INTEGER,
+        end_char INTEGER,
+        embedding BLOB,
+        dimension INTEGER,
+        dtype TEXT DEFAULT 'float32',
+        model_name TEXT,
+        FOREIGN KEY (document_id) REFERENCES documents (id)
+    )
+    ''')
+    cursor.execute(f"CREATE UNIQUE INDEX idx_embeddings_document_id_{rebuild_id} "
+                   f"ON {REBUILD_TABLES['embeddings']} (document_id)")
+    cursor.execute(f"CREATE UNIQUE INDEX idx_chunks_document_ordinal_{rebuild_id} "
+                   f"ON {REBUILD_TABLES['chunks']} (document_id, ordinal)")
+
+def normalize_date(value):
+    """A created_after/created_before bound in the form of created_at
+
+    created_at is stored as UTC 'YYYY-MM-DD HH:MM:SS' text and compared as
+    text, so an ISO 8601 bound such as '2024-05-01T10:00:00' or one with a UTC
+    offset is rewritten to that form first. Bare dates are kept as they are.
+
+    Raises:
+        ValueError: If value isn't an ISO 8601 date or date and time
+    """
+    moment = datetime.fromisoformat(value)
+    if len(value) == 10:
+        return value
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def _document_filter(extensions=None, path_prefix=None, created_after=None, created_before=None,
+                     min_size=None, max_size=None):
+    """SQL conditions on documents d, and their parameters, for the document filters
+
+    Each condition can use an index: a path prefix is matched as a range of
+    file_path rather than with substr().
+
+    Args:
+        extensions (list): Only documents with these file extensions (e.g. ['.pdf'])
+        path_prefix (str): Only documents whose path starts with this
+        created_after, created_before (str): ISO 8601 date or date and time bounds (inclusive) on created_at
+        min_size, max_size (int): Bounds (inclusive) on the file size in bytes
+    """
+    conditions, params = [], []
+    if extensions:
+        conditions.append(f"d.extension IN ({','.join('?' * len(extensions))})")
+        params.extend(ext.lower() for ext in extensions)
+    if path_prefix:
+        conditions.append("d.file_path >= ? AND d.file_path < ?")
+        params.extend((path_prefix, path_prefix[:-1] + chr(ord(path_prefix[-1]) + 1)))
+    if created_after:
+        conditions.append("d.created_at >= ?")
+        params.append(normalize_date(created_after))
+    if created_before:
+        # A bare date includes the whole day
+        created_before = normalize_date(created_before)
+        conditions.append("d.created_at <= ?")
+        params.append(created_before if len(created_before) > 10 else f"{created_before} 23:59:59")
+    if min_size is not None:
+        conditions.append("d.file_size >= ?")
+        params.append(min_size)
+    if max_size is not None:
+        conditions.append("d.file_size <= ?")
+        params.append(max_size)
+    return conditions, params
+
+def _fts_query(query_text):
+    """FTS5 query matching any word of the query text
+
+    Each whitespace-separated term becomes a quoted phrase, so identifiers
+    and part numbers (get_all_documents, AB-1234) match their tokens in
+    sequence and FTS5 operators in user input are taken literally.
+    """
+    terms = [term for term in query_text.split() if re.search(r'\w', term)]
+    return ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+# Schema migrations, applied in order; a database's PRAGMA user_version is the
+# number of migrations it has already run. Append new migrations, never edit old ones.
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_unique_embeddings,
+    _migrate_document_extension,
+    _migrate_embedding_metadata,
+    _migrate_separate_text,
+    _migrate_vector_version,
+    _migrate_full_text_search,
+    _migrate_text_length,
+    _migrate_rebuilds,
+    _migrate_filter_indexes,
+]
 
 class Database:
-    def __init__(self, db_path='document_embeddings.db'):
+    def __init__(self, db_path='document_embeddings.db', vector_dtype=EMBEDDING_DTYPE):
+        if vector_dtype not in STORAGE_CODECS:
+            raise ValueError(f"Unknown embedding dtype '{vector_dtype}', expected one of {STORAGE_CODECS}")
         self.db_path = db_path
-        self.setup_database()
+        self.vector_dtype = vector_dtype
+        self._listeners = []
+        self._local = threading.local()
+        self._version_lock = threading.Lock()
+        # Bumped on every change to the searchable corpus, so caches can tell when they're stale
+        self.corpus_version = 0
+        
+        # The file is opened and migrated on first use, not when the module is imported
+        self._set_up = False
+        self._setup_lock = threading.Lock()
+        self._full_text_search = False
+    
+    @property
+    def full_text_search(self):
+        """Whether this SQLite build has the FTS5 index used by lexical and hybrid search"""
+        self._ensure_set_up()
+        return self._full_text_search
+    
+    def _ensure_set_up(self):
+        if not self._set_up:
+            with self._setup_lock:
+                if not self._set_up:
+                    self.setup_database()
+    
+    def _connect(self, read_only=False):
+        if read_only:
+            uri = f"file:{pathname2url(os.path.abspath(self.db_path))}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT, isolation_level=None)
+        else:
+            # Autocommit mode; write transactions are opened explicitly by _transaction
+            conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute("PRAGMA query_only = 1")
+        return conn
+    
+    def _connection(self, read_only=False):
+        """Get this thread's pooled connection, opening it on first use"""
+        self._ensure_set_up()
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # Connections must not be shared with forked child processes
+            local.__dict__.clear()
+            local.pid = os.getpid()
+        
+        key = 'reader' if read_only else 'writer'
+        conn = getattr(local, key, None)
+        if conn is None:
+            conn = self._connect(read_only)
+            setattr(local, key, conn)
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        """Run statements in one write transaction on this thread's connection"""
+        conn = self._connection()
+        cursor = conn.cursor()
+        # IMMEDIATE takes the write lock up front, so concurrent writers wait instead of deadlocking
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+    
+    def _read(self):
+        """Cursor on this thread's read-only connection, used by search and listing paths"""
+        return self._connection(read_only=True).cursor()
+    
+    def close(self):
+        """Close the calling thread's pooled connections"""
+        for key in ('reader', 'writer'):
+            conn = self._local.__dict__.pop(key, None)
+            if conn is not None:
+                conn.close()
+    
+    def add_listener(self, listener):
+        """Register an object to be notified when embeddings or documents change
+
+        Listeners may implement on_embedding_inserted(document_id, embedding_blob, file_path, dtype),
+        on_chunks_replaced(document_id, chunks, file_path, dtype), on_document_deleted(document_id),
+        on_documents_inserted(document_ids), on_embeddings_cleared() and on_embeddings_replaced() (a rebuild
+        swapped in new vector tables). Blobs are passed as stored, encoded with the dtype codec.
+        on_changes_committed() follows the per-document events of each write.
+        """
+        self._listeners.append(listener)
+    
+    def _notify(self, event, *args):
+        for listener in self._listeners:
+            handler = getattr(listener, event, None)
+            if handler is not None:
+                handler(*args)
+        
+        # Every event changes the corpus; bump the version only once listeners have caught up,
+        # so a search that sees the new version also sees the new vectors
+        with self._version_lock:
+            self.corpus_version += 1
+    
+    def _bump_vector_version(self, cursor):
+        """Count a write to the vectors, once per transaction; the version it replaced is kept per thread"""
+        cursor.execute("SELECT value FROM counters WHERE name = 'vectors'")
+        self._local.vector_version_before_write = cursor.fetchone()[0]
+        cursor.execute("UPDATE counters SET value = value + 1 WHERE name = 'vectors'")
+    
+    def get_vector_version(self):
+        """Counter that changes whenever stored vectors are written or deleted"""
+        cursor = self._read()
+        cursor.execute("SELECT value FROM counters WHERE name = 'vectors'")
+        return cursor.fetchone()[0]
+    
+    def get_vector_version_before_write(self):
+        """Vector version just before the calling thread's last vector write, or None
+        
+        Listeners notified of that write can tell from it whether a copy of
+        the vectors missed only this write.
+        """
+        return getattr(self._local, 'vector_version_before_write', None)
     
     def setup_database(self):
-        """Create database and tables if they don't exist"""
-        conn = sqlite3.connect(self.db_path)
+        """Create the database, or bring an existing one up to the current schema version"""
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
         cursor = conn.cursor()
         
-        # Create documents table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY,
-            file_path TEXT UNIQUE,
-            document_text TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        # Write-ahead logging lets searches read while ingestion writes
+        cursor.execute("PRAGMA journal_mode = WAL")
+        
+        try:
+            for version, migration in enumerate(MIGRATIONS, start=1):
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    # Re-check under the write lock in case another process migrated first
+                    cursor.execute("PRAGMA user_version")
+                    if cursor.fetchone()[0] < version:
+                        migration(cursor)
+                        cursor.execute(f"PRAGMA user_version = {version}")
+                    cursor.execute("COMMIT")
+                except BaseException:
+                    cursor.execute("ROLLBACK")
+                    raise
+            
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,))
+            self._full_text_search = cursor.fetchone() is not None
+            self._set_up = True
+        finally:
+            conn.close()
+    
+    def _file_paths(self, cursor, document_ids):
+        """Get {document_id: file_path} for the given documents"""
+        paths = {}
+        document_ids = list(document_ids)
+        for start in range(0, len(document_ids), MAX_PARAMETERS):
+            batch = document_ids[start:start + MAX_PARAMETERS]
+            cursor.execute(
+                f"SELECT id, file_path FROM documents WHERE id IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            paths.update(cursor.fetchall())
+        return paths
+    
+    def insert_documents_bulk(self, documents):
+        """Insert or update many documents in one transaction
+        
+        Args:
+            documents (list): (file_path, document_text, file_size, file_mtime, content_hash) tuples
+        
+        Returns:
+            list: Document IDs, in the order of documents
+        """
+        if not documents:
+            return []
+        
+        with timed('db_insert_documents'), self._transaction() as cursor:
+            document_ids = self._write_documents(cursor, documents)
+        
+        # Bodies are searchable by lexical search
+        self._notify('on_documents_inserted', document_ids)
+        return document_ids
+    
+    def _write_documents(self, cursor, documents):
+        """Upsert documents and their bodies in the open transaction and return their IDs, in order"""
+        # Store documents, refreshing the state of files that changed
+        cursor.executemany(
+            """
+            INSERT INTO documents (file_path, extension, file_size, file_mtime, content_hash, text_length)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (file_path) DO UPDATE SET
+                file_size = excluded.file_size,
+                file_mtime = excluded.file_mtime,
+                content_hash = excluded.content_hash,
+                text_length = excluded.text_length
+            """,
+            [(file_path, _extension(file_path), file_size, file_mtime, content_hash,
+              len(document_text) if document_text is not None else None)
+             for file_path, document_text, file_size, file_mtime, content_hash in documents]
         )
-        ''')
         
-        # Create embeddings table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS embeddings (
-            id INTEGER PRIMARY KEY,
-            document_id INTEGER,
-            embedding BLOB,
-            FOREIGN KEY (document_id) REFERENCES documents (id)
+        # Get document IDs
+        paths = [document[0] for document in documents]
+        ids = {}
+        for start in range(0, len(paths), MAX_PARAMETERS):
+            batch = paths[start:start + MAX_PARAMETERS]
+            cursor.execute(
+                f"SELECT file_path, id FROM documents WHERE file_path IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            ids.update(cursor.fetchall())
+        
+        # The full-text index needs the old body of a replaced document to remove its terms
+        if self.full_text_search:
+            document_ids = [ids[path] for path in paths]
+            for start in range(0, len(document_ids), MAX_PARAMETERS):
+                batch = document_ids[start:start + MAX_PARAMETERS]
+                cursor.execute(
+                    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, document_text) "
+                    f"SELECT 'delete', document_id, document_text FROM document_texts "
+                    f"WHERE document_id IN ({','.join('?' * len(batch))})",
+                    batch
+                )
+        
+        # A rebuild in progress has to embed the new bodies again
+        self._invalidate_rebuild(cursor, [ids[path] for path in paths])
+        
+        # Store the bodies separately so they're only read when needed
+        texts = [(ids[document[0]], document[1]) for document in documents]
+        cursor.executemany(
+            "INSERT OR REPLACE INTO document_texts (document_id, document_text) VALUES (?, ?)",
+            texts
         )
-        ''')
+        if self.full_text_search:
+            cursor.executemany(f"INSERT INTO {FTS_TABLE} (rowid, document_text) VALUES (?, ?)", texts)
+        return [ids[path] for path in paths]
+    
+    def insert_document(self, file_path, document_text, file_size=None, file_mtime=None, content_hash=None):
+        """Insert a document into the database, or update it in place, and return its ID"""
+        return self.insert_documents_bulk([(file_path, document_text, file_size, file_mtime, content_hash)])[0]
+    
+    def get_file_state(self, file_path):
+        """Get (id, file_size, file_mtime, content_hash) of a stored file, or None
         
-        conn.commit()
-        conn.close()
+        The state of a document without vectors (its embedding failed) is None
+        but for the ID, so it compares as changed.
+        """
+        cursor = self._read()
+        cursor.execute(f"SELECT id, {FILE_STATE_COLUMNS} FROM documents d WHERE file_path = ?", (file_path,))
+        return cursor.fetchone()
     
-    def insert_document(self, file_path, document_text):
-        """Insert a document into the database and return its ID"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def get_file_states(self, directory_path):
+        """Get {file_path: (id, file_size, file_mtime, content_hash)} for documents under a directory"""
+        prefix = os.path.join(directory_path, '')
         
-        # Store document in database
+        cursor = self._read()
         cursor.execute(
-            "INSERT OR IGNORE INTO documents (file_path, document_text) VALUES (?, ?)",
-            (file_path, document_text)
+            f"SELECT file_path, id, {FILE_STATE_COLUMNS} FROM documents d "
+            "WHERE substr(file_path, 1, ?) = ?",
+            (len(prefix), prefix)
         )
-        conn.commit()
+        return {row[0]: row[1:] for row in cursor.fetchall()}
+    
+    def update_file_state(self, document_id, file_size, file_mtime):
+        """Record a new size and mtime for a file whose content didn't change"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE documents SET file_size = ?, file_mtime = ? WHERE id = ?",
+                (file_size, file_mtime, document_id)
+            )
+    
+    def _encode(self, blob):
+        """Re-encode a float32 blob with the configured storage codec"""
+        if self.vector_dtype == 'float32':
+            return blob
+        return encode_vector(decode_vector(blob), self.vector_dtype)
+    
+    def insert_embeddings_bulk(self, embeddings, model_name=None):
+        """Insert or replace the embeddings of many documents in one transaction
+        
+        Args:
+            embeddings (list): (document_id, embedding_blob) tuples of float32 blobs,
+                stored with the vector_dtype codec
+            model_name (str): Model that produced the embeddings
+        """
+        if not embeddings:
+            return
         
-        # Get document ID
-        cursor.execute("SELECT id FROM documents WHERE file_path = ?", (file_path,))
-        document_id = cursor.fetchone()[0]
+        with timed('db_insert_embeddings'), self._transaction() as cursor:
+            stored = self._write_embeddings(cursor, embeddings, model_name)
+            self._bump_vector_version(cursor)
+            paths = self._file_paths(cursor, {document_id for document_id, _ in embeddings})
         
-        conn.close()
-        return document_id
+        self._notify_embeddings(stored, paths)
+        self._notify('on_changes_committed')
     
-    def insert_embedding(self, document_id, embedding_blob):
-        """Insert an embedding for a document into the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _write_embeddings(self, cursor, embeddings, model_name):
+        """Store document embeddings in the open transaction; returns (document_id, stored_blob) tuples"""
+        stored = [(document_id, self._encode(blob), len(blob) // 4) for document_id, blob in embeddings]
+        # Store embeddings, replacing the previous one of each document
+        cursor.executemany(
+            "INSERT OR REPLACE INTO embeddings (document_id, embedding, dimension, dtype, model_name) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(document_id, blob, dimension, self.vector_dtype, model_name)
+             for document_id, blob, dimension in stored]
+        )
+        return [(document_id, blob) for document_id, blob, _ in stored]
+    
+    def _notify_embeddings(self, stored, paths):
+        for document_id, embedding_blob in stored:
+            self._notify('on_embedding_inserted', document_id, embedding_blob, paths.get(document_id, ''),
+                         self.vector_dtype)
+    
+    def insert_embedding(self, document_id, embedding_blob, model_name=None):
+        """Insert or replace the (float32) embedding of a document"""
+        self.insert_embeddings_bulk([(document_id, embedding_blob)], model_name)
+    
+    def replace_chunks_bulk(self, documents, model_name=None):
+        """Replace the chunk embeddings of many documents in one transaction
         
-        # Store embedding
-        cursor.execute(
-            "INSERT OR REPLACE INTO embeddings (document_id, embedding) VALUES (?, ?)",
-            (document_id, embedding_blob)
+        Args:
+            documents (list): (document_id, chunks) tuples, where chunks is a list of
+                (ordinal, start_char, end_char, embedding_blob) tuples of float32 blobs,
+                stored with the vector_dtype codec
+            model_name (str): Model that produced the embeddings
+        """
+        if not documents:
+            return
+        
+        with timed('db_insert_chunks'), self._transaction() as cursor:
+            stored = self._write_chunks(cursor, documents, model_name)
+            self._bump_vector_version(cursor)
+            paths = self._file_paths(cursor, {document_id for document_id, _ in documents})
+        
+        for document_id, chunks in stored:
+            self._notify('on_chunks_replaced', document_id, chunks, paths.get(document_id, ''), self.vector_dtype)
+        self._notify('on_changes_committed')
+    
+    def _write_chunks(self, cursor, documents, model_name):
+        """Replace chunk embeddings in the open transaction; returns (document_id, stored chunks) tuples"""
+        stored = [(document_id, [(ordinal, start, end, self._encode(blob)) for ordinal, start, end, blob in chunks])
+                  for document_id, chunks in documents]
+        cursor.executemany("DELETE FROM chunks WHERE document_id = ?",
+                           [(document_id,) for document_id, _ in documents])
+        cursor.executemany(
+            "INSERT INTO chunks (document_id, ordinal, start_char, end_char, embedding, dimension, dtype, model_name) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(document_id, ordinal, start, end, stored_blob, len(blob) // 4, self.vector_dtype, model_name)
+             for (document_id, chunks), (_, stored_chunks) in zip(documents, stored)
+             for (ordinal, start, end, blob), (_, _, _, stored_blob) in zip(chunks, stored_chunks)]
         )
-        conn.commit()
-        conn.close()
+        return stored
     
+    def store_documents_bulk(self, documents, model_name=None):
+        """Insert or update documents together with their chunk and document embeddings, in one transaction
+        
+        A file's size, mtime and content hash are only committed with its
+        vectors, so a failed embedding or write never leaves a document that
+        later runs would skip as unchanged.
+        
+        Args:
+            documents (list): (file_path, document_text, file_size, file_mtime, content_hash,
+                embedding_blob, chunks) tuples, with chunks and blobs as in replace_chunks_bulk
+            model_name (str): Model that produced the embeddings
+
+        Returns:
+            list: Document IDs, in the order of documents
+        """
+        if not documents:
+            return []
+        
+        with timed('db_store_documents'), self._transaction() as cursor:
+            document_ids = self._write_documents(cursor, [document[:5] for document in documents])
+            chunks = self._write_chunks(cursor, [(document_id, document[6])
+                                                 for document_id, document in zip(document_ids, documents)],
+                                        model_name)
+            embeddings = self._write_embeddings(cursor, [(document_id, document[5])
+                                                         for document_id, document in zip(document_ids, documents)],
+                                                model_name)
+            self._bump_vector_version(cursor)
+        
+        paths = {document_id: document[0] for document_id, document in zip(document_ids, documents)}
+        self._notify('on_documents_inserted', document_ids)
+        for document_id, stored_chunks in chunks:
+            self._notify('on_chunks_replaced', document_id, stored_chunks, paths[document_id], self.vector_dtype)
+        self._notify_embeddings(embeddings, paths)
+        self._notify('on_changes_committed')
+        return document_ids
+    
+    def replace_chunks(self, document_id, chunks, model_name=None):
+        """Replace the chunk embeddings of a document
+
+        Args:
+            document_id (int): Document the chunks belong to
+            chunks (list): (ordinal, start_char, end_char, embedding_blob) tuples of float32 blobs
+        """
+        self.replace_chunks_bulk([(document_id, chunks)], model_name)
+    
+    @timed('db_read_vectors')
+    def get_all_chunk_vectors(self, document_ids=None):
+        """Get every searchable vector, ordered by document and chunk ordinal
+
+        Returns (document_id, file_path, ordinal, start_char, end_char, embedding, dtype) rows,
+        where dtype names the codec the embedding blob is stored with.
+        Documents without chunks fall back to their whole-document embedding,
+        with ordinal -1 and no character offsets.
+
+        Args:
+            document_ids (list): Only return the vectors of these documents
+        """
+        if document_ids is None:
+            batches, condition = [[]], ""
+        else:
+            ids = list(document_ids)
+            batches = [ids[start:start + MAX_PARAMETERS // 2] for start in range(0, len(ids), MAX_PARAMETERS // 2)]
+        
+        rows = []
+        cursor = self._read()
+        for batch in batches:
+            if document_ids is not None:
+                condition = f"AND d.id IN ({','.join('?' * len(batch))})"
+            cursor.execute(f"""
+                SELECT c.document_id, d.file_path, c.ordinal, c.start_char, c.end_char, c.embedding, c.dtype
+                FROM chunks c
+                JOIN documents d ON d.id = c.document_id
+                WHERE 1 {condition}
+                UNION ALL
+                SELECT d.id, d.file_path, -1, 0, NULL, e.embedding, e.dtype
+                FROM documents d
+                JOIN embeddings e ON d.id = e.document_id
+                WHERE NOT EXISTS (SELECT 1 FROM chunks c WHERE c.document_id = d.id) {condition}
+                ORDER BY 1, 3
+            """, batch * 2)
+            rows.extend(cursor.fetchall())
+        return rows
+    
+    @timed('db_read_passages')
+    def get_passages(self, passages, length=200):
+        """Get {document_id: (file_path, snippet)} for (document_id, start_char, end_char) passages
+
+        Each snippet is cut from the passage start with substr() in SQL, so
+        large documents are never loaded whole. An end_char of -1 means the
+        passage runs to the end of the document.
+        """
+        if not passages:
+            return {}
+        
+        wanted = []
+        for document_id, start, end in passages:
+            span = length if end < 0 else min(length, end - start)
+            # Ask for one extra character to know whether a long passage was truncated
+            fetch_length = span + 1 if end < 0 or end - start > length else span
+            wanted.extend((int(document_id), int(start) + 1, fetch_length, span))
+        
+        values = ','.join(['(?, ?, ?, ?)'] * len(passages))
+        cursor = self._read()
+        cursor.execute(f"""
+            WITH wanted(id, start, fetch_length, span) AS (VALUES {values})
+            SELECT w.id, d.file_path, substr(t.document_text, w.start, w.fetch_length), w.span
+            FROM wanted w
+            JOIN documents d ON d.id = w.id
+            LEFT JOIN document_texts t ON t.document_id = w.id
+        """, wanted)
+        
+        snippets = {}
+        for doc_id, file_path, text, span in cursor.fetchall():
+            text = text or ''
+            snippets[doc_id] = (file_path, text[:span] + '...' if len(text) > span else text)
+        return snippets
+    
+    @timed('lexical')
+    def search_lexical(self, query_text, limit, file_extensions=None, filters=None):
+        """Rank documents by BM25 over their full text
+
+        Args:
+            filters (dict): Other document filters of list_documents (path_prefix, created_after, ...)
+
+        Returns:
+            list: (document_id, file_path, score, snippet) of up to limit documents,
+                best first; higher scores are better
+        """
+        if not self.full_text_search:
+            raise RuntimeError("Full-text search is not available: this SQLite build lacks FTS5")
+        match = _fts_query(query_text)
+        if not match or limit <= 0:
+            return []
+        
+        conditions, params = _document_filter(file_extensions, **(filters or {}))
+        document_filter = ''.join(f"AND {condition} " for condition in conditions)
+        params = [match] + params + [limit]
+        
+        cursor = self._read()
+        cursor.execute(f"""
+            SELECT d.id, d.file_path, -bm25({FTS_TABLE}), snippet({FTS_TABLE}, 0, '', '', '...', 32)
+            FROM {FTS_TABLE}
+            JOIN documents d ON d.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH ? {document_filter}
+            ORDER BY bm25({FTS_TABLE})
+            LIMIT ?
+        """, params)
+        return cursor.fetchall()
+    
+    @timed('db_read_embeddings')
     def get_all_document_embeddings(self):
         """Get all documents and their embeddings from the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        cursor = self._read()
         cursor.execute("""
-            SELECT d.id, d.file_path, d.document_text, e.embedding 
+            SELECT d.id, d.file_path, t.document_text, e.embedding 
             FROM documents d
             JOIN embeddings e ON d.id = e.document_id
+            LEFT JOIN document_texts t ON t.document_id = d.id
+        """)
+        return cursor.fetchall()
+    
+    def get_all_documents(self):
+        """Get (id, file_path, document_text) for every document"""
+        cursor = self._read()
+        cursor.execute("""
+            SELECT d.id, d.file_path, t.document_text
+            FROM documents d
+            LEFT JOIN document_texts t ON t.document_id = d.id
         """)
+        return cursor.fetchall()
+    
+    def list_documents(self, after_id=None, limit=None, **filters):
+        """Get (id, file_path, created_at, extension, text_length) of documents, newest first
+        
+        Pages are read by keyset: pass the last ID of a page as after_id to get
+        the next one, which costs the same however deep the page is.
         
-        results = cursor.fetchall()
-        conn.close()
+        Args:
+            filters: extensions, path_prefix, created_after, created_before,
+                min_size and max_size (see _document_filter)
+        """
+        conditions, params = _document_filter(**filters)
+        if after_id is not None:
+            conditions.append("d.id < ?")
+            params.append(after_id)
         
-        return results
+        query = "SELECT d.id, d.file_path, d.created_at, d.extension, d.text_length FROM documents d"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY d.id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        cursor = self._read()
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    
+    @timed('db_filter_documents')
+    def filter_document_ids(self, **filters):
+        """Get the IDs of the documents matching the filters of list_documents, in ascending order"""
+        conditions, params = _document_filter(**filters)
+        cursor = self._read()
+        cursor.execute(f"SELECT d.id FROM documents d WHERE {' AND '.join(conditions) or 1} ORDER BY d.id", params)
+        return [row[0] for row in cursor.fetchall()]
+    
+    def iter_documents(self, page_size=1000, **filters):
+        """Yield the rows of list_documents one keyset page at a time, so memory stays bounded"""
+        after_id = filters.pop('after_id', None)
+        limit = filters.pop('limit', None)
+        while limit is None or limit > 0:
+            rows = self.list_documents(after_id, page_size if limit is None else min(page_size, limit), **filters)
+            yield from rows
+            if len(rows) < page_size:
+                return
+            after_id = rows[-1][0]
+            if limit is not None:
+                limit -= len(rows)
+    
+    def get_document_path(self, document_id):
+        """Get the file path of a document, or None if it doesn't exist"""
+        cursor = self._read()
+        cursor.execute("SELECT file_path FROM documents WHERE id = ?", (document_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def get_document_preview(self, document_id, max_length):
+        """Get (file_path, preview, total_length) of a document, or None if it doesn't exist"""
+        cursor = self._read()
+        cursor.execute(
+            "SELECT d.file_path, substr(t.document_text, 1, ?), d.text_length "
+            "FROM documents d LEFT JOIN document_texts t ON t.document_id = d.id WHERE d.id = ?",
+            (max_length, document_id)
+        )
+        return cursor.fetchone()
     
     def clear_database(self):
         """Delete all records from the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Delete all records from embeddings table first (due to foreign key constraint)
-        cursor.execute("DELETE FROM embeddings")
-        
-        # Delete all records from documents table
-        cursor.execute("DELETE FROM documents")
-        
-        # Commit changes
-        conn.commit()
-        conn.close()
+        with self._transaction() as cursor:
+            # Delete all records from embeddings and chunks tables first (due to foreign key constraint)
+            cursor.execute("DELETE FROM embeddings")
+            cursor.execute("DELETE FROM chunks")
+            
+            # Delete all records from documents and document_texts tables
+            if self.full_text_search:
+                cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('delete-all')")
+            cursor.execute("DELETE FROM document_texts")
+            cursor.execute("DELETE FROM documents")
+            if self._rebuild_in_progress(cursor):
+                for table in REBUILD_TABLES.values():
+                    cursor.execute(f"DELETE FROM {table}")
+            self._bump_vector_version(cursor)
         
+        self._notify('on_embeddings_cleared')
+        self._notify('on_changes_committed')
         print("Database cleared successfully.")
         return True
     
     def delete_document(self, document_id):
         """Delete a document and its embedding from the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._transaction() as cursor:
+            # Delete embedding and chunks first (due to foreign key constraint)
+            cursor.execute("DELETE FROM embeddings WHERE document_id = ?", (document_id,))
+            deleted_count = cursor.rowcount
+            cursor.execute("DELETE FROM chunks WHERE document_id = ?", (document_id,))
+            deleted_count += cursor.rowcount
+            
+            # Delete document
+            if self.full_text_search:
+                cursor.execute(
+                    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, document_text) "
+                    f"SELECT 'delete', document_id, document_text FROM document_texts WHERE document_id = ?",
+                    (document_id,)
+                )
+            cursor.execute("DELETE FROM document_texts WHERE document_id = ?", (document_id,))
+            cursor.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+            deleted_count += cursor.rowcount
+            self._invalidate_rebuild(cursor, [document_id])
+            self._bump_vector_version(cursor)
         
-        # Delete embedding first (due to foreign key constraint)
-        cursor.execute("DELETE FROM embeddings WHERE document_id = ?", (document_id,))
+        if deleted_count > 0:
+            self._notify('on_document_deleted', document_id)
+            self._notify('on_changes_committed')
+        return deleted_count > 0
+    
+    def clear_embeddings(self):
+        """Delete all document and chunk embeddings while keeping the documents"""
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM embeddings")
+            cursor.execute("DELETE FROM chunks")
+            self._bump_vector_version(cursor)
         
-        # Delete document
-        cursor.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+        self._notify('on_embeddings_cleared')
+        self._notify('on_changes_committed')
+    
+    # Embedding rebuilds: new vectors are written to the shadow tables in REBUILD_TABLES
+    # while searches keep reading the live ones, then swapped in by swap_rebuild
+    @staticmethod
+    def _rebuild_in_progress(cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (REBUILD_TABLES['embeddings'],))
+        return cursor.fetchone() is not None
+    
+    def _invalidate_rebuild(self, cursor, document_ids):
+        """Drop the shadow vectors of changed or deleted documents, so a rebuild in progress embeds them again"""
+        if not self._rebuild_in_progress(cursor):
+            return
+        for start in range(0, len(document_ids), MAX_PARAMETERS):
+            batch = document_ids[start:start + MAX_PARAMETERS]
+            for table in REBUILD_TABLES.values():
+                cursor.execute(f"DELETE FROM {table} WHERE document_id IN ({','.join('?' * len(batch))})", batch)
+    
+    def start_rebuild(self, model_name, restart=False):
+        """Start an embedding rebuild into empty shadow tables, or resume the one in progress
         
-        # Commit changes
-        conn.commit()
-        deleted_count = conn.total_changes
-        conn.close()
+        A rebuild in progress is resumed if it uses the same model and dtype;
+        otherwise, or with restart, its shadow tables are dropped and a new one starts.
         
-        return deleted_count > 0
+        Returns:
+            dict: The rebuild, as returned by get_rebuild
+        """
+        with self._transaction() as cursor:
+            cursor.execute(
+                "SELECT id, model_name, dtype FROM rebuilds WHERE status = 'running' ORDER BY id DESC LIMIT 1"
+            )
+            row = cursor.fetchone()
+            if (row is not None and not restart and row[1:] == (model_name, self.vector_dtype)
+                    and self._rebuild_in_progress(cursor)):
+                rebuild_id = row[0]
+            else:
+                now = time.time()
+                cursor.execute(
+                    "UPDATE rebuilds SET status = 'abandoned', finished_at = ? WHERE status = 'running'", (now,)
+                )
+                for table in REBUILD_TABLES.values():
+                    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+                cursor.execute(
+                    "INSERT INTO rebuilds (model_name, dtype, started_at, updated_at) VALUES (?, ?, ?, ?)",
+                    (model_name, self.vector_dtype, now, now)
+                )
+                rebuild_id = cursor.lastrowid
+                _create_rebuild_tables(cursor, rebuild_id)
+        return self.get_rebuild(rebuild_id)
+    
+    def get_rebuild(self, rebuild_id):
+        """Get a rebuild as a dict, or None if it doesn't exist"""
+        cursor = self._read()
+        cursor.execute(f"SELECT {', '.join(REBUILD_COLUMNS)} FROM rebuilds WHERE id = ?", (rebuild_id,))
+        row = cursor.fetchone()
+        return dict(zip(REBUILD_COLUMNS, row)) if row else None
+    
+    def get_documents_after(self, after_id, limit):
+        """Get (id, file_path, document_text) of up to limit documents with a body, by ascending ID after after_id"""
+        cursor = self._read()
+        cursor.execute("""
+            SELECT d.id, d.file_path, t.document_text
+            FROM documents d
+            JOIN document_texts t ON t.document_id = d.id
+            WHERE d.id > ? AND t.document_text IS NOT NULL
+            ORDER BY d.id
+            LIMIT ?
+        """, (after_id, limit))
+        return cursor.fetchall()
+    
+    def get_rebuild_backlog(self, after_id, limit):
+        """Like get_documents_after, for the documents the rebuild in progress has no vectors of yet"""
+        cursor = self._read()
+        cursor.execute(f"""
+            SELECT d.id, d.file_path, t.document_text
+            FROM documents d
+            JOIN document_texts t ON t.document_id = d.id
+            WHERE d.id > ? AND t.document_text IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM {REBUILD_TABLES['embeddings']} e WHERE e.document_id = d.id)
+            ORDER BY d.id
+            LIMIT ?
+        """, (after_id, limit))
+        return cursor.fetchall()
+    
+    def write_rebuild_batch(self, rebuild_id, documents, model_name=None, checkpoint=None, failed=0):
+        """Store the new vectors of a batch of documents and advance the rebuild's checkpoint, in one transaction
+        
+        Documents deleted or given a new body since they were read are left
+        out; the rebuild finds them again in its backlog.
+        
+        Args:
+            documents (list): (document_id, document_text, embedding_blob, chunks) tuples, where
+                document_text is the body that was embedded and chunks is a list of
+                (ordinal, start_char, end_char, embedding_blob) tuples of float32 blobs
+            checkpoint (int): Highest document ID the rebuild is done with
+            failed (int): Documents of the batch that couldn't be embedded
+        
+        Returns:
+            int: Number of documents stored
+        """
+        with timed('db_insert_rebuild'), self._transaction() as cursor:
+            current = [
+                (document_id, text, blob, chunks) for document_id, text, blob, chunks in documents
+                if cursor.execute("SELECT 1 FROM document_texts WHERE document_id = ? AND document_text = ?",
+                                  (document_id, text)).fetchone()
+            ]
+            ids = [(document_id,) for document_id, *_ in current]
+            for table in REBUILD_TABLES.values():
+                cursor.executemany(f"DELETE FROM {table} WHERE document_id = ?", ids)
+            cursor.executemany(
+                f"INSERT INTO {REBUILD_TABLES['embeddings']} (document_id, embedding, dimension, dtype, model_name) "
+                f"VALUES (?, ?, ?, ?, ?)",
+                [(document_id, self._encode(blob), len(blob) // 4, self.vector_dtype, model_name)
+                 for document_id, _, blob, _ in current]
+            )
+            cursor.executemany(
+                f"INSERT INTO {REBUILD_TABLES['chunks']} "
+                f"(document_id, ordinal, start_char, end_char, embedding, dimension, dtype, model_name) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(document_id, ordinal, start, end, self._encode(blob), len(blob) // 4, self.vector_dtype, model_name)
+                 for document_id, _, _, chunks in current for ordinal, start, end, blob in chunks]
+            )
+            cursor.execute(
+                "UPDATE rebuilds SET checkpoint = MAX(checkpoint, COALESCE(?, checkpoint)), "
+                "documents_done = documents_done + ?, documents_failed = documents_failed + ?, updated_at = ? "
+                "WHERE id = ?",
+                (checkpoint, len(current), failed, time.time(), rebuild_id)
+            )
+        return len(current)
+    
+    def swap_rebuild(self, rebuild_id, skip_ids=()):
+        """Replace the live vector tables with the shadow tables of a finished rebuild
+        
+        The swap is one transaction: searches see either the old vectors or
+        all of the new ones. It doesn't happen while documents other than
+        skip_ids (those that failed to embed) still lack new vectors; those
+        keep their previous vectors, which are reported.
+        
+        Returns:
+            bool: Whether the tables were swapped
+        """
+        skip_ids = set(skip_ids)
+        with self._transaction() as cursor:
+            cursor.execute(f"""
+                SELECT d.id
+                FROM documents d
+                JOIN document_texts t ON t.document_id = d.id
+                WHERE t.document_text IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM {REBUILD_TABLES['embeddings']} e WHERE e.document_id = d.id)
+            """)
+            missing = [row[0] for row in cursor.fetchall()]
+            if any(doc_id not in skip_ids for doc_id in missing):
+                return False
+            
+            # Carry the failed documents' current vectors over rather than leave them unsearchable
+            for start in range(0, len(missing), MAX_PARAMETERS):
+                batch = missing[start:start + MAX_PARAMETERS]
+                placeholders = ','.join('?' * len(batch))
+                cursor.execute(f"""
+                    INSERT INTO {REBUILD_TABLES['embeddings']} (document_id, embedding, dimension, dtype, model_name)
+                    SELECT document_id, embedding, dimension, dtype, model_name
+                    FROM embeddings WHERE document_id IN ({placeholders})
+                """, batch)
+                cursor.execute(f"""
+                    INSERT INTO {REBUILD_TABLES['chunks']}
+                    (document_id, ordinal, start_char, end_char, embedding, dimension, dtype, model_name)
+                    SELECT document_id, ordinal, start_char, end_char, embedding, dimension, dtype, model_name
+                    FROM chunks WHERE document_id IN ({placeholders})
+                """, batch)
+            
+            for table, shadow in REBUILD_TABLES.items():
+                cursor.execute(f"DROP TABLE {table}")
+                cursor.execute(f"ALTER TABLE {shadow} RENAME TO {table}")
+            now = time.time()
+            cursor.execute("UPDATE rebuilds SET status = 'done', updated_at = ?, finished_at = ? WHERE id = ?",
+                           (now, now, rebuild_id))
+            self._bump_vector_version(cursor)
+        
+        self._notify('on_embeddings_replaced')
+        self._notify('on_changes_committed')
+        if missing:
+            print(f"Kept the previous embeddings of {len(missing)} documents that failed to re-embed "
+                  f"(IDs: {', '.join(map(str, sorted(missing)))})")
+        return True
+    
+    def create_job(self, kind, payload):
+        """Queue a background job and return its ID"""
+        with self._transaction() as cursor:
+            cursor.execute("INSERT INTO jobs (kind, payload) VALUES (?, ?)", (kind, json.dumps(payload)))
+            return cursor.lastrowid
+    
+    def get_job(self, job_id):
+        """Get a job as a dict, or None if it doesn't exist"""
+        cursor = self._read()
+        cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,))
+        row = cursor.fetchone()
+        
+        if row is None:
+            return None
+        job = dict(zip(JOB_COLUMNS, row))
+        job['payload'] = json.loads(job['payload'])
+        return job
+    
+    def claim_next_job(self):
+        """Mark the oldest queued job as running and return it, or None if the queue is empty"""
+        with self._transaction() as cursor:
+            cursor.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1")
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            
+            # The immediate transaction holds the write lock, so no other worker (or process) claims it too
+            now = time.time()
+            cursor.execute(
+                "UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?), updated_at = ? "
+                "WHERE id = ?",
+                (now, now, row[0])
+            )
+        return self.get_job(row[0])
+    
+    def update_job(self, job_id, **fields):
+        """Update job columns and refresh its heartbeat"""
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{column} = ?" for column in fields if column in JOB_COLUMNS)
+        
+        with self._transaction() as cursor:
+            cursor.execute(f"UPDATE jobs SET {assignments} WHERE id = ?",
+                           [value for column, value in fields.items() if column in JOB_COLUMNS] + [job_id])
+    
+    def requeue_stale_jobs(self, timeout):
+        """Put running jobs whose heartbeat is older than timeout seconds back in the queue"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND updated_at < ?",
+                (time.time() - timeout,)
+            )
+            return cursor.rowcount
 
 # Initialize the database when the module is imported
-db = Database()
\ No newline at end of file
+db = Database()
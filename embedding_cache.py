@@ -0,0 +1,198 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from database import db, BUSY_TIMEOUT, CONNECTION_PRAGMAS, MAX_PARAMETERS
+from metrics import EMBEDDING_CACHE_LOOKUPS
+
+# Most megabytes of embeddings the cache keeps before evicting the least recently used (0 disables it)
+EMBEDDING_CACHE_MB = float(os.environ.get('EMBEDDING_CACHE_MB', 1024))
+
+# Share of the limit freed by each eviction, so inserts don't evict a few rows at a time
+EVICTION_FRACTION = 0.1
+
+# Runs of whitespace are one separator to the tokenizer, so they're collapsed before hashing
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def text_hash(text):
+    """SHA-256 digest of text with its whitespace normalized"""
+    return hashlib.sha256(WHITESPACE_PATTERN.sub(' ', text).strip().encode('utf-8')).digest()
+
+class EmbeddingCache:
+    """Embeddings of texts embedded before, keyed by model configuration and text hash
+
+    The entries live in an SQLite file next to the database, so the server,
+    ingestion jobs and rebuilds share them. A configuration is a
+    (model_name, backend, pooling, max_length) tuple; any change to it misses.
+    Lookups refresh the entries' last use, and once the embeddings take more
+    than max_bytes the least recently used are evicted. Errors are reported
+    and treated as misses, so the cache never fails an ingestion.
+    """
+
+    def __init__(self, path, max_bytes=int(EMBEDDING_CACHE_MB * 1024 * 1024)):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._setup_lock = threading.Lock()
+        self._set_up = False
+        self._stats_lock = threading.Lock()
+        self._stored_bytes = None  # Estimate since the last eviction check; other processes write too
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _connection(self):
+        """This thread's connection, opening (and creating the file) on first use"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # Connections must not be shared with forked child processes
+            local.__dict__.clear()
+            local.pid = os.getpid()
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            if not self._set_up:
+                with self._setup_lock:
+                    if not self._set_up:
+                        self._setup(conn)
+        return conn
+
+    def _setup(self, conn):
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            model_name TEXT NOT NULL,
+            backend TEXT NOT NULL,
+            pooling TEXT NOT NULL,
+            max_length INTEGER NOT NULL,
+            text_hash BLOB NOT NULL,
+            embedding BLOB NOT NULL,
+            last_used REAL NOT NULL,
+            UNIQUE (model_name, backend, pooling, max_length, text_hash)
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache(last_used)")
+        self._set_up = True
+
+    def get_many(self, config, hashes):
+        """Cached float32 embeddings of the text hashes under config
+
+        Returns:
+            dict: text hash -> embedding, for the hashes found
+        """
+        found = {}
+        try:
+            conn = self._connection()
+            for start in range(0, len(hashes), MAX_PARAMETERS):
+                batch = hashes[start:start + MAX_PARAMETERS]
+                rows = conn.execute(f"""
+                    SELECT text_hash, embedding FROM embedding_cache
+                    WHERE model_name = ? AND backend = ? AND pooling = ? AND max_length = ?
+                    AND text_hash IN ({','.join('?' * len(batch))})
+                """, (*config, *batch)).fetchall()
+                found.update((bytes(digest), np.frombuffer(embedding, dtype=np.float32)) for digest, embedding in rows)
+            if found:
+                self._touch(conn, config, list(found))
+        except sqlite3.Error as e:
+            print(f"Embedding cache lookup failed: {str(e)}")
+        return found
+
+    def _touch(self, conn, config, hashes):
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for start in range(0, len(hashes), MAX_PARAMETERS):
+                batch = hashes[start:start + MAX_PARAMETERS]
+                conn.execute(f"""
+                    UPDATE embedding_cache SET last_used = ?
+                    WHERE model_name = ? AND backend = ? AND pooling = ? AND max_length = ?
+                    AND text_hash IN ({','.join('?' * len(batch))})
+                """, (now, *config, *batch))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def put_many(self, config, embeddings):
+        """Store embeddings ({text hash: float32 embedding}) under config, evicting if over the limit"""
+        if not embeddings:
+            return
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.executemany(
+                    "INSERT OR IGNORE INTO embedding_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(*config, digest, np.asarray(embedding, dtype=np.float32).tobytes(), now)
+                     for digest, embedding in embeddings.items()])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            added = max(cursor.rowcount, 0) * next(iter(embeddings.values())).size * 4
+            with self._stats_lock:
+                if self._stored_bytes is not None:
+                    self._stored_bytes += added
+                check = self._stored_bytes is None or self._stored_bytes > self.max_bytes
+            if check:
+                self._evict(conn)
+        except sqlite3.Error as e:
+            print(f"Embedding cache update failed: {str(e)}")
+
+    def _evict(self, conn):
+        """Delete the least recently used entries until the embeddings fit the limit, with some room to spare"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows, stored = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(embedding)), 0) FROM embedding_cache").fetchone()
+            target = self.max_bytes * (1 - EVICTION_FRACTION)
+            if stored > self.max_bytes:
+                excess = int(np.ceil((stored - target) / (stored / rows)))
+                conn.execute("""
+                    DELETE FROM embedding_cache WHERE rowid IN (
+                        SELECT rowid FROM embedding_cache ORDER BY last_used LIMIT ?
+                    )
+                """, (excess,))
+                stored -= excess * stored / rows
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with self._stats_lock:
+            self._stored_bytes = stored
+
+    def count(self, hits, misses):
+        with self._stats_lock:
+            self.hits += hits
+            self.misses += misses
+        EMBEDDING_CACHE_LOOKUPS.inc(hits, outcome='hit')
+        EMBEDDING_CACHE_LOOKUPS.inc(misses, outcome='miss')
+
+    def stats(self):
+        """Lookups served by this process so far"""
+        with self._stats_lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def summary(self, since):
+        """Hits and hit rate of the lookups made after stats() returned since"""
+        now = self.stats()
+        hits = now['hits'] - since['hits']
+        lookups = hits + now['misses'] - since['misses']
+        return f"{hits} of {lookups} chunks reused ({hits / lookups if lookups else 0:.1%} hit rate)"
+
+    def close(self):
+        conn = self._local.__dict__.pop('conn', None)
+        if conn is not None:
+            conn.close()
+
+# Shared by every embedder of this process, next to the database file
+embedding_cache = EmbeddingCache(f"{os.path.splitext(db.db_path)[0]}.embedding_cache.db")
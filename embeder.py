@@ -1,145 +1,531 @@
 import os
-import torch
-from transformers import BertModel, BertTokenizer
+import re
+import time
+import threading
 import numpy as np
-from tqdm import tqdm
 from database import db  # Import the database instance
-import docx  # Import for DOCX support
-import PyPDF2  # Import for PDF support
+from extractors import read_file_content, file_state, hash_file
+from pipeline import IngestionPipeline, DOCUMENTS_PER_ROUND
+from embedding_cache import embedding_cache, text_hash
+from metrics import timed
+
+DEFAULT_MODEL_NAME = os.environ.get('MODEL_NAME', 'bert-base-uncased')
+DEFAULT_MAX_LENGTH = int(os.environ.get('MAX_TOKEN_LENGTH', 512))
+
+# Token window and overlap used to split long documents into chunks
+DEFAULT_CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE', 256))
+DEFAULT_CHUNK_OVERLAP = int(os.environ.get('CHUNK_OVERLAP', 32))
+
+# Number of chunks per forward pass
+DEFAULT_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))
+
+# How token embeddings become a text embedding (part of the embedding cache key; change it with the pooling code)
+POOLING = 'mean'
+
+# Forward pass implementation: 'eager' (float32), 'int8' (dynamically quantized linear layers),
+# 'torchscript' (traced and frozen graph) or 'onnx' (exported graph run by onnxruntime)
+INFERENCE_BACKENDS = ('eager', 'int8', 'torchscript', 'onnx')
+DEFAULT_INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'eager')
+
+# Torch intra-op and inter-op thread pool sizes (also used by onnxruntime); 0 keeps the defaults
+TORCH_NUM_THREADS = int(os.environ.get('TORCH_NUM_THREADS', 0))
+TORCH_INTEROP_THREADS = int(os.environ.get('TORCH_INTEROP_THREADS', 0))
+
+# Where the onnx backend keeps exported models, one file per model name
+MODEL_EXPORT_DIR = os.environ.get('MODEL_EXPORT_DIR', 'exported_models')
+
+DEFAULT_FILE_EXTENSIONS = ['.txt', '.md', '.csv', '.json', '.html', '.docx', '.pdf', '.py', '']
+
+# Process-wide registry of loaded embedders, keyed by model name and inference backend
+_embedders = {}
+_embedders_lock = threading.Lock()
+_threads_configured = False
+
+def get_embedder(model_name=None, backend=None):
+    """Return the shared DocumentEmbedder for model_name, loading it on first use"""
+    if model_name is None:
+        model_name = DEFAULT_MODEL_NAME
+    if backend is None:
+        backend = DEFAULT_INFERENCE_BACKEND
+
+    key = (model_name, backend)
+    embedder = _embedders.get(key)
+    if embedder is None:
+        with _embedders_lock:
+            # Re-check under the lock so concurrent callers load the model only once
+            embedder = _embedders.get(key)
+            if embedder is None:
+                embedder = DocumentEmbedder(model_name, backend=backend)
+                _embedders[key] = embedder
+    return embedder
+
+def set_embedder(embedder, model_name=None, backend=None):
+    """Make get_embedder return embedder, e.g. a stub that needs no model, for benchmarks
+
+    Call it before the modules that share the embedder (app, jobs) are imported.
+    """
+    key = (model_name or DEFAULT_MODEL_NAME, backend or DEFAULT_INFERENCE_BACKEND)
+    with _embedders_lock:
+        _embedders[key] = embedder
+
+def configure_threads(num_threads=TORCH_NUM_THREADS, interop_threads=TORCH_INTEROP_THREADS):
+    """Size torch's thread pools; the inter-op pool can only be sized before its first use"""
+    import torch
+    
+    global _threads_configured
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if interop_threads > 0 and not _threads_configured:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            print("Could not set the inter-op thread count: torch already started its inter-op pool")
+    _threads_configured = True
+
+def _last_hidden_state(model):
+    """BertModel with tensor inputs and the last hidden state as its only output, for tracing and export"""
+    import torch
+    
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+        
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+    
+    return LastHiddenState()
+
+class EagerBackend:
+    """The model as loaded, in float32"""
+    name = 'eager'
+    
+    def __init__(self, model, device, model_name):
+        self.model = model.to(device)
+        self.device = device
+    
+    def __call__(self, input_ids, attention_mask):
+        """Last hidden state, (batch, tokens, hidden_size)"""
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+class Int8Backend(EagerBackend):
+    """Linear layers quantized to int8 weights, activations quantized on the fly (CPU only)"""
+    name = 'int8'
+    
+    def __init__(self, model, device, model_name):
+        import torch
+        
+        quantize_dynamic = getattr(torch, 'ao', torch).quantization.quantize_dynamic
+        model = quantize_dynamic(model.to('cpu'), {torch.nn.Linear}, dtype=torch.qint8)
+        super().__init__(model, torch.device('cpu'), model_name)
+
+class TorchScriptBackend(EagerBackend):
+    """The model traced into a frozen TorchScript graph"""
+    name = 'torchscript'
+    
+    def __init__(self, model, device, model_name):
+        import torch
+        
+        super().__init__(model, device, model_name)
+        example = (torch.ones((2, 16), dtype=torch.long, device=device),
+                   torch.ones((2, 16), dtype=torch.long, device=device))
+        with torch.inference_mode(False), torch.no_grad():
+            traced = torch.jit.trace(_last_hidden_state(self.model), example, strict=False)
+        self.graph = torch.jit.freeze(traced.eval())
+    
+    def __call__(self, input_ids, attention_mask):
+        return self.graph(input_ids, attention_mask)
+
+class OnnxBackend:
+    """The model exported to ONNX and run by onnxruntime on the CPU"""
+    name = 'onnx'
+    
+    def __init__(self, model, device, model_name):
+        import torch
+        import onnxruntime  # Optional dependency: the caller falls back to eager without it
+        
+        self.model = model
+        self.device = torch.device('cpu')
+        path = os.path.join(MODEL_EXPORT_DIR, re.sub(r'[^\w.-]+', '_', model_name).strip('_') + '.onnx')
+        if not os.path.exists(path):
+            self._export(model.to('cpu'), path)
+        
+        options = onnxruntime.SessionOptions()
+        if TORCH_NUM_THREADS > 0:
+            options.intra_op_num_threads = TORCH_NUM_THREADS
+        if TORCH_INTEROP_THREADS > 0:
+            options.inter_op_num_threads = TORCH_INTEROP_THREADS
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    
+    @staticmethod
+    def _export(model, path):
+        import torch
+        
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        example = (torch.ones((2, 16), dtype=torch.long), torch.ones((2, 16), dtype=torch.long))
+        tmp_path = f"{path}.tmp"
+        dynamic_axes = {'input_ids': {0: 'batch', 1: 'tokens'}, 'attention_mask': {0: 'batch', 1: 'tokens'},
+                        'last_hidden_state': {0: 'batch', 1: 'tokens'}}
+        with torch.inference_mode(False), torch.no_grad():
+            torch.onnx.export(_last_hidden_state(model), example, tmp_path,
+                              input_names=['input_ids', 'attention_mask'], output_names=['last_hidden_state'],
+                              dynamic_axes=dynamic_axes, opset_version=17, dynamo=False)
+        os.replace(tmp_path, path)
+        print(f"Exported {path}")
+    
+    def __call__(self, input_ids, attention_mask):
+        import torch
+        
+        (hidden,) = self.session.run(['last_hidden_state'], {
+            'input_ids': input_ids.cpu().numpy(),
+            'attention_mask': attention_mask.cpu().numpy()
+        })
+        return torch.from_numpy(hidden)
+
+_BACKEND_CLASSES = {backend.name: backend for backend in (EagerBackend, Int8Backend, TorchScriptBackend, OnnxBackend)}
+
+def load_backend(name, model, device, model_name):
+    """Wrap model in the named backend, falling back to eager if its runtime is missing here"""
+    if name not in _BACKEND_CLASSES:
+        raise ValueError(f"Unknown inference backend {name!r}, expected one of {', '.join(INFERENCE_BACKENDS)}")
+    try:
+        return _BACKEND_CLASSES[name](model, device, model_name)
+    except (ImportError, RuntimeError) as e:
+        if name == 'eager':
+            raise
+        print(f"Inference backend {name} is unavailable ({e}), using eager")
+        return EagerBackend(model, device, model_name)
 
 class DocumentEmbedder:
-    def __init__(self, model_name='bert-base-uncased'):
-        # Initialize BERT model and tokenizer
-        self.tokenizer = BertTokenizer.from_pretrained(model_name)
-        self.model = BertModel.from_pretrained(model_name)
-        self.model.eval()  # Set model to evaluation mode
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, max_length=DEFAULT_MAX_LENGTH,
+                 chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP,
+                 backend=DEFAULT_INFERENCE_BACKEND, cache=embedding_cache):
+        # Chunks must fit in the model input next to the [CLS] and [SEP] tokens
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        self.model_name = model_name
+        self.max_length = max_length
+        self.chunk_size = min(chunk_size, max_length - 2)
+        self.chunk_overlap = chunk_overlap
+        self.backend_name = backend
+        # Chunk embeddings computed before, by this or another process (None to always run the model)
+        self.cache = cache
         
-        # Check if CUDA is available
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.model.to(self.device)
+        # The model is loaded on first use (or by load()), so creating an embedder is cheap
+        self._tokenizer = None
+        self._backend = None
+        self._load_lock = threading.Lock()
+    
+    @property
+    def loaded(self):
+        return self._backend is not None
+    
+    def load(self):
+        """Load the tokenizer and model now instead of on first use (safe to call more than once)"""
+        if self._backend is None:
+            with self._load_lock:
+                if self._backend is None:
+                    self._load()
+        return self
+    
+    def _load(self):
+        start = time.perf_counter()
+        import torch
+        from transformers import BertModel, BertTokenizerFast
+        
+        configure_threads()
+        
+        # Initialize BERT model and tokenizer (the fast tokenizer provides character offsets)
+        self._tokenizer = BertTokenizerFast.from_pretrained(self.model_name)
+        model = BertModel.from_pretrained(self.model_name)
+        model.eval()  # Set model to evaluation mode
+        self._hidden_size = model.config.hidden_size
+        
+        # Check if CUDA is available; backends other than eager and torchscript run on the CPU
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self._backend = load_backend(self.backend_name, model, device, self.model_name)
+        print(f"Loaded {self.model_name} ({self._backend.name} backend) in {time.perf_counter() - start:.1f} s")
+    
+    @property
+    def tokenizer(self):
+        return self.load()._tokenizer
+    
+    @property
+    def backend(self):
+        return self.load()._backend
+    
+    @property
+    def model(self):
+        return self.backend.model
+    
+    @property
+    def device(self):
+        return self.backend.device
+    
+    @property
+    def hidden_size(self):
+        return self.load()._hidden_size
+    
+    @property
+    def cache_config(self):
+        """Everything besides the text that determines an embedding, the embedding cache's key prefix"""
+        return (self.model_name, self.backend_name, POOLING, self.max_length)
+    
+    def warmup(self):
+        """Load the model and run one forward pass, so the first real query doesn't pay for either"""
+        self.load()
+        self.generate_embeddings(["warmup"])
     
     def generate_embedding(self, text):
         """Generate BERT embedding for a given text"""
-        # Tokenize text
-        inputs = self.tokenizer(text, return_tensors='pt', 
-                               padding=True, truncation=True, max_length=512)
-        inputs = {key: val.to(self.device) for key, val in inputs.items()}
+        return self.generate_embeddings([text], batch_size=1)[0]
+    
+    def generate_embeddings(self, texts, batch_size=DEFAULT_BATCH_SIZE):
+        """Generate BERT embeddings for many texts with batched forward passes
         
-        # Generate embeddings
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+        Texts are tokenized in one call and sorted by token length, so each
+        batch holds similarly sized inputs and little compute goes to padding.
         
-        # Instead of just using the [CLS] token, average all token embeddings
-        # This generally produces better results for document similarity
-        token_embeddings = outputs.last_hidden_state
+        Returns:
+            np.ndarray: (len(texts), hidden_size) float32 matrix of unit-length embeddings
+        """
+        import torch
         
-        # Create attention mask to properly handle padding
-        attention_mask = inputs['attention_mask']
+        hidden_size = self.hidden_size
+        if not texts:
+            return np.empty((0, hidden_size), dtype=np.float32)
         
-        # Expand attention mask to same dimensions as token_embeddings
-        input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
+        # Tokenize everything at once without padding; each batch is padded separately
+        with timed('tokenize'):
+            input_ids = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)['input_ids']
+        order = np.argsort([len(ids) for ids in input_ids], kind='stable')
         
-        # Sum the embeddings of tokens with actual content (not padding)
-        sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1)
-        sum_mask = torch.sum(input_mask_expanded, 1)
+        embeddings = np.empty((len(texts), hidden_size), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            inputs = self.tokenizer.pad({'input_ids': [input_ids[i] for i in batch]}, return_tensors='pt')
+            inputs = {key: val.to(self.device) for key, val in inputs.items()}
+            
+            # Generate embeddings
+            with timed('forward'), torch.inference_mode():
+                # Instead of just using the [CLS] token, average all token embeddings
+                # This generally produces better results for document similarity
+                token_embeddings = self.backend(inputs['input_ids'], inputs['attention_mask'])
+                
+                # Expand attention mask to same dimensions as token_embeddings to ignore padding
+                input_mask_expanded = inputs['attention_mask'].unsqueeze(-1).expand(token_embeddings.size()).float()
+                
+                # Average the embeddings of tokens with actual content (not padding)
+                sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1)
+                sum_mask = torch.clamp(torch.sum(input_mask_expanded, 1), min=1e-9)
+                embeddings[batch] = (sum_embeddings / sum_mask).cpu().numpy()
         
-        # Average the embeddings
-        pooled_embeddings = sum_embeddings / sum_mask
+        # Explicitly normalize to unit length (important for cosine similarity)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+    
+    def _cached_embeddings(self, texts, batch_size=DEFAULT_BATCH_SIZE):
+        """generate_embeddings for document chunks, only running the model on texts the cache doesn't have
         
-        # Convert to numpy and normalize
-        embedding = pooled_embeddings.cpu().numpy()[0]
+        Repeated texts (copies of a file, chunks unchanged since the last
+        ingestion or rebuild) are embedded once.
+        """
+        cache = self.cache
+        if cache is None or not cache.enabled or not texts:
+            return self.generate_embeddings(texts, batch_size=batch_size)
         
-        # Explicitly normalize to unit length (important for cosine similarity)
-        embedding = embedding / np.linalg.norm(embedding)
+        config = self.cache_config
+        hashes = [text_hash(text) for text in texts]
+        with timed('cache_lookup'):
+            embeddings = cache.get_many(config, list(set(hashes)))
+        missing = {}  # text hash -> first text with it
+        for digest, text in zip(hashes, texts):
+            if digest not in embeddings:
+                missing.setdefault(digest, text)
+        
+        if missing:
+            generated = dict(zip(missing, self.generate_embeddings(list(missing.values()), batch_size=batch_size)))
+            cache.put_many(config, generated)
+            embeddings.update(generated)
+        cache.count(hits=len(texts) - len(missing), misses=len(missing))
+        return np.stack([embeddings[digest] for digest in hashes])
+    
+    def _chunk_spans(self, offsets, text_length):
+        """Turn token character offsets into overlapping (start_char, end_char) windows"""
+        if not offsets:
+            return [(0, text_length)]
+        
+        spans = []
+        stride = self.chunk_size - self.chunk_overlap
+        for first in range(0, len(offsets), stride):
+            last = min(first + self.chunk_size, len(offsets)) - 1
+            spans.append((offsets[first][0], offsets[last][1]))
+            if last == len(offsets) - 1:
+                break
+        return spans
+    
+    def chunk_texts(self, texts):
+        """Split texts into overlapping token windows
+
+        Returns one list of (start_char, end_char) spans per text.
+        """
+        with timed('chunk'):
+            encodings = self.tokenizer(list(texts), add_special_tokens=False, return_offsets_mapping=True,
+                                       truncation=False, verbose=False)
+        return [self._chunk_spans(offsets, len(text))
+                for text, offsets in zip(texts, encodings['offset_mapping'])]
+    
+    def chunk_text(self, text):
+        """Split text into overlapping token windows"""
+        return self.chunk_texts([text])[0]
+    
+    def embed_documents(self, texts, batch_size=DEFAULT_BATCH_SIZE):
+        """Embed documents chunk by chunk, batching the chunks of all documents together
+        
+        Returns:
+            list: one (document_embedding, chunks) tuple per text, where chunks is a
+                list of (ordinal, start_char, end_char, embedding) and the document
+                embedding is the normalized mean of the chunk embeddings
+        """
+        spans = self.chunk_texts(texts)
+        chunk_texts = [text[start:end] for text, text_spans in zip(texts, spans) for start, end in text_spans]
+        chunk_embeddings = self._cached_embeddings(chunk_texts, batch_size=batch_size)
+        
+        results = []
+        offset = 0
+        for text_spans in spans:
+            embeddings = chunk_embeddings[offset:offset + len(text_spans)]
+            offset += len(text_spans)
+            
+            document_embedding = embeddings.mean(axis=0)
+            document_embedding = document_embedding / np.linalg.norm(document_embedding)
+            chunks = [(ordinal, start, end, embeddings[ordinal])
+                      for ordinal, (start, end) in enumerate(text_spans)]
+            results.append((document_embedding.astype(np.float32), chunks))
+        return results
+    
+    def embed_document(self, text):
+        """Embed a document chunk by chunk"""
+        return self.embed_documents([text])[0]
+    
+    def store_documents(self, documents, batch_size=DEFAULT_BATCH_SIZE):
+        """Embed file contents and store them with their embeddings in one transaction
+        
+        Args:
+            documents (list): (file_path, document_text, file_size, file_mtime, content_hash) tuples
         
-        return embedding
+        Returns:
+            list: Document IDs, in the order of documents
+        """
+        embedded = self.embed_documents([document[1] for document in documents], batch_size=batch_size)
+        return db.store_documents_bulk([
+            document + (document_embedding.tobytes(),
+                        [(ordinal, start, end, embedding.tobytes()) for ordinal, start, end, embedding in chunks])
+            for document, (document_embedding, chunks) in zip(documents, embedded)
+        ], model_name=self.model_name)
     
     def read_file_content(self, file_path):
         """Read content from various file formats"""
-        file_extension = os.path.splitext(file_path)[1].lower()
+        return read_file_content(file_path)
+    
+    def process_documents(self, file_paths):
+        """Process document files, embedding their chunks in shared batches
         
-        try:
-            # Process text files (including .py files)
-            if file_extension in ['.txt', '.md', '.csv', '.json', '.html', '.py', ''] or file_path.endswith('/'):
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    return file.read()
-                    
-            # Process DOCX files
-            elif file_extension == '.docx':
-                doc = docx.Document(file_path)
-                full_text = []
-                for para in doc.paragraphs:
-                    full_text.append(para.text)
-                return '\n'.join(full_text)
+        Files whose content hash matches the stored document are not re-embedded.
+        A file is only recorded together with its embeddings, so one that fails
+        is tried again next time.
+        
+        Returns:
+            int: Number of documents stored (or found unchanged) successfully
+        """
+        documents = []
+        unchanged = 0
+        for file_path in file_paths:
+            try:
+                file_size, file_mtime = file_state(file_path)
+                content_hash = hash_file(file_path)
+                known = db.get_file_state(file_path)
+                if known is not None and known[3] == content_hash:
+                    db.update_file_state(known[0], file_size, file_mtime)
+                    unchanged += 1
+                    continue
                 
-            # Process PDF files
-            elif file_extension == '.pdf':
-                text = ""
-                with open(file_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    for page_num in range(len(pdf_reader.pages)):
-                        page = pdf_reader.pages[page_num]
-                        text += page.extract_text()
-                return text
+                # Read the document using the appropriate method based on file type
+                document_text = self.read_file_content(file_path)
                 
-            else:
-                print(f"Unsupported file extension: {file_extension}")
-                return None
+                if document_text is None or document_text.strip() == "":
+                    print(f"No content extracted from {file_path}")
+                    continue
                 
+                documents.append((file_path, document_text, file_size, file_mtime, content_hash))
+            
+            except Exception as e:
+                print(f"Error processing {file_path}: {str(e)}")
+        
+        if not documents:
+            return unchanged
+        
+        try:
+            # Generate the chunk and document embeddings and store them with the documents
+            self.store_documents(documents)
+            return unchanged + len(documents)
         except Exception as e:
-            print(f"Error reading file {file_path}: {str(e)}")
-            return None
+            print(f"Error embedding batch of {len(documents)} documents: {str(e)}")
+        
+        # Fall back to one document at a time so a single bad input doesn't fail the batch
+        stored = unchanged
+        for document in documents:
+            try:
+                self.store_documents([document])
+                stored += 1
+            except Exception as e:
+                print(f"Error embedding {document[0]}: {str(e)}")
+        return stored
     
     def process_document(self, file_path):
         """Process a document file and store its embedding"""
-        try:
-            # Read the document using the appropriate method based on file type
-            document_text = self.read_file_content(file_path)
-            
-            if document_text is None or document_text.strip() == "":
-                print(f"No content extracted from {file_path}")
-                return False
-            
-            # Store document in database and get its ID
-            document_id = db.insert_document(file_path, document_text)
-            
-            # Generate embedding
-            embedding = self.generate_embedding(document_text)
-            
-            # Convert numpy array to binary blob for storage
-            embedding_blob = embedding.tobytes()
-            
-            # Store embedding in the database
-            db.insert_embedding(document_id, embedding_blob)
-            
-            return True
-            
-        except Exception as e:
-            print(f"Error processing {file_path}: {str(e)}")
-            return False
+        return self.process_documents([file_path]) == 1
     
-    def process_directory(self, directory_path, file_extensions=None):
-        """Process all documents in a directory"""
+    def iter_directory_files(self, directory_path, file_extensions=None):
+        """Yield the files of a directory tree that match file_extensions, in a stable order"""
         if file_extensions is None:
-            file_extensions = ['.txt', '.md', '.csv', '.json', '.html', '.docx', '.pdf', '.py', '']
-            
-        processed_count = 0
-        failed_count = 0
+            file_extensions = DEFAULT_FILE_EXTENSIONS
         
-        for root, _, files in os.walk(directory_path):
-            for file in files:
-                file_path = os.path.join(root, file)
+        for root, dirs, files in os.walk(directory_path):
+            # Sort so that an interrupted walk can be resumed by position
+            dirs.sort()
+            for file in sorted(files):
                 file_ext = os.path.splitext(file)[1].lower()
                 
                 # Process files with matching extensions or files with no extension
                 if file_ext in file_extensions or ('' in file_extensions and file_ext == ''):
-                    print(f"Processing: {file_path}")
-                    
-                    success = self.process_document(file_path)
-                    if success:
-                        processed_count += 1
-                    else:
-                        failed_count += 1
+                    yield os.path.join(root, file)
+    
+    def process_directory(self, directory_path, file_extensions=None, incremental=True, purge_missing=False):
+        """Process all documents in a directory
+        
+        Args:
+            incremental (bool): Skip files that haven't changed since they were last processed
+            purge_missing (bool): Delete documents under the directory whose files no longer exist
+        """
+        known = db.get_file_states(directory_path) if incremental or purge_missing else {}
+        cache_before = self.cache.stats() if self.cache is not None else None
+        pipeline = IngestionPipeline(self, db)
+        processed_count, failed_count, skipped_count = pipeline.run(
+            self.iter_directory_files(directory_path, file_extensions),
+            known=known if incremental else None
+        )
+        purged_count = pipeline.purge_missing(known, pipeline.seen_paths) if purge_missing else 0
         
         print(f"Processing complete. Successfully processed {processed_count} documents.")
-        print(f"Failed to process {failed_count} documents.")
\ No newline at end of file
+        print(f"Skipped {skipped_count} unchanged documents.")
+        print(f"Failed to process {failed_count} documents.")
+        if purge_missing:
+            print(f"Purged {purged_count} documents whose files were deleted.")
+        for stage, counters in pipeline.stats.snapshot()['stages'].items():
+            print(f"  {stage:>7}: {counters['items']} items, {counters['failed']} failed, "
+                  f"{counters['items_per_sec']:.1f} items/sec")
+        if cache_before is not None and self.cache.enabled:
+            print(f"Embedding cache: {self.cache.summary(cache_before)}.")
+        return processed_count, failed_count
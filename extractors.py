@@ -0,0 +1,62 @@
+import os
+import hashlib
+
+# Extensions read as plain UTF-8 text
+TEXT_EXTENSIONS = ['.txt', '.md', '.csv', '.json', '.html', '.py', '']
+
+def file_state(file_path):
+    """Get (size, mtime in nanoseconds) of a file, used to skip unchanged files cheaply"""
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def hash_file(file_path, block_size=1 << 20):
+    """SHA-256 hex digest of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_file_content(file_path):
+    """Read content from various file formats
+    
+    Kept free of model imports so it can run in extraction worker processes;
+    the DOCX and PDF parsers are only imported once such a file is read.
+    """
+    file_extension = os.path.splitext(file_path)[1].lower()
+    
+    try:
+        # Process text files (including .py files)
+        if file_extension in TEXT_EXTENSIONS or file_path.endswith('/'):
+            with open(file_path, 'r', encoding='utf-8') as file:
+                return file.read()
+                
+        # Process DOCX files
+        elif file_extension == '.docx':
+            import docx  # Import for DOCX support
+            
+            doc = docx.Document(file_path)
+            full_text = []
+            for para in doc.paragraphs:
+                full_text.append(para.text)
+            return '\n'.join(full_text)
+            
+        # Process PDF files
+        elif file_extension == '.pdf':
+            import PyPDF2  # Import for PDF support
+            
+            pages = []
+            with open(file_path, 'rb') as file:
+                pdf_reader = PyPDF2.PdfReader(file)
+                for page in pdf_reader.pages:
+                    pages.append(page.extract_text())
+            # Join once instead of growing a string page by page
+            return ''.join(pages)
+            
+        else:
+            print(f"Unsupported file extension: {file_extension}")
+            return None
+            
+    except Exception as e:
+        print(f"Error reading file {file_path}: {str(e)}")
+        return None
@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+import logging
+from database import db  # Import the database instance
+from embeder import get_embedder
+from pipeline import IngestionPipeline
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = int(os.environ.get('INGEST_WORKERS', 1))
+
+# Running jobs without a heartbeat for this long are assumed orphaned by a crash
+STALE_JOB_TIMEOUT = 300
+POLL_INTERVAL = 5
+
+# Seconds between the heartbeats of a running job, however long its rounds or upload take
+HEARTBEAT_INTERVAL = 60
+
+class JobQueue:
+    """Background ingestion workers that drain the persistent jobs table
+
+    Jobs are rows in the jobs table, so they survive a restart: queued jobs
+    are picked up again and running jobs whose worker died are re-queued and
+    resume from their last checkpoint.
+    """
+
+    def __init__(self, store=None, embeder=None, workers=DEFAULT_WORKERS):
+        self.store = store if store is not None else db
+        self._embeder = embeder
+        self.workers = workers
+        self._threads = []
+        self._pipelines = {}  # job id -> IngestionPipeline of running directory jobs
+        self._wakeup = threading.Condition()
+        self._start_lock = threading.Lock()
+
+    @property
+    def embeder(self):
+        if self._embeder is None:
+            self._embeder = get_embedder()
+        return self._embeder
+
+    def start(self):
+        """Start the worker threads (safe to call more than once)"""
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"ingest-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _enqueue(self, kind, payload):
+        job_id = self.store.create_job(kind, payload)
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def enqueue_upload(self, file_path):
+        """Queue ingestion of a single uploaded file and return the job ID"""
+        return self._enqueue('upload', {'file_path': file_path})
+
+    def enqueue_directory(self, directory_path, file_extensions=None, incremental=True, purge_missing=False):
+        """Queue ingestion of a directory tree and return the job ID"""
+        return self._enqueue('directory', {
+            'directory_path': directory_path,
+            'file_extensions': file_extensions,
+            'incremental': incremental,
+            'purge_missing': purge_missing
+        })
+
+    def get_status(self, job_id):
+        """Get a job's progress, including its ingestion rate, or None if it doesn't exist"""
+        job = self.store.get_job(job_id)
+        if job is None:
+            return None
+
+        elapsed = None
+        if job['started_at'] is not None:
+            end = job['finished_at'] or (time.time() if job['status'] == 'running' else job['updated_at'])
+            elapsed = max(end - job['started_at'], 0.0)
+        job['elapsed_seconds'] = elapsed
+        job['docs_per_sec'] = job['files_done'] / elapsed if elapsed else 0.0
+
+        pipeline = self._pipelines.get(job_id)
+        if pipeline is not None:
+            job['pipeline'] = pipeline.stats.snapshot()
+        return job
+
+    def _worker(self):
+        while True:
+            try:
+                self.store.requeue_stale_jobs(STALE_JOB_TIMEOUT)
+                job = self.store.claim_next_job()
+            except Exception as e:
+                logger.error(f"Error polling job queue: {str(e)}")
+                job = None
+
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(POLL_INTERVAL)
+                continue
+
+            self._run_job(job)
+
+    def _heartbeat(self, job_id, stopped):
+        """Keep refreshing a running job's updated_at so no worker takes it for orphaned"""
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.store.update_job(job_id)
+            except Exception as e:
+                logger.error(f"Error refreshing the heartbeat of job {job_id}: {str(e)}")
+
+    def _run_job(self, job):
+        logger.info(f"Starting {job['kind']} job {job['id']}: {job['payload']}")
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job['id'], stopped),
+                                     name=f"job-heartbeat-{job['id']}", daemon=True)
+        heartbeat.start()
+        try:
+            self._run_job_kind(job)
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+    def _run_job_kind(self, job):
+        try:
+            if job['kind'] == 'upload':
+                self._run_upload(job)
+            elif job['kind'] == 'directory':
+                self._run_directory(job)
+            else:
+                raise ValueError(f"Unknown job kind: {job['kind']}")
+            self.store.update_job(job['id'], status='done', finished_at=time.time())
+            logger.info(f"Finished job {job['id']}")
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {str(e)}")
+            self.store.update_job(job['id'], status='failed', error=str(e), finished_at=time.time())
+
+    def _run_upload(self, job):
+        stored = self.embeder.process_documents([job['payload']['file_path']])
+        self.store.update_job(job['id'], files_seen=1, files_done=stored, files_failed=1 - stored, checkpoint=1)
+
+    def _run_directory(self, job):
+        payload = job['payload']
+        if not os.path.isdir(payload['directory_path']):
+            raise ValueError(f"Invalid directory path: {payload['directory_path']}")
+
+        incremental = payload.get('incremental', True)
+        purge_missing = payload.get('purge_missing', False)
+        known = self.store.get_file_states(payload['directory_path']) if incremental or purge_missing else {}
+
+        # Files before the checkpoint were handled by an earlier, interrupted run
+        skip = job['checkpoint']
+        seen = skip
+        present = set()
+
+        def remaining_files():
+            nonlocal seen
+            files = self.embeder.iter_directory_files(payload['directory_path'], payload['file_extensions'])
+            for position, file_path in enumerate(files):
+                present.add(file_path)
+                if position >= skip:
+                    seen += 1
+                    yield file_path
+
+        checkpoint = skip
+        done, failed, skipped = job['files_done'], job['files_failed'], job['files_skipped'] or 0
+
+        def progress(files_in_round, processed_total, failed_total, skipped_total):
+            nonlocal checkpoint
+            checkpoint += files_in_round
+            self.store.update_job(job['id'], files_seen=seen, files_done=done + processed_total,
+                                  files_failed=failed + failed_total, files_skipped=skipped + skipped_total,
+                                  checkpoint=checkpoint)
+
+        pipeline = IngestionPipeline(self.embeder, self.store)
+        self._pipelines[job['id']] = pipeline
+        try:
+            pipeline.run(remaining_files(), progress=progress, known=known if incremental else None)
+            if purge_missing:
+                purged = pipeline.purge_missing(known, present)
+                logger.info(f"Job {job['id']} purged {purged} documents whose files were deleted")
+        finally:
+            self._pipelines.pop(job['id'], None)
+        self.store.update_job(job['id'], files_seen=seen)
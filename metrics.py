@@ -0,0 +1,221 @@
+import os
+import re
+import time
+import random
+import bisect
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Sampling profiler: this share of requests runs under cProfile, and the stats of those
+# slower than PROFILE_SLOW_SECONDS are written to PROFILE_DIR. A threshold of 0 disables it.
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', 0))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Monotonic counter with one series per label combination"""
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(self._values.items())]
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per label combination"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        samples = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((f'{self.name}_bucket', _format_labels(self.labels, key, [('le', le)]), cumulative))
+            samples.append((f'{self.name}_sum', _format_labels(self.labels, key), total))
+            samples.append((f'{self.name}_count', _format_labels(self.labels, key), cumulative))
+        return samples
+
+class Registry:
+    """The metrics exposed by /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, description, labels=()):
+        metric = Counter(name, description, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, description, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {value}' for name, labels, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    'ragfus_stage_seconds', 'Time spent in each search and ingestion stage', ('stage', 'file_type'))
+REQUEST_SECONDS = registry.histogram(
+    'ragfus_request_seconds', 'HTTP request handling time', ('endpoint',))
+REQUESTS = registry.counter(
+    'ragfus_requests_total', 'HTTP requests handled', ('endpoint', 'status'))
+FILES = registry.counter(
+    'ragfus_ingested_files_total', 'Files seen by ingestion, by outcome', ('file_type', 'status'))
+EMBEDDING_CACHE_LOOKUPS = registry.counter(
+    'ragfus_embedding_cache_lookups_total', 'Chunk texts looked up in the embedding cache, by outcome', ('outcome',))
+QUERY_BATCHES = registry.histogram(
+    'ragfus_query_batch_size', 'Distinct queries per coalesced embedding forward pass',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+# Stage durations of the request being handled, for its X-Timing breakdown
+_request_stages = contextvars.ContextVar('request_stages', default=None)
+
+# cProfile can only profile one request at a time
+_profile_lock = threading.Lock()
+
+def record(stage, seconds, file_type=''):
+    """Add one duration to a stage's histogram (and to the current request's breakdown)"""
+    STAGE_SECONDS.observe(seconds, stage=stage, file_type=file_type)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+def current_stages():
+    """The stage breakdown being collected in this context, None outside a timed request"""
+    return _request_stages.get()
+
+@contextmanager
+def collect_stages(stages):
+    """Add the durations recorded by the enclosed block to stages, a dict of stage -> seconds
+
+    For work done outside the request's own context, such as the query
+    batcher's forward passes or a response streamed after the request's
+    timer stopped.
+    """
+    token = _request_stages.set(stages)
+    try:
+        yield stages
+    finally:
+        _request_stages.reset(token)
+
+def format_timing(stages, total):
+    """X-Timing value: milliseconds per stage, then the total"""
+    parts = [f"{stage}={seconds * 1000:.2f}ms" for stage, seconds in stages.items()]
+    parts.append(f"total={total * 1000:.2f}ms")
+    return ', '.join(parts)
+
+@contextmanager
+def timed(stage, file_type=''):
+    """Time the enclosed block (or, used as a decorator, each call) as one observation of stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, file_type)
+
+class RequestTimer:
+    """Times one HTTP request, collects its per-stage breakdown and maybe profiles it
+
+    Call start() and stop() on the thread handling the request.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = {}
+        self.seconds = None
+        self._token = None
+        self._profiler = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._token = _request_stages.set(self.stages)
+        if (PROFILE_SLOW_SECONDS > 0 and random.random() < PROFILE_SAMPLE_RATE
+                and _profile_lock.acquire(blocking=False)):
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # Another profiler (e.g. a debugger) is active
+                self._profiler = None
+                _profile_lock.release()
+
+    def stop(self, status):
+        self.seconds = time.perf_counter() - self._start
+        _request_stages.reset(self._token)
+        REQUEST_SECONDS.observe(self.seconds, endpoint=self.endpoint)
+        REQUESTS.inc(endpoint=self.endpoint, status=status)
+        if self._profiler is not None:
+            self._profiler.disable()
+            try:
+                if self.seconds >= PROFILE_SLOW_SECONDS:
+                    self._dump_profile()
+            finally:
+                self._profiler = None
+                _profile_lock.release()
+
+    def _dump_profile(self):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        endpoint = re.sub(r'[^\w-]+', '_', self.endpoint).strip('_') or 'root'
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{int(self.seconds * 1000)}ms.prof"
+        path = os.path.join(PROFILE_DIR, name)
+        self._profiler.dump_stats(path)
+        print(f"Slow request to {self.endpoint} ({self.seconds:.3f} s) profiled to {path}")
+
+    def header(self):
+        """X-Timing value: milliseconds per stage, then the total"""
+        total = self.seconds if self.seconds is not None else time.perf_counter() - self._start
+        return format_timing(self.stages, total)
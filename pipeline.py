@@ -0,0 +1,326 @@
+import os
+import queue
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from database import db  # Import the database instance
+from extractors import read_file_content, file_state, hash_file
+from metrics import record, FILES
+
+# Documents gathered per embedding round (their chunks share forward passes)
+DOCUMENTS_PER_ROUND = 16
+
+DEFAULT_EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+
+# Files extracted ahead of the embedding stage; bounds memory however big the tree is
+DEFAULT_QUEUE_SIZE = 64
+
+STAGES = ('walk', 'skip', 'extract', 'embed', 'write')
+
+# Unchanged files are passed along in rounds of up to this many files
+MAX_ROUND_FILES = 512
+
+_DONE = object()
+
+class _Item:
+    """A file moving through the pipeline"""
+    __slots__ = ('file_path', 'size', 'mtime', 'known', 'future', 'text', 'content_hash', 'status', 'result')
+
+    def __init__(self, file_path, size=None, mtime=None, known=None):
+        self.file_path = file_path
+        self.size = size
+        self.mtime = mtime
+        self.known = known  # (id, file_size, file_mtime, content_hash) already stored, or None
+        self.future = None
+        self.text = None
+        self.content_hash = None
+        self.status = 'pending'  # pending -> unchanged | failed | embedded
+        self.result = None
+
+def _extract(file_path):
+    """Runs in an extraction worker process"""
+    start = time.perf_counter()
+    content_hash = hash_file(file_path)
+    text = read_file_content(file_path)
+    return text, content_hash, time.perf_counter() - start
+
+class PipelineStats:
+    """Thread-safe per-stage item, failure and busy-time counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self._stages = {stage: {'items': 0, 'failed': 0, 'busy_seconds': 0.0} for stage in STAGES}
+
+    def record(self, stage, items=0, failed=0, seconds=0.0):
+        with self._lock:
+            counters = self._stages[stage]
+            counters['items'] += items
+            counters['failed'] += failed
+            counters['busy_seconds'] += seconds
+
+    def snapshot(self):
+        """Counters per stage, with throughput over wall time and over the stage's busy time"""
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        with self._lock:
+            stages = {}
+            for stage, counters in self._stages.items():
+                busy = counters['busy_seconds']
+                stages[stage] = dict(counters,
+                                     items_per_sec=counters['items'] / elapsed,
+                                     items_per_busy_sec=counters['items'] / busy if busy else None)
+        return {'elapsed_seconds': elapsed, 'stages': stages}
+
+class IngestionPipeline:
+    """Streaming ingestion: walk -> extraction process pool -> batched embedding -> DB writer
+
+    Text extraction runs in worker processes so PDF parsing doesn't hold the
+    GIL the model needs. They are spawned, so a script that ingests must
+    guard its entry point with if __name__ == '__main__'. The stages are connected by bounded queues and
+    documents stay in walk order, so progress can be checkpointed by position.
+    """
+
+    def __init__(self, embeder, store=None, extract_workers=DEFAULT_EXTRACT_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE, batch_size=DOCUMENTS_PER_ROUND):
+        self.embeder = embeder
+        self.store = store if store is not None else db
+        self.extract_workers = max(1, extract_workers)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stats = PipelineStats()
+
+    @staticmethod
+    def _put(target, item, stop):
+        """Put into a bounded queue, giving up once the pipeline is stopping"""
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(source, stop):
+        while True:
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return _DONE
+
+    def run(self, file_paths, progress=None, known=None):
+        """Ingest file_paths (any iterable, consumed lazily)
+
+        Args:
+            progress (callable): Called after each written round with
+                (files_in_round, processed_total, failed_total, skipped_total)
+            known (dict): {file_path: (id, file_size, file_mtime, content_hash)} of
+                stored documents; files whose size and mtime, or content hash,
+                still match are skipped instead of re-embedded
+
+        Returns:
+            tuple: (processed_count, failed_count, skipped_count)
+        """
+        self.stats = PipelineStats()
+        self.seen_paths = set()
+        extracted = queue.Queue(maxsize=self.queue_size)
+        embedded = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        errors = []
+
+        producer = threading.Thread(target=self._produce, args=(file_paths, known or {}, extracted, stop, errors),
+                                    name='ingest-extract', daemon=True)
+        embedder = threading.Thread(target=self._embed, args=(extracted, embedded, stop, errors),
+                                    name='ingest-embed', daemon=True)
+        producer.start()
+        embedder.start()
+
+        processed_count = 0
+        failed_count = 0
+        skipped_count = 0
+        try:
+            while True:
+                batch = self._get(embedded, stop)
+                if batch is _DONE:
+                    break
+                stored, failed, skipped = self._write(batch)
+                processed_count += stored
+                failed_count += failed
+                skipped_count += skipped
+                if progress is not None:
+                    progress(len(batch), processed_count, failed_count, skipped_count)
+        finally:
+            # Unblock the other stages if the writer stops early
+            stop.set()
+            producer.join()
+            embedder.join()
+
+        if errors:
+            raise errors[0]
+        return processed_count, failed_count, skipped_count
+
+    def purge_missing(self, known, present_paths):
+        """Delete stored documents whose files no longer exist
+
+        Args:
+            known (dict): Stored documents, as passed to run()
+            present_paths (set): Paths found by the walk
+        """
+        purged = 0
+        for file_path, (document_id, _, _, _) in known.items():
+            if file_path not in present_paths and not os.path.exists(file_path):
+                if self.store.delete_document(document_id):
+                    purged += 1
+        return purged
+
+    def _produce(self, file_paths, known, extracted, stop, errors):
+        try:
+            # Spawned rather than forked: this runs in a thread of a process with other threads
+            # (and maybe torch's pools) holding locks a forked child would inherit
+            with ProcessPoolExecutor(max_workers=self.extract_workers,
+                                     mp_context=multiprocessing.get_context('spawn')) as pool:
+                for file_path in file_paths:
+                    start = time.perf_counter()
+                    self.seen_paths.add(file_path)
+                    try:
+                        size, mtime = file_state(file_path)
+                    except OSError as e:
+                        print(f"Error reading file {file_path}: {str(e)}")
+                        size = mtime = None
+                    item = _Item(file_path, size, mtime, known.get(file_path))
+                    self.stats.record('walk', items=1, seconds=time.perf_counter() - start)
+
+                    if item.known is not None and size is not None and item.known[1:3] == (size, mtime):
+                        # Same size and mtime: don't even read the file
+                        item.status = 'unchanged'
+                        self.stats.record('skip', items=1)
+                    elif size is not None:
+                        item.future = pool.submit(_extract, file_path)
+                    else:
+                        item.status = 'failed'
+
+                    if not self._put(extracted, item, stop):
+                        pool.shutdown(cancel_futures=True)
+                        return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            self._put(extracted, _DONE, stop)
+
+    def _embed(self, extracted, embedded, stop, errors):
+        try:
+            batch = []
+            pending = 0  # items of the batch that need embedding
+            while True:
+                item = self._get(extracted, stop)
+                if item is _DONE:
+                    break
+                if item.future is not None:
+                    self._collect(item)
+                    if item.status == 'pending':
+                        pending += 1
+                batch.append(item)
+
+                if pending >= self.batch_size or len(batch) >= MAX_ROUND_FILES:
+                    if not self._put(embedded, self._embed_batch(batch), stop):
+                        return
+                    batch, pending = [], 0
+            if batch:
+                self._put(embedded, self._embed_batch(batch), stop)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            self._put(embedded, _DONE, stop)
+
+    def _collect(self, item):
+        """Wait for an item's extraction and decide whether it needs embedding"""
+        try:
+            item.text, item.content_hash, seconds = item.future.result()
+        except Exception as e:
+            print(f"Error reading file {item.file_path}: {str(e)}")
+            seconds = 0.0
+        item.future = None
+        record('extract', seconds, file_type=os.path.splitext(item.file_path)[1].lower())
+
+        if item.known is not None and item.content_hash is not None and item.known[3] == item.content_hash:
+            # Touched but identical content: only the stored size and mtime need refreshing
+            item.status = 'unchanged'
+            item.text = None
+            self.stats.record('extract', items=1, seconds=seconds)
+            self.stats.record('skip', items=1)
+        elif item.text is None or item.text.strip() == "":
+            print(f"No content extracted from {item.file_path}")
+            item.status = 'failed'
+            item.text = None
+            self.stats.record('extract', failed=1, seconds=seconds)
+        else:
+            self.stats.record('extract', items=1, seconds=seconds)
+
+    def _embed_batch(self, batch):
+        """Embed the extracted documents of a round; documents that fail are marked failed"""
+        start = time.perf_counter()
+        todo = [item for item in batch if item.status == 'pending']
+        if not todo:
+            return batch
+        try:
+            for item, result in zip(todo, self.embeder.embed_documents([item.text for item in todo])):
+                item.result, item.status = result, 'embedded'
+        except Exception as e:
+            print(f"Error embedding batch of {len(todo)} documents: {str(e)}")
+            # Fall back to one document at a time so a single bad input doesn't fail the batch
+            for item in todo:
+                try:
+                    item.result, item.status = self.embeder.embed_document(item.text), 'embedded'
+                except Exception as e:
+                    print(f"Error embedding {item.file_path}: {str(e)}")
+                    item.status = 'failed'
+
+        succeeded = sum(1 for item in todo if item.status == 'embedded')
+        self.stats.record('embed', items=succeeded, failed=len(todo) - succeeded,
+                          seconds=time.perf_counter() - start)
+        return batch
+
+    def _write(self, batch):
+        """Store a round: unchanged files get their state refreshed, embedded ones are written in bulk"""
+        start = time.perf_counter()
+        failed = skipped = 0
+        embedded = []
+        for item in batch:
+            if item.status == 'unchanged':
+                if item.known[1:3] != (item.size, item.mtime):
+                    try:
+                        self.store.update_file_state(item.known[0], item.size, item.mtime)
+                    except Exception as e:
+                        print(f"Error storing {item.file_path}: {str(e)}")
+                skipped += 1
+            elif item.status == 'embedded':
+                embedded.append(item)
+            else:
+                failed += 1
+
+        stored = 0
+        try:
+            if embedded:
+                # Documents and vectors in one transaction: a file is never recorded without its vectors
+                self.store.store_documents_bulk([
+                    (item.file_path, item.text, item.size, item.mtime, item.content_hash, item.result[0].tobytes(),
+                     [(ordinal, chunk_start, chunk_end, embedding.tobytes())
+                      for ordinal, chunk_start, chunk_end, embedding in item.result[1]])
+                    for item in embedded
+                ], model_name=self.embeder.model_name)
+                stored = len(embedded)
+        except Exception as e:
+            print(f"Error storing batch of {len(embedded)} documents: {str(e)}")
+            self.stats.record('write', failed=len(embedded))
+            failed += len(embedded)
+
+        # Release the texts as soon as the round is written
+        for item in batch:
+            status = {'unchanged': 'skipped', 'embedded': 'stored' if stored else 'failed'}.get(item.status, 'failed')
+            FILES.inc(file_type=os.path.splitext(item.file_path)[1].lower(), status=status)
+            item.text = item.result = None
+
+        self.stats.record('write', items=stored, seconds=time.perf_counter() - start)
+        return stored, failed, skipped
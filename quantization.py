@@ -0,0 +1,248 @@
+import os
+import numpy as np
+
+# Encodings of stored embedding blobs; the name is kept in the dtype column of every row
+STORAGE_CODECS = ('float32', 'float16', 'int8')
+
+# Encodings of the resident search index
+INDEX_CODECS = ('float32', 'float16', 'int8', 'pq')
+
+# Product quantization: dimensions per sub-vector, and rows its codebooks are trained on
+PQ_SUBVECTOR_DIM = int(os.environ.get('PQ_SUBVECTOR_DIM', 8))
+PQ_TRAINING_ROWS = 65536
+PQ_ITERATIONS = 10
+
+# Bounds the float32 copy made while scoring or decoding a block of codes
+BLOCK_ELEMENTS = 1 << 22
+
+def encode_vector(vector, codec):
+    """Encode a float32 vector as a storage blob
+
+    int8 blobs start with the vector's float32 scale, followed by one signed
+    byte per dimension.
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    if codec == 'float32':
+        return vector.tobytes()
+    if codec == 'float16':
+        return vector.astype(np.float16).tobytes()
+    if codec == 'int8':
+        scale = np.float32(np.abs(vector).max() / 127) if vector.size else np.float32(0)
+        codes = np.round(vector / scale) if scale > 0 else np.zeros_like(vector)
+        return scale.tobytes() + codes.astype(np.int8).tobytes()
+    raise ValueError(f"Unknown storage codec '{codec}', expected one of {STORAGE_CODECS}")
+
+def decode_vector(blob, codec='float32'):
+    """Decode a storage blob back to a float32 vector (rows written before codecs are float32)"""
+    if codec is None or codec == 'float32':
+        return np.frombuffer(blob, dtype=np.float32)
+    if codec == 'float16':
+        return np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+    if codec == 'int8':
+        scale = np.frombuffer(blob, dtype=np.float32, count=1)[0]
+        return np.frombuffer(blob, dtype=np.int8, offset=4).astype(np.float32) * scale
+    raise ValueError(f"Unknown storage codec '{codec}', expected one of {STORAGE_CODECS}")
+
+def _blocks(num_rows, width):
+    block = max(1, BLOCK_ELEMENTS // max(width, 1))
+    for start in range(0, num_rows, block):
+        yield slice(start, start + block)
+
+class Float32Codec:
+    """Uncompressed rows: scores are exact"""
+    name = 'float32'
+    lossy = False
+    needs_training = False
+    trained = True
+
+    def __init__(self, dimension=None):
+        self.dimension = dimension
+
+    def code_shape(self, dimension):
+        return (dimension,), np.float32
+
+    def train(self, vectors):
+        pass
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float32)
+
+    def decode(self, codes):
+        return codes
+
+    def score(self, codes, query):
+        return codes @ query
+
+    def score_many(self, codes, queries):
+        """(queries, rows) scores of a block of queries"""
+        return queries @ codes.T
+
+    def bytes_per_vector(self, dimension):
+        return 4 * dimension
+
+class Float16Codec(Float32Codec):
+    """Half-precision rows, widened to float32 a block at a time for scoring"""
+    name = 'float16'
+    lossy = True
+
+    def code_shape(self, dimension):
+        return (dimension,), np.float16
+
+    def encode(self, vectors):
+        return np.asarray(vectors).astype(np.float16)
+
+    def decode(self, codes):
+        return codes.astype(np.float32)
+
+    def score(self, codes, query):
+        scores = np.empty(len(codes), dtype=np.float32)
+        for block in _blocks(len(codes), codes.shape[1]):
+            scores[block] = codes[block].astype(np.float32) @ query
+        return scores
+
+    def score_many(self, codes, queries):
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for block in _blocks(len(codes), codes.shape[1]):
+            scores[:, block] = queries @ codes[block].astype(np.float32).T
+        return scores
+
+    def bytes_per_vector(self, dimension):
+        return 2 * dimension
+
+class Int8Codec(Float32Codec):
+    """Symmetric int8 rows with a per-vector float32 scale
+
+    Each code row is 4 bytes of scale followed by one signed byte per dimension.
+    """
+    name = 'int8'
+    lossy = True
+
+    def code_shape(self, dimension):
+        return (dimension + 4,), np.uint8
+
+    def encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        codes = np.empty((len(vectors), vectors.shape[1] + 4), dtype=np.uint8)
+        codes[:, :4] = scales.astype(np.float32)[:, None].view(np.uint8)
+        codes[:, 4:] = np.round(vectors / scales[:, None]).astype(np.int8).view(np.uint8)
+        return codes
+
+    @staticmethod
+    def _scales(codes):
+        return np.ascontiguousarray(codes[:, :4]).view(np.float32).ravel()
+
+    def decode(self, codes):
+        return codes[:, 4:].view(np.int8).astype(np.float32) * self._scales(codes)[:, None]
+
+    def score(self, codes, query):
+        scores = np.empty(len(codes), dtype=np.float32)
+        for block in _blocks(len(codes), codes.shape[1]):
+            part = codes[block]
+            scores[block] = (part[:, 4:].view(np.int8).astype(np.float32) @ query) * self._scales(part)
+        return scores
+
+    def score_many(self, codes, queries):
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for block in _blocks(len(codes), codes.shape[1]):
+            part = codes[block]
+            scores[:, block] = (queries @ part[:, 4:].view(np.int8).astype(np.float32).T) * self._scales(part)
+        return scores
+
+    def bytes_per_vector(self, dimension):
+        return dimension + 4
+
+class ProductQuantizer:
+    """Product quantization: one byte per PQ_SUBVECTOR_DIM dimensions
+
+    Vectors are split into sub-vectors, each replaced by the id of its nearest
+    of up to 256 k-means centroids trained for that subspace. Queries are
+    scored by asymmetric distance computation: a (subspaces x 256) table of
+    query/centroid inner products is summed along each row's codes.
+    """
+    name = 'pq'
+    lossy = True
+    needs_training = True
+
+    def __init__(self, subvector_dim=PQ_SUBVECTOR_DIM):
+        self.subvector_dim = subvector_dim
+        self.codebooks = None  # (subspaces, centroids, subvector_dim)
+        self.dimension = None
+
+    @property
+    def trained(self):
+        return self.codebooks is not None
+
+    def code_shape(self, dimension):
+        return (-(-dimension // self.subvector_dim),), np.uint8
+
+    def _split(self, vectors):
+        """(rows, subspaces, subvector_dim) view of vectors, zero-padded to whole sub-vectors"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        subspaces = self.code_shape(vectors.shape[1])[0][0]
+        padding = subspaces * self.subvector_dim - vectors.shape[1]
+        if padding:
+            vectors = np.pad(vectors, ((0, 0), (0, padding)))
+        return vectors.reshape(len(vectors), subspaces, self.subvector_dim)
+
+    def train(self, vectors, seed=0):
+        rng = np.random.default_rng(seed)
+        if len(vectors) > PQ_TRAINING_ROWS:
+            vectors = vectors[np.sort(rng.choice(len(vectors), PQ_TRAINING_ROWS, replace=False))]
+        self.dimension = vectors.shape[1]
+        sub_vectors = self._split(vectors)
+        num_centroids = min(256, len(vectors))
+
+        codebooks = np.empty((sub_vectors.shape[1], num_centroids, self.subvector_dim), dtype=np.float32)
+        for subspace in range(sub_vectors.shape[1]):
+            points = sub_vectors[:, subspace]
+            centroids = points[rng.choice(len(points), num_centroids, replace=False)].copy()
+            for _ in range(PQ_ITERATIONS):
+                labels = self._nearest(points, centroids)
+                counts = np.bincount(labels, minlength=num_centroids)
+                sums = np.zeros_like(centroids)
+                for dim in range(self.subvector_dim):
+                    sums[:, dim] = np.bincount(labels, weights=points[:, dim], minlength=num_centroids)
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+            codebooks[subspace] = centroids
+        self.codebooks = codebooks
+
+    @staticmethod
+    def _nearest(points, centroids):
+        # argmin ||p - c||^2 == argmax (p.c - ||c||^2 / 2)
+        return np.argmax(points @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+
+    def encode(self, vectors):
+        sub_vectors = self._split(vectors)
+        codes = np.empty(sub_vectors.shape[:2], dtype=np.uint8)
+        for subspace in range(sub_vectors.shape[1]):
+            codes[:, subspace] = self._nearest(sub_vectors[:, subspace], self.codebooks[subspace])
+        return codes
+
+    def decode(self, codes):
+        subspaces = np.arange(codes.shape[1])
+        vectors = self.codebooks[subspaces, codes].reshape(len(codes), -1)
+        return vectors[:, :self.dimension]
+
+    def score(self, codes, query):
+        table = np.einsum('skd,sd->sk', self.codebooks, self._split(query[None])[0])
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for subspace in range(codes.shape[1]):
+            scores += table[subspace][codes[:, subspace]]
+        return scores
+
+    def score_many(self, codes, queries):
+        # Each query needs its own lookup table
+        return np.stack([self.score(codes, query) for query in queries])
+
+    def bytes_per_vector(self, dimension):
+        return self.code_shape(dimension)[0][0]
+
+def make_codec(name):
+    """Resident index codec by name"""
+    codecs = {'float32': Float32Codec, 'float16': Float16Codec, 'int8': Int8Codec, 'pq': ProductQuantizer}
+    if name not in codecs:
+        raise ValueError(f"Unknown index codec '{name}', expected one of {INDEX_CODECS}")
+    return codecs[name]()
@@ -1,57 +1,172 @@
 from database import db
-from embeder import DocumentEmbedder
-import sqlite3
+from embeder import get_embedder, DOCUMENTS_PER_ROUND
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import logging
+import os
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def rebuild_all_embeddings():
-    """Rebuild embeddings for all documents in the database using the improved embedding method"""
-    embeder = DocumentEmbedder()
-    
-    # Get all documents from the database
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, file_path, document_text FROM documents")
-    documents = cursor.fetchall()
-    conn.close()
-    
-    logger.info(f"Found {len(documents)} documents to reprocess")
-    
-    # Clear existing embeddings
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM embeddings")
-    conn.commit()
-    conn.close()
-    
-    logger.info("Cleared existing embeddings")
-    
-    # Rebuild embeddings
-    success_count = 0
-    error_count = 0
-    
-    for doc_id, file_path, document_text in documents:
-        try:
-            logger.info(f"Processing document {doc_id}: {file_path}")
-            
-            # Generate new embedding
-            embedding = embeder.generate_embedding(document_text)
-            
-            # Convert to binary blob
-            embedding_blob = embedding.tobytes()
-            
-            # Store embedding
-            db.insert_embedding(doc_id, embedding_blob)
-            
-            success_count += 1
-            
-        except Exception as e:
-            logger.error(f"Error processing document {doc_id}: {str(e)}")
-            error_count += 1
-    
-    logger.info(f"Embedding rebuild complete. Successful: {success_count}, Failed: {error_count}")
+# Most documents embedded per second by a rebuild (0 for no limit), so live searches keep their share of the CPU
+REBUILD_MAX_DOCS_PER_SEC = float(os.environ.get('REBUILD_MAX_DOCS_PER_SEC', 0))
+
+# Niceness added to a rebuild run from the command line, so the scheduler favors the server
+REBUILD_NICE = int(os.environ.get('REBUILD_NICE', 10))
+
+class RateLimiter:
+    """Spaces out batches so no more than rate documents per second start (0 for no limit)"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.monotonic()
+    
+    def wait(self, count):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        start = max(self._next, now)
+        self._next = start + count / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+def embed_batch(embeder, batch):
+    """Embed (document_id, file_path, document_text) rows
+    
+    Returns:
+        tuple: (document_id, document_text, embedding_blob, chunks) tuples for write_rebuild_batch,
+            and the IDs of the documents that failed
+    """
+    try:
+        embedded = embeder.embed_documents([document_text for _, _, document_text in batch])
+    except Exception as e:
+        logger.error(f"Error processing batch, retrying documents one by one: {str(e)}")
+        embedded = []
+        for doc_id, file_path, document_text in batch:
+            try:
+                embedded.append(embeder.embed_document(document_text))
+            except Exception as e:
+                logger.error(f"Error processing document {doc_id} ({file_path}): {str(e)}")
+                embedded.append(None)
+    
+    documents, failed = [], []
+    for (doc_id, _, document_text), result in zip(batch, embedded):
+        if result is None:
+            failed.append(doc_id)
+            continue
+        document_embedding, chunks = result
+        documents.append((doc_id, document_text, document_embedding.tobytes(),
+                          [(ordinal, start, end, embedding.tobytes()) for ordinal, start, end, embedding in chunks]))
+    return documents, failed
+
+def _rebuild_pass(embeder, rebuild_id, read_batch, after_id, batch_size, workers, limiter, failed, checkpointed):
+    """Embed the documents read_batch(after_id, batch_size) pages through and store them in the shadow tables
+    
+    Up to workers batches are embedded at once; they are stored in order, so
+    the checkpoint only ever covers documents that are done.
+    """
+    counts = {'done': 0, 'failed': 0}
+    start_time = time.perf_counter()
+    
+    def batches():
+        after = after_id
+        while True:
+            rows = read_batch(after, batch_size)
+            if not rows:
+                return
+            after = rows[-1][0]
+            rows = [row for row in rows if row[0] not in failed]
+            if rows:
+                limiter.wait(len(rows))
+                yield rows
+    
+    def store(batch, future):
+        documents, batch_failed = future.result()
+        failed.update(batch_failed)
+        counts['done'] += db.write_rebuild_batch(rebuild_id, documents, embeder.model_name,
+                                                 checkpoint=batch[-1][0] if checkpointed else None,
+                                                 failed=len(batch_failed))
+        counts['failed'] += len(batch_failed)
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"Rebuilt {counts['done']} documents ({counts['done'] / elapsed:.1f} docs/sec), "
+                    f"up to document {batch[-1][0]}")
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in batches():
+            pending.append((batch, pool.submit(embed_batch, embeder, batch)))
+            if len(pending) > workers:
+                store(*pending.popleft())
+        while pending:
+            store(*pending.popleft())
+    return counts
+
+def rebuild_all_embeddings(batch_size=DOCUMENTS_PER_ROUND, workers=1, max_docs_per_sec=REBUILD_MAX_DOCS_PER_SEC,
+                           restart=False):
+    """Rebuild embeddings for all documents in the database using the improved embedding method
+    
+    New embeddings go to shadow tables while searches keep using the current
+    ones, which are replaced in one transaction at the end. Progress is
+    checkpointed after every batch, so an interrupted rebuild resumes where it
+    stopped unless restart is set or the model changed. Chunks whose text and
+    model configuration are in the embedding cache are not embedded again.
+    """
+    embeder = get_embedder()
+    cache_before = embeder.cache.stats() if embeder.cache is not None else None
+    
+    rebuild = db.start_rebuild(embeder.model_name, restart=restart)
+    if rebuild['documents_done'] or rebuild['documents_failed']:
+        logger.info(f"Resuming rebuild {rebuild['id']} after document {rebuild['checkpoint']} "
+                    f"({rebuild['documents_done']} documents done)")
+    else:
+        logger.info(f"Started rebuild {rebuild['id']} with {embeder.model_name}")
+    
+    limiter = RateLimiter(max_docs_per_sec)
+    failed = set()
+    
+    # Every document in ID order, from the checkpoint on
+    counts = _rebuild_pass(embeder, rebuild['id'], db.get_documents_after, rebuild['checkpoint'],
+                           batch_size, workers, limiter, failed, checkpointed=True)
+    
+    # Then those added or changed behind the checkpoint meanwhile, until none are left to swap in
+    while True:
+        backlog = _rebuild_pass(embeder, rebuild['id'], db.get_rebuild_backlog, 0,
+                                batch_size, workers, limiter, failed, checkpointed=False)
+        counts = {key: counts[key] + backlog[key] for key in counts}
+        if db.swap_rebuild(rebuild['id'], failed):
+            break
     
+    logger.info(f"Embedding rebuild complete. Successful: {counts['done']}, Failed: {counts['failed']}")
+    if cache_before is not None and embeder.cache.enabled:
+        logger.info(f"Embedding cache: {embeder.cache.summary(cache_before)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed every document, swapping the new embeddings in at the end")
+    parser.add_argument('--batch-size', type=int, default=DOCUMENTS_PER_ROUND,
+                        help='Documents embedded together and stored per checkpoint')
+    parser.add_argument('--workers', type=int, default=1, help='Batches embedded concurrently')
+    parser.add_argument('--max-docs-per-sec', type=float, default=REBUILD_MAX_DOCS_PER_SEC,
+                        help='Rate limit (0 for none)')
+    parser.add_argument('--nice', type=int, default=REBUILD_NICE, help='Niceness added to this process')
+    parser.add_argument('--restart', action='store_true', help='Discard an interrupted rebuild instead of resuming it')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Run the model on every chunk, e.g. after upgrading torch or transformers')
+    args = parser.parse_args()
+    
+    if args.nice and hasattr(os, 'nice'):
+        os.nice(args.nice)
+    
+    # Servers sharing a memory-mapped index switch to the new vectors once this process republishes it
+    from vector_index import VECTOR_STORE, VectorIndex
+    if VECTOR_STORE == 'mmap':
+        VectorIndex(db)
+    
+    if args.no_cache:
+        get_embedder().cache = None
+    
+    rebuild_all_embeddings(args.batch_size, args.workers, args.max_docs_per_sec, args.restart)
+
 if __name__ == "__main__":
-    rebuild_all_embeddings()
\ No newline at end of file
+    main()
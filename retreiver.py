@@ -1,16 +1,94 @@
-import numpy as np
 import os
-from embeder import DocumentEmbedder
+import copy
+import numpy as np
+from embeder import get_embedder
 from database import db  # Import the database instance
+from vector_index import VectorIndex
+from cache import LRUCache
+from batcher import QueryBatcher
+
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 1024))
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 3600))
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 1024))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 300))
+
+# 'vector' ranks by embedding similarity, 'lexical' by BM25 over the full text,
+# 'hybrid' fuses both rankings with reciprocal rank fusion
+SEARCH_MODES = ('vector', 'lexical', 'hybrid')
+
+# Reciprocal rank fusion: a document scores sum(1 / (RRF_K + rank)) over the rankings it appears in
+RRF_K = int(os.environ.get('RRF_K', 60))
+
+# Documents taken from each ranking before fusing, per requested result
+HYBRID_CANDIDATE_FACTOR = 4
+
+# Lexical candidates the vector search is restricted to with prefilter=True
+PREFILTER_CANDIDATES = int(os.environ.get('PREFILTER_CANDIDATES', 1000))
+
+# Queries embedded and scored together by search_many before their results are yielded
+SEARCH_BATCH_SIZE = int(os.environ.get('SEARCH_BATCH_SIZE', 256))
 
 class DocumentRetriever:
-    def __init__(self, query, db_path='document_embeddings.db'):
-        """Initialize the DocumentRetriever with a query"""
-        self.query = query
-        self.embeder = DocumentEmbedder()
-        # Note: We're using the centralized db instance instead of connecting directly
+    def __init__(self, embeder=None, store=None):
+        """Initialize the DocumentRetriever with an embedder and a document store
 
-    def search_similar_documents(self, query_text, top_k=5, file_extensions=None, min_similarity=0):
+        Args:
+            embeder (DocumentEmbedder): Embedder used for queries (defaults to the shared instance)
+            store (Database): Database holding the document embeddings (defaults to the global db)
+        """
+        self.embeder = embeder if embeder is not None else get_embedder()
+        self.store = store if store is not None else db
+        self.index = VectorIndex(self.store)
+        
+        # Concurrent searches share forward passes for their query embeddings
+        self.batcher = QueryBatcher(self.embeder)
+        
+        # Query text -> query vector, and query vector + search options -> results
+        self.query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+        self.result_cache = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+        self._result_version = None
+    
+    def embed_query(self, query_text):
+        """Query embedding, reused for repeated queries that only differ in whitespace (or case, for uncased models)"""
+        return self.embed_queries([query_text])[0]
+    
+    def embed_queries(self, query_texts):
+        """Embeddings of many queries; those not cached are embedded together in batched forward passes"""
+        lowercase = getattr(getattr(self.embeder, 'tokenizer', None), 'do_lower_case', False)
+        normalized = [' '.join(text.split()) for text in query_texts]
+        if lowercase:
+            normalized = [text.lower() for text in normalized]
+        
+        embeddings = [self.query_cache.get((self.embeder.model_name, text)) for text in normalized]
+        missing = sorted({text for text, embedding in zip(normalized, embeddings) if embedding is None})
+        if missing:
+            computed = {}
+            # A full batch gains nothing from waiting for other callers
+            if len(missing) >= self.batcher.max_batch_size:
+                computed_embeddings = self.embeder.generate_embeddings(missing)
+            else:
+                computed_embeddings = self.batcher.embed_many(missing)
+            for text, embedding in zip(missing, computed_embeddings):
+                # Copied so a cached row doesn't keep the whole batch alive
+                embedding = embedding.copy()
+                embedding.flags.writeable = False
+                self.query_cache.put((self.embeder.model_name, text), embedding)
+                computed[text] = embedding
+            embeddings = [computed[text] if embedding is None else embedding
+                          for text, embedding in zip(normalized, embeddings)]
+        return embeddings
+    
+    def cache_stats(self):
+        """Hit, miss and eviction counters of both caches"""
+        return {
+            'corpus_version': self.store.corpus_version,
+            'query_embeddings': self.query_cache.stats(),
+            'results': self.result_cache.stats()
+        }
+
+    def search_similar_documents(self, query_text, top_k=5, file_extensions=None, min_similarity=0,
+                                 aggregation='max', top_n=3, nprobe=None, exact=False, mode='vector',
+                                 prefilter=False, filters=None):
         """Find most similar documents to a query text using cosine similarity
         
         Args:
@@ -18,44 +96,209 @@ class DocumentRetriever:
             top_k (int): Maximum number of results to return
             file_extensions (list): Optional list of file extensions to filter by (e.g. ['.pdf', '.docx'])
             min_similarity (float): Minimum similarity score (0-1) to include in results
+            aggregation (str): How chunk scores become a document score: 'max' or 'top_n_mean'
+            top_n (int): Number of best chunks averaged by 'top_n_mean'
+            nprobe (int): IVF lists probed on large corpora; higher is slower but more accurate
+            exact (bool): Skip the approximate index and score every chunk
+            mode (str): 'vector', 'lexical' (BM25 over the full text) or 'hybrid'
+                (both rankings fused by reciprocal rank fusion)
+            prefilter (bool): Only score the vectors of the best lexical matches,
+                which is much less work per query on a large corpus
+            filters (dict): Document metadata filters: path_prefix, created_after,
+                created_before ('YYYY-MM-DD[ HH:MM:SS]'), min_size and max_size (bytes)
+        
+        Lexical and hybrid results also carry a 'score' (BM25, or the fused
+        score); documents found only by lexical search have no similarity or
+        passage, and their snippet is the matching part of their text.
         """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', expected one of {SEARCH_MODES}")
+        
         # Generate embedding for the query
-        query_embedding = self.embeder.generate_embedding(query_text)
+        query_embedding = self.embed_query(query_text) if mode != 'lexical' else None
         
-        # Get all document embeddings from the database
-        document_embeddings = db.get_all_document_embeddings()
+        key = self._result_key(query_text, query_embedding, top_k, file_extensions, min_similarity,
+                               aggregation, top_n, nprobe, exact, mode, prefilter, filters,
+                               self._result_version_check())
+        results = self.result_cache.get(key)
+        if results is not None:
+            return copy.deepcopy(results)
         
-        results = []
-        for doc_id, file_path, document_text, embedding_blob in document_embeddings:
-            # Apply file extension filter if specified
-            if file_extensions:
-                ext = os.path.splitext(file_path)[1].lower()
-                if ext not in file_extensions:
-                    continue
-                    
-            # Convert blob back to numpy array
-            doc_embedding = np.frombuffer(embedding_blob, dtype=np.float32)
+        depth = top_k if mode != 'hybrid' else top_k * HYBRID_CANDIDATE_FACTOR
+        lexical = None
+        if mode != 'vector' or prefilter:
+            # BM25 ranking from the FTS5 index
+            lexical_depth = PREFILTER_CANDIDATES if prefilter and mode != 'lexical' else depth
+            lexical = self.store.search_lexical(query_text, lexical_depth, file_extensions, filters)
+        
+        if mode == 'lexical':
+            results = [{'id': doc_id, 'file_path': file_path, 'similarity': None, 'score': score,
+                        'passage': None, 'snippet': snippet}
+                       for doc_id, file_path, score, snippet in lexical[:top_k]]
+            self.result_cache.put(key, copy.deepcopy(results))
+            return results
+        
+        # Score the chunks in the resident embedding matrix (or the probed part of it, or
+        # only the chunks of the lexical candidates)
+        hits = self.index.search(
+            query_embedding,
+            top_k=depth,
+            file_extensions=file_extensions,
+            min_similarity=min_similarity,
+            aggregation=aggregation,
+            top_n=top_n,
+            nprobe=nprobe,
+            exact=exact,
+            document_ids=[hit[0] for hit in lexical] if prefilter else None,
+            filters=filters
+        )
+        
+        if mode == 'hybrid':
+            return self._fuse(key, hits, lexical, top_k)
+        
+        results = self._vector_results(hits)
+        self.result_cache.put(key, copy.deepcopy(results))
+        return results
+    
+    def search_many(self, queries, top_k=5, file_extensions=None, min_similarity=0, aggregation='max', top_n=3,
+                    nprobe=None, exact=False, mode='vector', prefilter=False, filters=None):
+        """Search many queries, yielding the results of each one in order
+        
+        Vector queries are handled SEARCH_BATCH_SIZE at a time: the uncached
+        ones are embedded in batched forward passes and scored against the
+        corpus together (see VectorIndex.search_many). Lexical, hybrid and
+        prefiltered queries are searched one by one.
+        
+        Args:
+            queries (list): Query strings, or dicts with a 'query' and any keyword
+                arguments of search_similar_documents that override the defaults below
+        
+        Yields:
+            list: Results of each query, as returned by search_similar_documents
+        """
+        defaults = {'top_k': top_k, 'file_extensions': file_extensions, 'min_similarity': min_similarity,
+                    'aggregation': aggregation, 'top_n': top_n, 'nprobe': nprobe, 'exact': exact,
+                    'mode': mode, 'prefilter': prefilter, 'filters': filters}
+        for start in range(0, len(queries), SEARCH_BATCH_SIZE):
+            batch = []
+            for query in queries[start:start + SEARCH_BATCH_SIZE]:
+                options = dict(defaults)
+                if isinstance(query, dict):
+                    options.update(query)
+                else:
+                    options['query'] = query
+                if options['mode'] not in SEARCH_MODES:
+                    raise ValueError(f"Unknown search mode '{options['mode']}', expected one of {SEARCH_MODES}")
+                batch.append(options)
             
-            # Ensure the document embedding is normalized
-            if np.linalg.norm(doc_embedding) > 0:
-                doc_embedding = doc_embedding / np.linalg.norm(doc_embedding)
+            vector = [i for i, options in enumerate(batch) if options['mode'] == 'vector' and not options['prefilter']]
+            embeddings = self.embed_queries([batch[i]['query'] for i in vector])
+            version = self._result_version_check()
             
-            # Calculate cosine similarity
-            similarity = np.dot(query_embedding, doc_embedding)
+            results, pending = {}, []
+            for i, embedding in zip(vector, embeddings):
+                options = batch[i]
+                key = self._result_key(options['query'], embedding, options['top_k'], options['file_extensions'],
+                                       options['min_similarity'], options['aggregation'], options['top_n'],
+                                       options['nprobe'], options['exact'], 'vector', False, options['filters'],
+                                       version)
+                cached = self.result_cache.get(key)
+                if cached is not None:
+                    results[i] = copy.deepcopy(cached)
+                else:
+                    pending.append((i, key, embedding))
             
-            # Apply minimum similarity filter
-            if similarity < min_similarity:
+            if pending:
+                hits = self.index.search_many(
+                    np.vstack([embedding for _, _, embedding in pending]),
+                    [{name: batch[i][name] for name in ('top_k', 'file_extensions', 'min_similarity', 'aggregation',
+                                                        'top_n', 'nprobe', 'exact', 'filters')}
+                     for i, _, _ in pending]
+                )
+                for (i, key, _), query_hits in zip(pending, hits):
+                    results[i] = self._vector_results(query_hits)
+                    self.result_cache.put(key, copy.deepcopy(results[i]))
+            
+            for i, options in enumerate(batch):
+                if i in results:
+                    yield results[i]
+                else:
+                    yield self.search_similar_documents(options.pop('query'), **options)
+    
+    def _result_version_check(self):
+        """Current corpus version, dropping cached results if it changed"""
+        # Results stay valid until the corpus changes (here, or in another process sharing a mapped store)
+        version = (self.store.corpus_version, self.index.refresh())
+        if version != self._result_version:
+            self.result_cache.clear()
+            self._result_version = version
+        return version
+    
+    @staticmethod
+    def _result_key(query_text, query_embedding, top_k, file_extensions, min_similarity, aggregation, top_n,
+                    nprobe, exact, mode, prefilter, filters, version):
+        return (mode, prefilter, query_text if mode != 'vector' or prefilter else None,
+                query_embedding.tobytes() if query_embedding is not None else None, top_k,
+                tuple(sorted(file_extensions)) if file_extensions else None,
+                tuple(sorted(filters.items())) if filters else None,
+                min_similarity, aggregation, top_n, nprobe, exact, version)
+    
+    def _vector_results(self, hits):
+        """Result dicts of vector hits"""
+        # Only the best passage of each winner is read, for the snippet
+        snippets = self.store.get_passages([(doc_id, start, end) for doc_id, _, _, start, end in hits])
+        
+        results = []
+        for doc_id, similarity, ordinal, start, end in hits:
+            if doc_id not in snippets:
                 continue
-                
+            file_path, snippet = snippets[doc_id]
             results.append({
                 'id': doc_id,
                 'file_path': file_path,
                 'similarity': similarity,
-                'document_text': document_text[:200] + '...' if len(document_text) > 200 else document_text
+                'passage': {
+                    'chunk': ordinal,
+                    'start_char': start,
+                    'end_char': end if end >= 0 else None
+                },
+                'snippet': snippet
             })
+        return results
+    
+    def _fuse(self, key, hits, lexical, top_k):
+        """Merge vector hits and lexical matches by reciprocal rank fusion"""
+        fused = {}
+        for rank, hit in enumerate(hits, start=1):
+            fused[hit[0]] = fused.get(hit[0], 0.0) + 1.0 / (RRF_K + rank)
+        for rank, match in enumerate(lexical, start=1):
+            fused[match[0]] = fused.get(match[0], 0.0) + 1.0 / (RRF_K + rank)
+        winners = sorted(fused, key=lambda doc_id: -fused[doc_id])[:top_k]
+        
+        # Vector hits show their best passage, lexical-only matches the FTS5 snippet
+        vector_hits = {hit[0]: hit for hit in hits if hit[0] in winners}
+        lexical_matches = {match[0]: match for match in lexical}
+        snippets = self.store.get_passages([(doc_id, start, end) for doc_id, _, _, start, end in vector_hits.values()])
         
-        # Sort by similarity (highest first)
-        results.sort(key=lambda x: x['similarity'], reverse=True)
+        results = []
+        for doc_id in winners:
+            if doc_id in vector_hits and doc_id in snippets:
+                _, similarity, ordinal, start, end = vector_hits[doc_id]
+                file_path, snippet = snippets[doc_id]
+                passage = {'chunk': ordinal, 'start_char': start, 'end_char': end if end >= 0 else None}
+            elif doc_id in lexical_matches:
+                _, file_path, _, snippet = lexical_matches[doc_id]
+                similarity, passage = None, None
+            else:
+                continue
+            results.append({
+                'id': doc_id,
+                'file_path': file_path,
+                'similarity': similarity,
+                'score': fused[doc_id],
+                'passage': passage,
+                'snippet': snippet
+            })
         
-        # Return top_k results
-        return results[:top_k]
+        self.result_cache.put(key, copy.deepcopy(results))
+        return results
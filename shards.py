@@ -0,0 +1,218 @@
+import os
+import heapq
+import itertools
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from quantization import make_codec
+from vector_store import ROW_DTYPE
+
+# Worker processes scoring the mapped vector store in parallel, one shard each (0 or 1 scores in process)
+SEARCH_SHARDS = int(os.environ.get('SEARCH_SHARDS', 0))
+
+# Below this many vectors a search is faster in process than fanned out to the shards
+SHARD_MIN_VECTORS = int(os.environ.get('SHARD_MIN_VECTORS', 100000))
+
+# Thread pools of the numerical libraries; one thread per shard process keeps them from oversubscribing the cores
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+# Documents with consecutive IDs placed on the same shard, so a shard scores long runs of rows in place
+SHARD_SLAB_DOCUMENTS = 256
+
+# Runs of a shard's rows shorter than this are copied together and scored in blocks rather than one by one
+MIN_RUN_ROWS = 64
+
+# Bytes of codes a shard process copies and scores at a time, so the copy stays in cache
+SCORE_BLOCK_BYTES = 1 << 21
+
+# Worker process state: vectors file -> its codes mapped read-only, (rows file, rows, shard) -> its layout
+_codes = {}
+_layouts = {}
+
+def _map_codes(directory, manifest, codec):
+    path = os.path.join(directory, manifest['vectors_file'])
+    codes = _codes.get(path)
+    if codes is None or len(codes) < manifest['rows']:
+        _codes.clear()
+        shape, dtype = codec.code_shape(manifest['dimension'])
+        codes = _codes[path] = np.memmap(path, dtype=dtype, mode='r', shape=(manifest['rows'],) + shape)
+    return codes
+
+def shard_groups(group_doc, num_shards):
+    """Groups (documents) of each shard
+
+    A document's shard depends on its ID alone, in slabs of SHARD_SLAB_DOCUMENTS
+    consecutive IDs dealt out in turn, so it keeps its shard across generations.
+    """
+    shard_of = np.asarray(group_doc) // SHARD_SLAB_DOCUMENTS % num_shards
+    return [np.flatnonzero(shard_of == number) for number in range(num_shards)]
+
+def _shard_layout(directory, manifest, number, num_shards):
+    """Groups of one shard and how to score their rows, from the rows file
+
+    Returns:
+        tuple: (global group numbers, group offsets into the shard's rows, runs, scattered):
+            runs are (offset, first_row, last_row) of long runs of consecutive rows,
+            scattered the (offsets, row numbers) of the rest
+    """
+    key = (manifest['rows_file'], manifest['rows'], number, num_shards)
+    layout = _layouts.get(key)
+    if layout is None:
+        if len(_layouts) > 64:
+            _layouts.clear()
+        rows = np.memmap(os.path.join(directory, manifest['rows_file']), dtype=ROW_DTYPE, mode='r',
+                         shape=(manifest['rows'],))
+        starts = np.flatnonzero(rows['first'])
+        groups = shard_groups(rows['document_id'][starts], num_shards)[number]
+        lengths = np.diff(np.append(starts, manifest['rows']))[groups]
+        offsets = np.cumsum(lengths) - lengths
+        row_numbers = np.repeat(starts[groups] - offsets, lengths) + np.arange(lengths.sum())
+
+        breaks = np.flatnonzero(np.diff(row_numbers) != 1) + 1
+        run_starts = np.concatenate(([0], breaks))
+        run_ends = np.append(breaks, len(row_numbers))
+        long = run_ends - run_starts >= MIN_RUN_ROWS
+        runs = [(int(start), int(row_numbers[start]), int(row_numbers[end - 1]) + 1)
+                for start, end in zip(run_starts[long], run_ends[long])]
+        scattered = np.ones(len(row_numbers), dtype=bool)
+        for start, end in zip(run_starts[long], run_ends[long]):
+            scattered[start:end] = False
+        scattered = np.flatnonzero(scattered)
+        layout = _layouts[key] = (groups, offsets, runs, (scattered, row_numbers[scattered]))
+    return layout
+
+def score_shard(directory, manifest, codec_name, shard, allowed_bits, query, k, min_score):
+    """Best k groups of one shard by their best row's score (runs in a shard process)
+
+    Args:
+        manifest (dict): Generation of the mapped store to score
+        shard (tuple): (number, num_shards, num_groups) of the shard
+        allowed_bits (np.ndarray): np.packbits of the allowed mask of the shard's groups
+
+    Returns:
+        list: (score, group) of the best groups, highest first (ties by group);
+            group numbers are global
+    """
+    number, num_shards, num_groups = shard
+    codec = make_codec(codec_name)
+    codes = _map_codes(directory, manifest, codec)
+    groups, offsets, runs, (scattered, scattered_rows) = _shard_layout(directory, manifest, number, num_shards)
+    if len(groups) != num_groups:
+        raise RuntimeError("Shard groups don't match the mapped generation")
+    if not num_groups:
+        return []
+
+    scores = np.empty(sum(last - first for _, first, last in runs) + len(scattered), dtype=np.float32)
+    for offset, first, last in runs:
+        scores[offset:offset + last - first] = codec.score(codes[first:last], query)
+    block = max(1, SCORE_BLOCK_BYTES // max(codes[0].nbytes, 1))
+    for start in range(0, len(scattered), block):
+        scores[scattered[start:start + block]] = codec.score(codes[scattered_rows[start:start + block]], query)
+    allowed = np.unpackbits(allowed_bits, count=num_groups).astype(bool)
+    return top_groups(scores, offsets, allowed, k, min_score, groups)
+
+def top_groups(scores, starts, allowed, k, min_score, groups=None):
+    """Best k allowed groups by their best row's score, at least min_score
+
+    Args:
+        scores (np.ndarray): Score of every row of the groups
+        starts (np.ndarray): Offset of each group's first row in scores
+        groups (np.ndarray): Global numbers of the groups, if they aren't all of them in order
+
+    Returns:
+        list: (score, group) of the best groups, highest first (ties by group)
+    """
+    group_scores = np.maximum.reduceat(scores, starts)
+    group_scores[~allowed] = -np.inf
+    valid = np.flatnonzero(group_scores >= min_score)
+    if len(valid) > k:
+        valid = valid[np.argpartition(-group_scores[valid], k - 1)[:k]]
+    valid = valid[np.lexsort((valid, -group_scores[valid]))]
+    return list(zip(group_scores[valid].tolist(), (valid if groups is None else groups[valid]).tolist()))
+
+def _ready():
+    return os.getpid()
+
+@contextmanager
+def _single_threaded_libraries():
+    """Environment for starting shard processes; the calling process keeps its own settings"""
+    saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    os.environ.update({name: '1' for name in THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+class ShardPool:
+    """Worker processes that each score one shard of the mapped vector store
+
+    Documents are placed by ID (see shard_groups), so a document's chunks
+    are always scored together, by the same shard in every generation.
+    Shard i is always scored by process i, which maps the store's files
+    read-only, so every process shares one page-cache copy of the vectors.
+    A search sends every shard the query and the allowed mask of its groups;
+    each returns its local top k and the results are merged with a heap.
+    """
+
+    def __init__(self, num_shards=SEARCH_SHARDS):
+        self.num_shards = num_shards
+        self._executors = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Processes don't survive fork, so a forked server process starts its own
+        if self._executors is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._executors is None or self._pid != os.getpid():
+                # Spawned rather than forked: the server has threads (and maybe torch's pools) running
+                context = multiprocessing.get_context('spawn')
+                with _single_threaded_libraries():
+                    executors = [ProcessPoolExecutor(max_workers=1, mp_context=context)
+                                 for _ in range(self.num_shards)]
+                    # Start every process now, while the environment is set
+                    for future in [executor.submit(_ready) for executor in executors]:
+                        future.result()
+                self._executors = executors
+                self._pid = os.getpid()
+
+    def search(self, directory, manifest, codec_name, shards, allowed, query, k, min_score):
+        """Merge the local top k of every shard
+
+        Args:
+            shards (list): Group numbers of each shard, as returned by shard_groups
+            allowed (np.ndarray): Mask of the allowed groups of the whole generation
+
+        Returns:
+            list: (score, group) of the best k groups, highest first
+        """
+        self._ensure_started()
+        try:
+            futures = [
+                self._executors[number].submit(
+                    score_shard, directory, manifest, codec_name, (number, len(shards), len(groups)),
+                    np.packbits(allowed[groups]), query, k, min_score)
+                for number, groups in enumerate(shards)
+            ]
+            shard_hits = [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A shard process died; start them all again on the next search
+            self.close()
+            raise
+        # Every shard's list is sorted the same way, ties going to the earlier group
+        merged = heapq.merge(*shard_hits, key=lambda hit: (-hit[0], hit[1]))
+        return list(itertools.islice(merged, k))
+
+    def close(self):
+        if self._executors is not None and self._pid == os.getpid():
+            for executor in self._executors:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._executors = None
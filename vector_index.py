@@ -0,0 +1,994 @@
+import os
+import atexit
+import threading
+import numpy as np
+from ann_index import IVFIndex
+from quantization import make_codec, decode_vector, PQ_TRAINING_ROWS
+from vector_store import MappedVectorStore, ROW_DTYPE
+from shards import ShardPool, shard_groups, top_groups, SEARCH_SHARDS, SHARD_MIN_VECTORS
+from metrics import timed
+
+# Row grows are amortized by doubling the capacity of every array
+MIN_CAPACITY = 16
+
+AGGREGATIONS = ('max', 'top_n_mean')
+
+# Approximate search: 'ivf' or 'off'
+ANN_INDEX = os.environ.get('ANN_INDEX', 'ivf')
+
+# Below this many vectors exact search is fast enough and no ANN index is built
+ANN_MIN_VECTORS = int(os.environ.get('ANN_MIN_VECTORS', 50000))
+
+# The ANN index is retrained once the corpus has grown this much since training
+ANN_RETRAIN_GROWTH = 4
+
+# Documents found by the ANN probe that are rescored exactly, per requested result
+ANN_RERANK_FACTOR = 4
+
+# Encoding of the resident vectors: 'float32', 'float16', 'int8' or 'pq' (see quantization.py)
+INDEX_CODEC = os.environ.get('INDEX_CODEC', 'float32')
+
+# With a lossy codec, documents rescored from their stored vectors, per requested result
+RESCORE_FACTOR = 4
+
+# Filters that leave fewer than this share of the rows are scored as a candidate list instead of a full scan
+FILTER_CANDIDATE_RATIO = 0.1
+
+# Filter masks kept until the indexed documents change
+MAX_FILTER_MASKS = 256
+
+# Bounds the (queries x rows) score matrix of a search_many block
+SCORE_BLOCK_ELEMENTS = 1 << 25
+
+# Where the resident vectors live: 'memory' (per process) or 'mmap' (files shared by every process)
+VECTOR_STORE = os.environ.get('VECTOR_STORE', 'memory')
+
+def _resize(array, capacity):
+    resized = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    resized[:len(array)] = array
+    return resized
+
+class _DecodedRows:
+    """Read-only float32 view of encoded rows, decoded one slice at a time"""
+
+    def __init__(self, codec, codes, dimension):
+        self.codec = codec
+        self.codes = codes
+        self.shape = (len(codes), dimension)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        return self.codec.decode(self.codes[key])
+
+class VectorIndex:
+    """Resident, pre-normalized matrix of chunk embeddings used for vectorized search
+
+    The chunks of a document occupy a contiguous run of rows (a "group"), so
+    per-document scores come from a single np.maximum.reduceat over the chunk
+    scores. The matrix is loaded from the database on first use and then kept
+    in sync through the database listener hooks. Removed documents are
+    tombstoned and compacted away once they make up a quarter of the rows.
+
+    Documents embedded before chunking was introduced only have a row in the
+    embeddings table; they are indexed as a single row whose end offset is -1.
+
+    Large indexes are also partitioned by an IVF index (see ann_index.py);
+    searches then only score the rows of the probed lists and rescore the
+    best documents exactly, unless exact=True is requested.
+
+    Rows can be kept compressed (float16, int8 or product-quantized codes,
+    see quantization.py). Scores over the codes are then only used to pick
+    candidates, which are rescored with their stored vectors.
+
+    With vector_store='mmap' the rows are not copied into every process but
+    mapped read-only from a MappedVectorStore next to the database (see
+    vector_store.py), so server workers share one page-cache copy and start
+    without reading the vector tables. Each database write is published to
+    the store as one new generation, which the other processes switch to on
+    their next search.
+
+    With shards > 1 (mmap only), exact searches of large indexes are fanned
+    out to a pool of processes that each score the groups of the documents
+    placed on them by ID (see shards.py) and the coordinator merges their local top k.
+    """
+
+    def __init__(self, store, ann=ANN_INDEX, ann_min_vectors=ANN_MIN_VECTORS, codec=INDEX_CODEC,
+                 rescore_factor=RESCORE_FACTOR, vector_store=VECTOR_STORE, shards=SEARCH_SHARDS,
+                 shard_min_vectors=SHARD_MIN_VECTORS):
+        self.store = store
+        self._codec = make_codec(codec)
+        self.rescore_factor = rescore_factor
+        self._lock = threading.RLock()
+        self._loaded = False
+        self.ann_min_vectors = ann_min_vectors
+        db_path = getattr(store, 'db_path', None)
+        self._ivf = None
+        if ann == 'ivf':
+            self._ivf = IVFIndex(f"{os.path.splitext(db_path)[0]}.ivf.npz" if db_path else None)
+            atexit.register(self.save)
+        elif ann not in (None, 'off'):
+            raise ValueError(f"Unknown ANN index '{ann}', expected 'ivf' or 'off'")
+        self._mapped = None
+        self._manifest = None
+        self._vector_version = None  # Memory store only: the stored vector version the rows reflect
+        self._pending = {}  # document id -> (file_path, rows, chunked) to publish, or None to delete
+        if vector_store == 'mmap':
+            if self._codec.needs_training or not db_path:
+                raise ValueError("The mmap vector store needs a database file and a float32, float16 or int8 codec")
+            self._mapped = MappedVectorStore(f"{os.path.splitext(db_path)[0]}.vectors", self._codec)
+        elif vector_store != 'memory':
+            raise ValueError(f"Unknown vector store '{vector_store}', expected 'memory' or 'mmap'")
+        self._shards = None
+        self.shard_min_vectors = shard_min_vectors
+        if shards > 1:
+            if self._mapped is None:
+                raise ValueError("Sharded search needs the mmap vector store, which the shard processes map")
+            self._shards = ShardPool(shards)
+        self._reset()
+        store.add_listener(self)
+
+    def _reset(self):
+        # Per-row arrays
+        self._size = 0
+        self._dimension = None
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._row_ordinal = np.empty(0, dtype=np.int64)
+        self._row_start = np.empty(0, dtype=np.int64)
+        self._row_end = np.empty(0, dtype=np.int64)
+        # Per-document (group) arrays
+        self._num_groups = 0
+        self._group_start = np.empty(0, dtype=np.int64)
+        self._group_len = np.empty(0, dtype=np.int64)
+        self._group_doc = np.empty(0, dtype=np.int64)
+        self._group_ext = np.empty(0, dtype=object)
+        self._group_alive = np.empty(0, dtype=bool)
+        self._group_chunked = np.empty(0, dtype=bool)
+        self._groups = {}  # document id -> group
+        self._dead_rows = 0
+        self._masks = {}  # filter -> mask of the groups it allows
+        self._shard_groups = None  # (generation, group numbers of each shard) of the mapped store
+        # Mapped store only: ROW_DTYPE records and dead row numbers of the mapped generation
+        self._row_records = np.empty(0, dtype=ROW_DTYPE)
+        self._dead = np.empty(0, dtype=np.int64)
+        if self._ivf is not None:
+            self._ivf.reset()
+
+    def __len__(self):
+        """Number of indexed documents"""
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._groups)
+
+    @property
+    def num_vectors(self):
+        with self._lock:
+            self._ensure_loaded()
+            return self._size - self._dead_rows
+
+    @staticmethod
+    def _normalize(vectors):
+        """Scale rows to unit length, leaving all-zero rows untouched"""
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def memory_usage(self):
+        """Bytes held by the resident vectors, compared to uncompressed float32 rows"""
+        with self._lock:
+            self._ensure_loaded()
+            dimension = self._dimension or 0
+            used = self._size * self._codec.bytes_per_vector(dimension)
+            float32 = self._size * 4 * dimension
+            return {'codec': self._codec.name, 'vectors': self._size, 'bytes': used,
+                    'float32_bytes': float32, 'saved_bytes': float32 - used}
+
+    @staticmethod
+    def _extension(file_path):
+        return os.path.splitext(file_path)[1].lower()
+
+    def load(self):
+        """Load the index now instead of on the first search (does nothing once loaded)"""
+        self._ensure_loaded()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            if self._mapped is not None:
+                self._open_mapped()
+            else:
+                self.reload()
+
+    def _prepare_ann(self):
+        """Restore the saved IVF index of a freshly loaded corpus, or train one"""
+        if self._ivf is not None and self._size >= self.ann_min_vectors:
+            if not self._ivf.load(*self._ann_keys()):
+                self._train_ann()
+
+    def reload(self, replaced=False):
+        """(Re)build the index from every chunk and embedding stored in the database
+
+        Args:
+            replaced (bool): Every stored vector was replaced (a rebuild was swapped in),
+                so other processes mapping the store drop their ANN index too
+        """
+        with self._lock, timed('index_load'):
+            self._reset()
+            self._loaded = True
+            if self._mapped is not None:
+                self._pending = {}
+                self._rebuild_mapped(new_epoch=replaced)
+                self._prepare_ann()
+                return
+
+            # Read the version first: a write racing the load makes the next refresh() reload again
+            self._vector_version = self.store.get_vector_version()
+            records = self.store.get_all_chunk_vectors()
+            if self._codec.needs_training and records:
+                self._train_codec(records)
+
+            current_doc, current_path, rows = None, None, []
+            for doc_id, file_path, ordinal, start, end, embedding_blob, dtype in records:
+                if doc_id != current_doc and rows:
+                    self._add_rows(current_doc, current_path, rows, chunked=rows[0][2] >= 0)
+                    rows = []
+                current_doc, current_path = doc_id, file_path
+                rows.append((ordinal, start, end if end is not None else -1, decode_vector(embedding_blob, dtype)))
+            if rows:
+                self._add_rows(current_doc, current_path, rows, chunked=rows[0][2] >= 0)
+
+            if self._codec.lossy:
+                usage = self.memory_usage()
+                print(f"Indexed {usage['vectors']} vectors as {usage['codec']}: {usage['bytes'] / 2**20:.1f} MB, "
+                      f"{usage['saved_bytes'] / 2**20:.1f} MB less than float32")
+
+            self._prepare_ann()
+
+    # Memory-mapped store
+    @staticmethod
+    def _group_records(records):
+        """Group get_all_chunk_vectors() records into (document_id, file_path, rows) per document"""
+        documents = []
+        for doc_id, file_path, ordinal, start, end, embedding_blob, dtype in records:
+            if not documents or documents[-1][0] != doc_id:
+                documents.append((doc_id, file_path, []))
+            documents[-1][2].append((ordinal, start, end if end is not None else -1,
+                                     decode_vector(embedding_blob, dtype)))
+        return documents
+
+    def _encode_groups(self, documents):
+        """Encoded rows and ROW_DTYPE records of (document_id, file_path, rows) groups"""
+        codes, records = [], []
+        for document_id, file_path, rows in documents:
+            vectors = self._normalize(np.vstack([row[3] for row in rows]).astype(np.float32, copy=False))
+            if self._dimension is None:
+                self._dimension = vectors.shape[1]
+            elif vectors.shape[1] != self._dimension:
+                print(f"Skipping embeddings for document {document_id}: dimension "
+                      f"{vectors.shape[1]} != {self._dimension}")
+                continue
+            extension = self._extension(file_path).encode('utf-8')[:ROW_DTYPE['extension'].itemsize]
+            records.extend((document_id, ordinal, start, end, position == 0, extension)
+                           for position, (ordinal, start, end, _) in enumerate(rows))
+            codes.append(self._codec.encode(vectors))
+
+        if not codes:
+            shape, dtype = self._codec.code_shape(self._dimension or 0)
+            return np.empty((0,) + shape, dtype=dtype), np.empty(0, dtype=ROW_DTYPE)
+        return np.concatenate(codes), np.array(records, dtype=ROW_DTYPE)
+
+    def _open_mapped(self, base_version=None):
+        """Map the published generation, rebuilding the store if it doesn't match the database
+
+        Args:
+            base_version (int): Also accept a generation stamped with this older
+                vector version, which a write this process is staging brings up to date
+        """
+        self._loaded = True
+        manifest = self._mapped.read_manifest()
+        if (manifest is None or manifest['codec'] != self._codec.name
+                or manifest['stamp'] not in (self.store.get_vector_version(), base_version)):
+            self.reload()
+            return
+        self._load_generation(manifest)
+        self._prepare_ann()
+
+    def _rebuild_mapped(self, new_epoch=False):
+        """Write every stored vector to a new file set of the mapped store"""
+        with self._mapped.locked():
+            # Read the version first: a write racing the export leaves the store stale, never wrongly current
+            stamp = self.store.get_vector_version()
+            codes, records = self._encode_groups(self._group_records(self.store.get_all_chunk_vectors()))
+            manifest = self._mapped.publish(self._mapped.read_manifest(), self._dimension, codes, records,
+                                            [], stamp, new_file_set=True, new_epoch=new_epoch)
+        self._load_generation(manifest)
+        print(f"Wrote {manifest['rows']} vectors to {self._mapped.directory}")
+
+    def _load_generation(self, manifest):
+        """Point the row and group arrays at a published generation of the mapped store"""
+        previous = self._manifest
+        manifest, codes, rows, dead = self._mapped.open(manifest)
+        self._manifest = manifest
+        size = manifest['rows']
+
+        self._size = size
+        self._dimension = manifest['dimension']
+        self._matrix = codes
+        self._row_records = rows
+        self._row_ordinal = rows['ordinal']
+        self._row_start = rows['start']
+        self._row_end = rows['end']
+
+        group_start = np.flatnonzero(rows['first'])
+        self._num_groups = len(group_start)
+        self._group_start = group_start
+        self._group_len = np.diff(np.append(group_start, size))
+        self._group_doc = np.asarray(rows['document_id'][group_start])
+        self._group_ext = np.char.decode(rows['extension'][group_start], 'utf-8').astype(object)
+        self._group_alive = ~np.isin(group_start, dead)
+        self._group_chunked = rows['end'][group_start] >= 0
+        alive = np.flatnonzero(self._group_alive)
+        self._groups = dict(zip(self._group_doc[alive].tolist(), alive.tolist()))
+        self._dead = dead
+        self._dead_rows = len(dead)
+        self._masks.clear()
+
+        if self._ivf is not None and self._ivf.trained:
+            if previous is not None and previous['file_set'] == manifest['file_set'] and previous['rows'] <= size:
+                if size > previous['rows']:
+                    self._ivf.append(previous['rows'], self._rows()[previous['rows']:size])
+            elif previous is not None and (previous['dimension'] != manifest['dimension']
+                                           or previous.get('epoch', 0) != manifest.get('epoch', 0)):
+                # Another model's vectors (a rebuild was swapped in): train again on first use
+                self._ivf.reset()
+            else:
+                # A new file set: keep the centroids, assign its rows again
+                self._ivf.assign_all(self._rows())
+
+    def refresh(self):
+        """Catch up with the vectors other processes wrote
+
+        The mapped store switches to the newest published generation (one stat
+        call otherwise); the memory store reloads if the stored vector version
+        moved past the one it reflects (one query otherwise).
+
+        Returns:
+            int: The mapped generation, or the stored vector version of the memory store
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if self._mapped is None:
+                if self.store.get_vector_version() != self._vector_version:
+                    self.reload()
+                return self._vector_version
+            if self._mapped.changed():
+                manifest = self._mapped.read_manifest()
+                if manifest is None:
+                    self.reload()
+                elif manifest['generation'] != self._manifest['generation']:
+                    self._load_generation(manifest)
+            return self._manifest['generation']
+
+    def _stage(self, document_id, change):
+        """Queue a change for the mapped store; flush() publishes it once the database write is done"""
+        if not self._loaded:
+            # The write is already committed: files stamped just before it only miss what is being staged
+            get_base_version = getattr(self.store, 'get_vector_version_before_write', None)
+            self._open_mapped(get_base_version() if get_base_version is not None else None)
+        self._pending[document_id] = change
+
+    def flush(self):
+        """Publish the changes staged for the mapped store as one new generation"""
+        with self._lock:
+            if self._mapped is None or not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            with self._mapped.locked():
+                manifest = self._mapped.read_manifest()
+                if manifest is None:
+                    self._rebuild_mapped()
+                    return
+                if manifest['generation'] != self._manifest['generation']:
+                    self._load_generation(manifest)
+
+                dead, documents = [self._dead], []
+                for document_id, change in pending.items():
+                    group = self._groups.get(document_id)
+                    if change is not None and not change[2] and group is not None and self._group_chunked[group]:
+                        # A whole-document embedding doesn't replace chunks
+                        continue
+                    if group is not None:
+                        start = self._group_start[group]
+                        dead.append(np.arange(start, start + self._group_len[group]))
+                    if change is not None:
+                        documents.append((document_id, change[0], change[1]))
+                codes, records = self._encode_groups(documents)
+                dead = np.unique(np.concatenate(dead)).astype(np.int64)
+                stamp = self.store.get_vector_version()
+
+                new_file_set = len(dead) * 4 > self._size + len(records)
+                if new_file_set:
+                    # Compact: write the live rows followed by the new ones to a new file set
+                    keep = np.ones(self._size, dtype=bool)
+                    keep[dead] = False
+                    codes = np.concatenate([self._matrix[keep], codes])
+                    records = np.concatenate([self._row_records[keep], records])
+                    dead = dead[:0]
+                manifest = self._mapped.publish(manifest, self._dimension, codes, records, dead, stamp,
+                                                new_file_set=new_file_set)
+            self._load_generation(manifest)
+
+    def _train_codec(self, records):
+        """Fit a codec that needs training (product quantization) to a sample of the stored vectors"""
+        rng = np.random.default_rng(0)
+        picks = np.sort(rng.choice(len(records), min(len(records), PQ_TRAINING_ROWS), replace=False))
+        sample = [decode_vector(records[i][5], records[i][6]) for i in picks]
+        self._codec.train(self._normalize(np.vstack([vector for vector in sample if len(vector) == len(sample[0])])))
+
+    def _reserve(self, num_rows):
+        """Make room for num_rows more rows and one more group"""
+        needed = self._size + num_rows
+        capacity = len(self._row_ordinal)
+        if needed > capacity:
+            capacity = max(MIN_CAPACITY, capacity * 2, needed)
+            self._matrix = _resize(self._matrix, capacity)
+            self._row_ordinal = _resize(self._row_ordinal, capacity)
+            self._row_start = _resize(self._row_start, capacity)
+            self._row_end = _resize(self._row_end, capacity)
+
+        group_capacity = len(self._group_start)
+        if self._num_groups >= group_capacity:
+            group_capacity = max(MIN_CAPACITY, group_capacity * 2)
+            self._group_start = _resize(self._group_start, group_capacity)
+            self._group_len = _resize(self._group_len, group_capacity)
+            self._group_doc = _resize(self._group_doc, group_capacity)
+            self._group_ext = _resize(self._group_ext, group_capacity)
+            self._group_alive = _resize(self._group_alive, group_capacity)
+            self._group_chunked = _resize(self._group_chunked, group_capacity)
+
+    def _add_rows(self, document_id, file_path, rows, chunked):
+        """Append a group of (ordinal, start_char, end_char, vector) rows for one document"""
+        self._remove(document_id)
+        vectors = self._normalize(np.vstack([row[3] for row in rows]).astype(np.float32, copy=False))
+        if self._size == 0 and self._dimension != vectors.shape[1]:
+            if self._ivf is not None:
+                self._ivf.reset()
+            if self._codec.needs_training and (not self._codec.trained or self._codec.dimension != vectors.shape[1]):
+                # First vectors of an empty index; reload() retrains on the whole corpus
+                self._codec.train(vectors)
+            shape, dtype = self._codec.code_shape(vectors.shape[1])
+            self._dimension = vectors.shape[1]
+            self._matrix = np.empty((0,) + shape, dtype=dtype)
+            self._row_ordinal = np.empty(0, dtype=np.int64)
+            self._row_start = np.empty(0, dtype=np.int64)
+            self._row_end = np.empty(0, dtype=np.int64)
+        elif vectors.shape[1] != self._dimension:
+            print(f"Skipping embeddings for document {document_id}: dimension "
+                  f"{vectors.shape[1]} != {self._dimension}")
+            return
+
+        self._reserve(len(rows))
+        start, end = self._size, self._size + len(rows)
+        self._matrix[start:end] = self._codec.encode(vectors)
+        if self._ivf is not None and self._ivf.trained:
+            self._ivf.append(start, vectors)
+        self._row_ordinal[start:end] = [row[0] for row in rows]
+        self._row_start[start:end] = [row[1] for row in rows]
+        self._row_end[start:end] = [row[2] for row in rows]
+        self._size = end
+
+        group = self._num_groups
+        self._group_start[group] = start
+        self._group_len[group] = len(rows)
+        self._group_doc[group] = document_id
+        self._group_ext[group] = self._extension(file_path)
+        self._group_alive[group] = True
+        self._group_chunked[group] = chunked
+        self._groups[document_id] = group
+        self._num_groups += 1
+        self._masks.clear()
+
+    def _remove(self, document_id):
+        group = self._groups.pop(document_id, None)
+        if group is None:
+            return
+        self._group_alive[group] = False
+        self._dead_rows += int(self._group_len[group])
+        if self._dead_rows * 4 > self._size:
+            self._compact()
+
+    def _compact(self):
+        """Drop tombstoned groups, keeping the remaining rows contiguous per document"""
+        groups = np.flatnonzero(self._group_alive[:self._num_groups])
+        lengths = self._group_len[groups]
+        row_mask = np.repeat(self._group_alive[:self._num_groups], self._group_len[:self._num_groups])
+
+        self._matrix = self._matrix[:self._size][row_mask]
+        self._row_ordinal = self._row_ordinal[:self._size][row_mask]
+        self._row_start = self._row_start[:self._size][row_mask]
+        self._row_end = self._row_end[:self._size][row_mask]
+        self._size = len(self._row_ordinal)
+        if self._ivf is not None and self._ivf.trained:
+            self._ivf.compact(row_mask)
+
+        self._group_start = np.cumsum(lengths) - lengths
+        self._group_len = lengths
+        self._group_doc = self._group_doc[groups]
+        self._group_ext = self._group_ext[groups]
+        self._group_alive = np.ones(len(groups), dtype=bool)
+        self._group_chunked = self._group_chunked[groups]
+        self._num_groups = len(groups)
+        self._groups = {int(doc_id): group for group, doc_id in enumerate(self._group_doc)}
+        self._dead_rows = 0
+        self._masks.clear()
+
+    def add_chunks(self, document_id, file_path, chunks):
+        """Insert or replace the chunk vectors of a document
+
+        Args:
+            chunks (list): (ordinal, start_char, end_char, embedding) tuples
+        """
+        with self._lock:
+            if self._mapped is not None:
+                self._stage(document_id, (file_path, list(chunks), True) if chunks else None)
+                return
+            if not self._loaded:
+                # The first search loads everything from the database anyway
+                return
+            if chunks:
+                self._add_rows(document_id, file_path, chunks, chunked=True)
+            else:
+                self._remove(document_id)
+
+    def add(self, document_id, embedding, file_path):
+        """Index a whole-document embedding, unless the document is already chunked"""
+        with self._lock:
+            if self._mapped is not None:
+                staged = self._pending.get(document_id)
+                if staged is not None and staged[2]:
+                    # Chunks staged by the same write take precedence, as they do once published
+                    return
+                self._stage(document_id, (file_path, [(0, 0, -1, embedding)], False))
+                return
+            if not self._loaded:
+                return
+            group = self._groups.get(document_id)
+            if group is not None and self._group_chunked[group]:
+                return
+            self._add_rows(document_id, file_path, [(0, 0, -1, embedding)], chunked=False)
+
+    def remove(self, document_id):
+        with self._lock:
+            if self._mapped is not None:
+                self._stage(document_id, None)
+                return
+            self._remove(document_id)
+
+    # Approximate search
+    def _ann_keys(self):
+        """(document_ids, ordinals, vectors) of every row, identifying rows in the saved ANN index"""
+        document_ids = np.repeat(self._group_doc[:self._num_groups], self._group_len[:self._num_groups])
+        return document_ids, self._row_ordinal[:self._size], self._rows()
+
+    def _rows(self):
+        """The resident rows as float32 vectors (decoded lazily for compressed codecs)"""
+        if not self._codec.lossy:
+            return self._matrix[:self._size]
+        return _DecodedRows(self._codec, self._matrix[:self._size], self._dimension)
+
+    def _score(self, rows, query):
+        return self._codec.score(self._matrix[rows], query)
+
+    def _train_ann(self):
+        print(f"Training IVF index over {self._size} vectors")
+        self._ivf.train(self._rows())
+        self._ivf.assign_all(self._rows())
+        self.save()
+
+    def save(self):
+        """Persist the ANN index if it changed since it was last saved"""
+        with self._lock:
+            if self._ivf is not None and self._ivf.trained and self._ivf.dirty:
+                try:
+                    self._ivf.save(*self._ann_keys())
+                except OSError as e:
+                    print(f"Error saving ANN index: {str(e)}")
+
+    def _use_ann(self, exact):
+        if exact or self._ivf is None or self._size - self._dead_rows < self.ann_min_vectors:
+            return False
+        if not self._ivf.trained or self._size > ANN_RETRAIN_GROWTH * self._ivf.trained_rows:
+            self._train_ann()
+        return True
+
+    def _ann_scores(self, query, allowed, nprobe, shortlist):
+        """Chunk scores for the rows of the probed IVF lists, -inf elsewhere
+
+        The shortlist documents with the best probed chunks are then rescored
+        in full, so their scores and best passages are exact.
+        """
+        scores = np.full(self._size, -np.inf, dtype=np.float32)
+        rows = self._ivf.probe(query, nprobe)
+        scores[rows] = self._score(rows, query)
+
+        group_scores = np.maximum.reduceat(scores, self._group_start[:self._num_groups])
+        group_scores[~allowed] = -np.inf
+        candidates = self._top_groups(group_scores, np.flatnonzero(group_scores > -np.inf), shortlist)
+        rows = self._group_rows(candidates)
+        scores[rows] = self._score(rows, query)
+        return scores
+
+    def _group_rows(self, groups):
+        """Row numbers of every chunk of the given groups"""
+        lengths = self._group_len[groups]
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(self._group_start[groups] - offsets, lengths) + np.arange(lengths.sum())
+
+    def _top_n_mean(self, query, group, top_n):
+        # Scored from the matrix, as approximate search may only have scored some of the chunks
+        start = self._group_start[group]
+        group_scores = self._score(slice(start, start + self._group_len[group]), query)
+        if len(group_scores) > top_n:
+            group_scores = np.partition(group_scores, len(group_scores) - top_n)[-top_n:]
+        return group_scores.mean()
+
+    def _top_groups(self, group_scores, candidates, top_k):
+        """Indices of the top_k highest-scoring candidate groups, best first"""
+        if candidates.size > top_k:
+            best = np.argpartition(-group_scores[candidates], top_k - 1)[:top_k]
+            candidates = candidates[best]
+        return candidates[np.argsort(-group_scores[candidates], kind='stable')]
+
+    def search(self, query_embedding, top_k=5, file_extensions=None, min_similarity=0,
+               aggregation='max', top_n=3, nprobe=None, exact=False, document_ids=None, filters=None):
+        """Score every chunk and aggregate the scores per document
+
+        Args:
+            aggregation (str): 'max' scores a document by its best chunk,
+                'top_n_mean' by the mean of its top_n best chunks
+            nprobe (int): IVF lists probed by approximate search (higher is
+                slower with better recall); defaults to ANN_NPROBE
+            exact (bool): Score every chunk even when an ANN index is available
+            document_ids (list): Only score the chunks of these documents (e.g.
+                lexical candidates); the ANN index is not used then
+            filters (dict): Metadata filters of Database.list_documents (path_prefix,
+                created_after, created_before, min_size, max_size); filters that
+                leave few rows are scored as a candidate list like document_ids
+
+        Returns:
+            list: (document_id, similarity, ordinal, start_char, end_char) of the
+                best-matching chunk of each result document, highest first
+        """
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation '{aggregation}', expected one of {AGGREGATIONS}")
+
+        with self._lock:
+            self._ensure_loaded()
+            self.refresh()
+            if not self._groups or top_k <= 0:
+                return []
+
+            query = self._normalize(np.asarray(query_embedding, dtype=np.float32).ravel())
+            allowed = self._allowed(file_extensions, filters)
+
+            if document_ids is not None:
+                restricted = np.zeros(self._num_groups, dtype=bool)
+                restricted[[self._groups[document_id] for document_id in document_ids
+                            if document_id in self._groups]] = True
+                allowed &= restricted
+            candidates = document_ids is not None or ((file_extensions or filters) and self._selective(allowed))
+            sharded = (not candidates and not self._use_ann(exact) and self._use_shards(aggregation, top_n))
+
+            if sharded:
+                # Scored in the shard processes, without holding up other searches and writes
+                snapshot = self._shard_snapshot()
+            else:
+                with timed('score'):
+                    if candidates:
+                        # Only the rows of the allowed documents
+                        scores = np.full(self._size, -np.inf, dtype=np.float32)
+                        rows = self._group_rows(np.flatnonzero(allowed))
+                        scores[rows] = self._score(rows, query)
+                    elif self._use_ann(exact):
+                        scores = self._ann_scores(query, allowed, nprobe, top_k * ANN_RERANK_FACTOR)
+                    else:
+                        scores = self._score(slice(0, self._size), query)
+
+                    results, rescore = self._select(query, scores, allowed, top_k, min_similarity,
+                                                    aggregation, top_n)
+                if rescore is None:
+                    return results
+
+        if sharded:
+            results, rescore = self._search_shards(snapshot, query, allowed, top_k, min_similarity)
+            if rescore is None:
+                return results
+
+        # Read outside the lock so ingestion isn't held up by the database
+        return self._rescore(query, rescore, top_k, min_similarity, aggregation, top_n)
+
+    def search_many(self, query_embeddings, options):
+        """Search many queries, scoring them against the corpus together
+
+        Exact searches are scored as one (queries x dimension) x (dimension x
+        rows) matrix product per block of queries, so the matrix is read once
+        per block rather than once per query; blocks are sized to keep the
+        score matrix under SCORE_BLOCK_ELEMENTS. Queries that would use the
+        ANN index go through search() one by one.
+
+        Args:
+            query_embeddings (np.ndarray): (queries, dimension) matrix
+            options (list): search() keyword arguments of each query
+
+        Yields:
+            list: The results of each query, in order, as returned by search()
+        """
+        queries = self._normalize(np.asarray(query_embeddings, dtype=np.float32).reshape(len(options), -1))
+        position = 0
+        while position < len(options):
+            with self._lock:
+                self._ensure_loaded()
+                self.refresh()
+                end = min(len(options), position + max(1, SCORE_BLOCK_ELEMENTS // max(self._size, 1)))
+                allowed = {}
+                for i in range(position, end):
+                    option = options[i]
+                    if (not self._groups or option.get('top_k', 5) <= 0 or option.get('document_ids') is not None
+                            or self._use_ann(option.get('exact', False))):
+                        continue
+                    mask = self._allowed(option.get('file_extensions'), option.get('filters'))
+                    # Selective filters are cheaper to score as a candidate list, in search()
+                    if not ((option.get('file_extensions') or option.get('filters')) and self._selective(mask)):
+                        allowed[i] = mask
+                batched = list(allowed)
+
+                selections = {}
+                if batched:
+                    with timed('score'):
+                        scores = self._codec.score_many(self._matrix[:self._size], queries[batched])
+                    for column, i in enumerate(batched):
+                        option = options[i]
+                        aggregation = option.get('aggregation', 'max')
+                        if aggregation not in AGGREGATIONS:
+                            raise ValueError(f"Unknown aggregation '{aggregation}', expected one of {AGGREGATIONS}")
+                        with timed('score'):
+                            selections[i] = self._select(queries[i], scores[column], allowed[i],
+                                                         option.get('top_k', 5), option.get('min_similarity', 0),
+                                                         aggregation, option.get('top_n', 3))
+
+            # Yield (and rescore, or search one by one) outside the lock
+            for i in range(position, end):
+                if i not in selections:
+                    yield self.search(queries[i], **options[i])
+                    continue
+                results, rescore = selections[i]
+                if rescore is not None:
+                    option = options[i]
+                    results = self._rescore(queries[i], rescore, option.get('top_k', 5),
+                                            option.get('min_similarity', 0), option.get('aggregation', 'max'),
+                                            option.get('top_n', 3))
+                yield results
+            position = end
+
+    # Sharded search
+    def _use_shards(self, aggregation, top_n):
+        # Shards return their best documents by best chunk, which is all 'max' needs
+        return (self._shards is not None and (aggregation == 'max' or top_n <= 1)
+                and self._size - self._dead_rows >= self.shard_min_vectors)
+
+    def _shard_snapshot(self):
+        """The arrays of the current generation, which a mapped store replaces rather than changes in place
+
+        Documents are assigned to shards by ID (see shard_groups), recomputed
+        for every generation.
+        """
+        generation = self._manifest['generation']
+        if self._shard_groups is None or self._shard_groups[0] != generation:
+            self._shard_groups = (generation, shard_groups(self._group_doc[:self._num_groups],
+                                                           self._shards.num_shards))
+        return {
+            'manifest': self._manifest,
+            'shards': self._shard_groups[1],
+            'matrix': self._matrix,
+            'group_start': self._group_start,
+            'group_len': self._group_len,
+            'group_doc': self._group_doc,
+            'row_ordinal': self._row_ordinal,
+            'row_start': self._row_start,
+            'row_end': self._row_end
+        }
+
+    def _search_shards(self, snapshot, query, allowed, top_k, min_similarity):
+        """Like _select, from the best groups of every shard
+
+        Returns:
+            tuple: (results, None), or (None, document ids to rescore) with a lossy codec
+        """
+        lossy = self._codec.lossy
+        k = top_k * self.rescore_factor if lossy else top_k
+        min_score = np.finfo(np.float32).min if lossy else min_similarity
+        with timed('score'):
+            try:
+                hits = self._shards.search(self._mapped.directory, snapshot['manifest'], self._codec.name,
+                                           snapshot['shards'], allowed, query, k, min_score)
+            except Exception as e:
+                # A shard process died, or another process replaced the files before a shard mapped them
+                print(f"Sharded search failed, scoring in process: {e!r}")
+                hits = top_groups(self._codec.score(snapshot['matrix'], query),
+                                  snapshot['group_start'][:len(allowed)], allowed, k, min_score)
+        if lossy:
+            return None, [int(snapshot['group_doc'][group]) for _, group in hits]
+
+        results = []
+        for score, group in hits:
+            start = snapshot['group_start'][group]
+            chunk_scores = self._codec.score(snapshot['matrix'][start:start + snapshot['group_len'][group]], query)
+            best = start + int(np.argmax(chunk_scores))
+            results.append((int(snapshot['group_doc'][group]), score, int(snapshot['row_ordinal'][best]),
+                            int(snapshot['row_start'][best]), int(snapshot['row_end'][best])))
+        return results, None
+
+    def _allowed(self, file_extensions, filters=None):
+        """Mask of the live groups with one of the file extensions and passing the metadata filters
+
+        Masks are computed once per filter and kept until the indexed documents
+        change. Metadata filters are pushed down to the database, which finds
+        the matching documents with its column indexes.
+        """
+        allowed = self._group_alive[:self._num_groups].copy()
+        if file_extensions:
+            extensions = sorted(ext.lower() for ext in file_extensions)
+            allowed &= self._mask(('extensions', tuple(extensions)),
+                                  lambda: np.isin(self._group_ext[:self._num_groups], extensions))
+        filters = {name: value for name, value in (filters or {}).items() if value is not None}
+        if filters:
+            allowed &= self._mask(('filters', tuple(sorted(filters.items()))),
+                                  lambda: np.isin(self._group_doc[:self._num_groups],
+                                                  self.store.filter_document_ids(**filters)))
+        return allowed
+
+    def _mask(self, key, compute):
+        mask = self._masks.get(key)
+        if mask is None:
+            if len(self._masks) >= MAX_FILTER_MASKS:
+                self._masks.clear()
+            mask = self._masks[key] = compute()
+        return mask
+
+    def _selective(self, allowed):
+        """Whether the allowed groups hold few enough rows to score them as a candidate list"""
+        rows = int(self._group_len[:self._num_groups][allowed].sum())
+        return rows < FILTER_CANDIDATE_RATIO * (self._size - self._dead_rows)
+
+    def _select(self, query, scores, allowed, top_k, min_similarity, aggregation, top_n):
+        """Pick the result documents from the chunk scores of one query
+
+        Returns:
+            tuple: (results, None), or (None, document ids to rescore) with a lossy codec
+        """
+        # Best chunk per document in one vectorized pass
+        group_scores = np.maximum.reduceat(scores, self._group_start[:self._num_groups])
+        group_scores[~allowed] = -np.inf
+
+        if self._codec.lossy:
+            # Scores over the codes only pick the documents to rescore
+            if aggregation == 'max' or top_n <= 1:
+                candidates = self._top_groups(group_scores, np.flatnonzero(group_scores > -np.inf),
+                                              top_k * self.rescore_factor)
+            else:
+                candidates, _ = self._search_top_n_mean(query, group_scores, top_k * self.rescore_factor,
+                                                        np.finfo(np.float32).min, top_n)
+            return None, [int(document_id) for document_id in self._group_doc[candidates]]
+
+        if aggregation == 'max' or top_n <= 1:
+            winners = self._top_groups(group_scores, np.flatnonzero(group_scores >= min_similarity), top_k)
+            doc_scores = group_scores[winners]
+        else:
+            winners, doc_scores = self._search_top_n_mean(query, group_scores, top_k, min_similarity, top_n)
+
+        results = []
+        for group, score in zip(winners, doc_scores):
+            start = self._group_start[group]
+            best = start + int(np.argmax(self._score(slice(start, start + self._group_len[group]), query)))
+            results.append((int(self._group_doc[group]), float(score), int(self._row_ordinal[best]),
+                            int(self._row_start[best]), int(self._row_end[best])))
+        return results, None
+
+    @timed('rescore')
+    def _rescore(self, query, document_ids, top_k, min_similarity, aggregation, top_n):
+        """Rank documents by their stored (full-precision) chunk vectors"""
+        documents = {}
+        for doc_id, _, ordinal, start, end, embedding_blob, dtype in self.store.get_all_chunk_vectors(document_ids):
+            documents.setdefault(doc_id, []).append(
+                (ordinal, start, end if end is not None else -1, decode_vector(embedding_blob, dtype)))
+
+        results = []
+        for doc_id, rows in documents.items():
+            vectors = [row[3] for row in rows]
+            if any(len(vector) != len(query) for vector in vectors):
+                continue
+            scores = self._normalize(np.vstack(vectors)) @ query
+            if aggregation == 'max' or top_n <= 1:
+                score = scores.max()
+            else:
+                score = np.sort(scores)[-top_n:].mean()
+            if score >= min_similarity:
+                ordinal, start, end, _ = rows[int(np.argmax(scores))]
+                results.append((doc_id, float(score), ordinal, start, end))
+        results.sort(key=lambda result: -result[1])
+        return results[:top_k]
+
+    def _search_top_n_mean(self, query, group_scores, top_k, min_similarity, top_n):
+        """Rank documents by the mean of their top_n chunks
+
+        A document's top-n mean never exceeds its best chunk, so the exact mean
+        is only computed for the documents with the highest maxima, widening
+        the candidate set until no remaining document could still qualify.
+        """
+        valid = np.flatnonzero(group_scores >= min_similarity)
+        num_candidates = min(valid.size, top_k * 4)
+        while True:
+            candidates = self._top_groups(group_scores, valid, num_candidates)
+            bound = group_scores[candidates[-1]] if num_candidates < valid.size else -np.inf
+
+            means = np.array([self._top_n_mean(query, group, top_n) for group in candidates], dtype=np.float32)
+            keep = means >= min_similarity
+            candidates, means = candidates[keep], means[keep]
+            order = np.argsort(-means, kind='stable')[:top_k]
+
+            threshold = means[order[-1]] if len(order) == top_k else min_similarity
+            if num_candidates >= valid.size or bound < threshold:
+                return candidates[order], means[order]
+            num_candidates = min(valid.size, num_candidates * 4)
+
+    # Database listener hooks
+    def on_chunks_replaced(self, document_id, chunks, file_path, dtype='float32'):
+        self.add_chunks(document_id, file_path, [
+            (ordinal, start, end, decode_vector(embedding_blob, dtype))
+            for ordinal, start, end, embedding_blob in chunks
+        ])
+
+    def on_embedding_inserted(self, document_id, embedding_blob, file_path, dtype='float32'):
+        self.add(document_id, decode_vector(embedding_blob, dtype), file_path)
+
+    def on_document_deleted(self, document_id):
+        self.remove(document_id)
+
+    def on_documents_inserted(self, document_ids):
+        # Their metadata may have changed
+        with self._lock:
+            self._masks.clear()
+
+    def on_changes_committed(self):
+        if self._mapped is not None:
+            self.flush()
+            return
+        with self._lock:
+            # This process's writes are already applied; if another process wrote in between, refresh() reloads
+            if self._loaded and self.store.get_vector_version_before_write() == self._vector_version:
+                self._vector_version += 1
+
+    def on_embeddings_replaced(self):
+        # A rebuild swapped in new tables; searches wait for the reload instead of seeing a partial index
+        with self._lock:
+            if self._ivf is not None:
+                # Centroids trained on the previous embeddings would only hurt recall
+                self._ivf.remove_file()
+            # The mapped store is republished even if this process hasn't searched yet, for the other processes
+            if self._loaded or self._mapped is not None:
+                self.reload(replaced=True)
+
+    def on_embeddings_cleared(self):
+        with self._lock:
+            self._reset()
+            if self._mapped is not None:
+                self._pending = {}
+                self._loaded = True
+                with self._mapped.locked():
+                    manifest = self._mapped.publish(self._mapped.read_manifest(), None, *self._encode_groups([]),
+                                                    [], self.store.get_vector_version(), new_file_set=True,
+                                                    new_epoch=True)
+                self._load_generation(manifest)
+            if self._ivf is not None:
+                # Centroids trained on the old embeddings would only hurt recall
+                self._ivf.remove_file()
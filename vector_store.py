@@ -0,0 +1,186 @@
+import os
+import json
+import threading
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within one process
+    fcntl = None
+
+# One record per vector row: the id sidecar of the vectors file
+ROW_DTYPE = np.dtype([
+    ('document_id', '<i8'),
+    ('ordinal', '<i8'),
+    ('start', '<i8'),
+    ('end', '<i8'),
+    ('first', 'u1'),  # 1 on the first row of each document's group
+    ('extension', 'S31'),
+])
+
+# Retries when a writer removes the files of the generation a reader is opening
+OPEN_ATTEMPTS = 5
+
+class MappedVectorStore:
+    """Encoded chunk vectors in flat files that every process maps read-only with np.memmap
+
+    Files in the store directory:
+        manifest.json           the published generation: row count, file set, dead rows, epoch
+        vectors-<set>.bin       fixed-width encoded rows, row-major, no header
+        rows-<set>.bin          ROW_DTYPE record per row (document id, ordinal, offsets)
+        dead-<generation>.npy   rows removed since the file set was written
+
+    Writers hold an exclusive file lock, append rows past the published row
+    count and publish a new manifest with os.replace(), so readers never see
+    a partial write and a mapped generation never changes under them. Once
+    enough rows are dead, the next write starts a new, compacted file set.
+    """
+
+    def __init__(self, directory, codec):
+        self.directory = directory
+        self.codec = codec
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self._thread_lock = threading.Lock()
+        self._stat = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def changed(self):
+        """Whether the manifest was replaced since it was last read (one stat call)"""
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return self._stat is not None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self._stat
+
+    def read_manifest(self):
+        """The published manifest, or None if nothing was published yet"""
+        try:
+            with open(self.manifest_path) as f:
+                stat = os.fstat(f.fileno())
+                manifest = json.load(f)
+        except FileNotFoundError:
+            self._stat = None
+            return None
+        self._stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return manifest
+
+    def open(self, manifest):
+        """Map a generation read-only
+
+        Returns:
+            tuple: (manifest, codes, rows, dead) for the generation that was actually
+                opened, which is newer than manifest if a writer replaced its files meanwhile
+        """
+        for _ in range(OPEN_ATTEMPTS):
+            try:
+                return (manifest,) + self._open(manifest)
+            except FileNotFoundError:
+                manifest = self.read_manifest()
+                if manifest is None:
+                    break
+        raise RuntimeError(f"Could not open a consistent generation of {self.directory}")
+
+    def _open(self, manifest):
+        num_rows = manifest['rows']
+        shape, dtype = self.codec.code_shape(manifest['dimension'] or 0)
+        if num_rows:
+            codes = np.memmap(self._path(manifest['vectors_file']), dtype=dtype, mode='r',
+                              shape=(num_rows,) + shape)
+            rows = np.memmap(self._path(manifest['rows_file']), dtype=ROW_DTYPE, mode='r', shape=(num_rows,))
+        else:
+            codes = np.empty((0,) + shape, dtype=dtype)
+            rows = np.empty(0, dtype=ROW_DTYPE)
+        dead = np.load(self._path(manifest['dead_file'])) if manifest['dead_file'] else np.empty(0, dtype=np.int64)
+        return codes, rows, dead
+
+    @contextmanager
+    def locked(self):
+        """Exclusive writer lock, across threads and (where fcntl exists) processes"""
+        with self._thread_lock:
+            with open(self._path('lock'), 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_at(path, offset, data):
+        """Write data at offset, dropping anything an interrupted writer left past it"""
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+
+    def publish(self, manifest, dimension, codes, rows, dead, stamp, new_file_set=False, new_epoch=False):
+        """Append rows (or start a new file set with them) and publish the next generation
+
+        Args:
+            manifest (dict): The current manifest, None if nothing was published yet
+            codes (np.ndarray): Encoded rows to append
+            rows (np.ndarray): Their ROW_DTYPE records
+            dead (np.ndarray): Every dead row number of the new generation
+            stamp (list): Database state the new generation corresponds to
+            new_epoch (bool): The rows replace every vector of the previous generation with
+                new embeddings (implies new_file_set), so readers drop what they derived from them
+        """
+        generation = manifest['generation'] + 1 if manifest else 1
+        epoch = manifest.get('epoch', 0) if manifest else 0
+        if new_epoch:
+            epoch += 1
+            new_file_set = True
+        if manifest is None or new_file_set:
+            file_set = generation
+            num_rows = 0
+        else:
+            file_set = manifest['file_set']
+            num_rows = manifest['rows']
+
+        vectors_file, rows_file = f"vectors-{file_set}.bin", f"rows-{file_set}.bin"
+        row_bytes = self.codec.bytes_per_vector(dimension or 0)
+        self._write_at(self._path(vectors_file), num_rows * row_bytes, np.ascontiguousarray(codes).tobytes())
+        self._write_at(self._path(rows_file), num_rows * ROW_DTYPE.itemsize, np.ascontiguousarray(rows).tobytes())
+
+        dead_file = None
+        if len(dead):
+            dead_file = f"dead-{generation}.npy"
+            np.save(self._path(dead_file), np.asarray(dead, dtype=np.int64))
+
+        published = {
+            'generation': generation,
+            'file_set': file_set,
+            'vectors_file': vectors_file,
+            'rows_file': rows_file,
+            'dead_file': dead_file,
+            'rows': num_rows + len(rows),
+            'dimension': dimension,
+            'codec': self.codec.name,
+            'stamp': stamp,
+            'epoch': epoch
+        }
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(published, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self._remove_stale_files(published)
+        return published
+
+    def _remove_stale_files(self, manifest):
+        """Delete the files no longer referenced; processes that still map them keep their pages"""
+        keep = {manifest['vectors_file'], manifest['rows_file'], manifest['dead_file'], 'manifest.json', 'lock'}
+        for name in os.listdir(self.directory):
+            if name not in keep and name.endswith(('.bin', '.npy')):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass